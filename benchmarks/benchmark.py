@@ -0,0 +1,592 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+Benchmarks for html5lib_to_markdown
+
+usage:
+
+    python benchmarks/benchmark.py [suite ...]
+
+If no suite is specified, every suite is run.
+
+The "document mix" is the set of html fixtures in
+``tests/tests_unit/fixtures-transformations``.
+
+Environment variables:
+
+* `MD_BENCHMARK_ROUNDS` - the number of rounds to run each benchmark; default 10
+"""
+
+# stdlib
+import glob
+import importlib
+import multiprocessing
+import os
+import subprocess
+import sys
+import timeit
+import warnings
+
+# local
+import html5lib_to_markdown
+from html5lib_to_markdown.markdown_info import MARKDOWN_TAGS_PRUNE
+from html5lib_to_markdown.transformer import tag_names_coalesce_sensitive
+from html5lib_to_markdown.transformer import tag_names_kept
+from html5lib_to_markdown.transformer import to_markdown
+from html5lib_to_markdown.transformer import Transformer
+from html5lib_to_markdown.utils import coalesce_text_tokens
+from html5lib_to_markdown.utils import copy_tokens
+from html5lib_to_markdown.utils import normalize_characters
+from html5lib_to_markdown.utils import split_blocks
+
+
+# ==============================================================================
+
+
+ROUNDS = int(os.getenv("MD_BENCHMARK_ROUNDS", 10))
+
+_dir_base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_dir_fixtures = os.path.join(
+    _dir_base, "tests", "tests_unit", "fixtures-transformations"
+)
+
+
+# ------------------------------------------------------------------------------
+
+
+def _load_documents():
+    documents = []
+    for _fpath in sorted(glob.glob(os.path.join(_dir_fixtures, "*.html"))):
+        with open(_fpath, "r") as fh:
+            documents.append(fh.read())
+    return documents
+
+
+def _is_compiled(module_name):
+    """is the module a compiled extension, from the optional mypyc build?"""
+    _module = importlib.import_module(module_name)
+    return not _module.__file__.endswith((".py", ".pyc"))
+
+
+def _time(func, rounds=None):
+    """returns the best time of `rounds` runs of `func`"""
+    rounds = ROUNDS if rounds is None else rounds
+    return min(timeit.repeat(func, number=1, repeat=rounds))
+
+
+def _report(title, results):
+    """prints a table of `results`, a list of (label, seconds), fastest first"""
+    print("=" * 80)
+    print(title)
+    print("-" * 80)
+    results = sorted(results, key=lambda i: i[1])
+    _fastest = results[0][1]
+    for (_label, _seconds) in results:
+        print("%-40s %10.2fms %8.2fx" % (_label, _seconds * 1000, _seconds / _fastest))
+    print("fastest: %s" % results[0][0])
+
+
+def _attribute_heavy_document(rows=100, attributes=24):
+    """
+    returns html resembling the output of a frontend framework, in which every
+    element carries dozens of `data-*` attributes
+    """
+    _attrs = " ".join(
+        'data-v-%04x="%s" data-testid="cell-%s"' % (i, i, i) for i in range(attributes)
+    )
+    _rows = []
+    for _row in range(rows):
+        _rows.append(
+            '<tr class="row" %(attrs)s><td class="cell" %(attrs)s>'
+            '<a href="https://example.com/%(row)s" title="%(row)s" class="link" '
+            "%(attrs)s>link %(row)s</a> "
+            '<img src="https://example.com/%(row)s.png" alt="%(row)s" '
+            'class="img" %(attrs)s></td><td %(attrs)s>text %(row)s</td></tr>'
+            % {"attrs": _attrs, "row": _row}
+        )
+    return "<div %s><table %s>%s</table></div>" % (_attrs, _attrs, "".join(_rows))
+
+
+def _script_heavy_document(blocks=100):
+    """
+    returns html resembling a scraped page, with inline scripts and svg icons
+    around every paragraph of content
+    """
+    _script = "<script>%s</script>" % (
+        "window.dataLayer.push({'event': 'view', 'id': %s});" * 20
+    )
+    _svg = "<svg>%s</svg>" % ('<path d="M0 0h24v24H0z" fill="none"/>' * 10)
+    _blocks = []
+    for _block in range(blocks):
+        _blocks.append(
+            "%s<p>%s paragraph <b>%s</b> of the content.</p>%s"
+            % (_script % ((_block,) * 20), _svg, _block, _svg)
+        )
+    return "".join(_blocks)
+
+
+def _chapter_document(sections=200):
+    """
+    returns html resembling a book chapter or an exported wiki page: a long
+    run of top-level headings, paragraphs and lists
+    """
+    _section = (
+        "<h2>Section %(section)s</h2>\n"
+        "<p>The <b>first</b> paragraph of section %(section)s, with a "
+        '<a href="https://example.com/%(section)s">link</a> and some '
+        "<i>emphasis</i>.</p>\n"
+        "<p>A second paragraph, with <code>code</code> and more text to "
+        "render.</p>\n"
+        "<ul><li>one</li><li>two <em>three</em></li></ul>\n"
+        "<pre>preformatted\ntext</pre>\n"
+    )
+    return "".join(_section % {"section": i} for i in range(sections))
+
+
+def _boilerplate_documents(documents=200):
+    """
+    returns html resembling a crawl of a single site: every page has the same
+    navigation, footer and disclaimer around a different body
+    """
+    _header = "<p>%s</p>\n" % " | ".join(
+        '<a href="https://example.com/%s">%s</a>' % (i, i) for i in range(20)
+    )
+    _footer = (
+        "<hr>\n<p><small>Copyright Example, Inc. All rights reserved. "
+        '<a href="https://example.com/privacy">Privacy</a></small></p>\n'
+        "<p><i>This message and any attachments are confidential, and are "
+        "intended solely for the addressee.</i></p>\n"
+    ) * 3
+    return [
+        "%s<h1>Page %s</h1>\n<p>The <b>body</b> of page %s.</p>\n%s"
+        % (_header, i, i, _footer)
+        for i in range(documents)
+    ]
+
+
+def _span_heavy_document(paragraphs=500, spans=True):
+    """
+    returns html resembling an export from a word processor, in which every
+    run of text within a paragraph is wrapped in a styled `span`
+    """
+    _paragraph = (
+        '<p><span class="c1">The </span><span class="c2">quick</span>'
+        '<span class="c1"> brown fox, </span><font color="red">jumps</font>'
+        "<span> over the </span><sup>%s</sup><span> lazy dog.</span></p>\n"
+    )
+    if not spans:
+        _paragraph = "<p>The quick brown fox, jumps over the %s lazy dog.</p>\n"
+    return "".join(_paragraph % i for i in range(paragraphs))
+
+
+# ==============================================================================
+
+
+def bench_backends():
+    """
+    Compares the parser backends and html5lib treebuilder/walker combinations
+    on the document mix.
+    """
+    documents = _load_documents()
+    combinations = [
+        ("html5lib + etree", {"backend": "html5lib", "treebuilder": "etree"}),
+        ("html5lib + dom", {"backend": "html5lib", "treebuilder": "dom"}),
+        ("html5lib + lxml", {"backend": "html5lib", "treebuilder": "lxml"}),
+        ("html5lib-tokenizer", {"backend": "html5lib-tokenizer"}),
+        ("html.parser", {"backend": "html.parser"}),
+    ]
+    results = []
+    for (_label, _kwargs) in combinations:
+        try:
+            transformer = Transformer(**_kwargs)
+        except ImportError as exc:
+            print("skipping `%s`: %s" % (_label, exc))
+            continue
+
+        def _run():
+            for _html in documents:
+                transformer.transform(_html)
+
+        with warnings.catch_warnings():
+            # the lxml treebuilder warns when it coerces invalid XML names
+            warnings.simplefilter("ignore")
+            results.append((_label, _time(_run)))
+    _report("backends: %s documents" % len(documents), results)
+
+
+def bench_variants():
+    """
+    Compares rendering two Markdown flavors with two ``transform`` calls vs a
+    single ``transform_variants`` call.
+    """
+    documents = _load_documents()
+    variants = {
+        "site": {"a_as_tag": True, "img_as_tag": True},
+        "feed": {"a_as_tag": False, "img_as_tag": False, "reference_style_link": True},
+    }
+    transformer = Transformer()
+    transformers = [Transformer(**_options) for _options in variants.values()]
+
+    def _run_transform():
+        for _html in documents:
+            for _transformer in transformers:
+                _transformer.transform(_html)
+
+    def _run_variants():
+        for _html in documents:
+            transformer.transform_variants(_html, variants)
+
+    results = [
+        ("transform x %s" % len(variants), _time(_run_transform)),
+        ("transform_variants", _time(_run_variants)),
+    ]
+    _report("variants: %s documents" % len(documents), results)
+
+
+def bench_attributes():
+    """
+    Renders attribute-heavy html, in which nearly every attribute must be
+    removed by the attribute allowlists.
+
+    "render" times only ``to_markdown`` and the serializer on pre-tokenized
+    html, as parsing dominates the "transform" timings.
+    """
+    _html = _attribute_heavy_document()
+    results = []
+    for (_label, _kwargs) in (
+        ("a_as_tag, img_as_tag", {}),
+        ("markdown links/images", {"a_as_tag": False, "img_as_tag": False}),
+    ):
+        transformer = Transformer(backend="html5lib-tokenizer", **_kwargs)
+        _options = transformer._markdown_options()
+        _tokens = list(transformer._tokenize(_html))
+        # `to_markdown` alters the tokens, so every round renders a fresh copy
+        _copies = [copy_tokens(_tokens) for _i in range(ROUNDS)]
+        results.append(
+            ("transform: %s" % _label, _time(lambda: transformer.transform(_html)))
+        )
+        results.append(
+            (
+                "render: %s" % _label,
+                _time(lambda: transformer._render(_copies.pop(), _options)),
+            )
+        )
+    _report("attributes: %s characters" % len(_html), results)
+
+
+def bench_prune():
+    """
+    Compares stripping scripts token-by-token with ``strip_scripts`` against
+    pruning the script and svg subtrees before the tree is walked.
+    """
+    _html = _script_heavy_document()
+    transformer_strip = Transformer()
+    transformer_prune = Transformer(prune_tags=MARKDOWN_TAGS_PRUNE)
+    results = [
+        ("strip_scripts", _time(lambda: transformer_strip.transform(_html))),
+        ("prune_tags", _time(lambda: transformer_prune.transform(_html))),
+    ]
+    _report("prune: %s characters" % len(_html), results)
+
+
+def bench_preview():
+    """
+    Compares rendering an entire large document against rendering a preview
+    of its first 300 characters with ``max_output_chars``.
+    """
+    _html = "\n".join(_load_documents() * 10)
+    results = []
+    for _backend in ("html5lib", "html.parser"):
+        transformer = Transformer(backend=_backend)
+        transformer_preview = Transformer(backend=_backend, max_output_chars=300)
+        results.append(
+            ("%s: full" % _backend, _time(lambda: transformer.transform(_html)))
+        )
+        results.append(
+            (
+                "%s: preview" % _backend,
+                _time(lambda: transformer_preview.transform(_html)),
+            )
+        )
+    _report("preview: %s characters" % len(_html), results)
+
+
+def bench_parallel():
+    """
+    Compares rendering a very large document with ``transform`` against
+    ``transform_parallel``, which renders runs of blocks in a process pool.
+    The pool is started by the first round and reused by the next ones, so
+    the best time does not include starting it.
+    """
+    _html = _chapter_document()
+    _processes = multiprocessing.cpu_count()
+    results = []
+    for (_label, _kwargs) in (
+        ("inline links", {}),
+        (
+            "reference links",
+            {"a_as_tag": False, "a_simple_links": False, "reference_style_link": True},
+        ),
+    ):
+        with Transformer(**_kwargs) as transformer:
+            results.append(
+                ("transform: %s" % _label, _time(lambda: transformer.transform(_html)))
+            )
+            results.append(
+                (
+                    "parallel x %s: %s" % (_processes, _label),
+                    _time(lambda: transformer.transform_parallel(_html)),
+                )
+            )
+    _report("parallel: %s characters" % len(_html), results)
+
+
+def bench_cache():
+    """
+    Compares rendering a crawl of pages that share their boilerplate with and
+    without ``block_cache``, which renders the repeated blocks once. The
+    cache is warm after the first round.
+    """
+    documents = _boilerplate_documents()
+    results = []
+    for _backend in ("html5lib", "html.parser"):
+        transformer = Transformer(backend=_backend)
+        transformer_cached = Transformer(backend=_backend, block_cache=1000)
+
+        def _run(transformer):
+            for _html in documents:
+                transformer.transform(_html)
+
+        results.append(("%s: transform" % _backend, _time(lambda: _run(transformer))))
+        results.append(
+            ("%s: block_cache" % _backend, _time(lambda: _run(transformer_cached)))
+        )
+    _report("cache: %s documents" % len(documents), results)
+
+
+def bench_incremental():
+    """
+    Compares re-converting a large document after a one-paragraph edit with
+    ``transform`` against an ``IncrementalTransform``, which only renders the
+    runs of blocks that changed. Both still parse the entire document.
+    """
+    _html = _chapter_document(sections=1000)
+    _edits = [
+        _html.replace("section %s," % i, "section <b>%s</b>," % i)
+        for i in range(ROUNDS)
+    ]
+    results = []
+    for _backend in ("html5lib", "html.parser"):
+        transformer = Transformer(backend=_backend)
+        incremental = transformer.incremental()
+        incremental.transform(_html)
+        _versions = list(_edits)
+        results.append(
+            ("%s: transform" % _backend, _time(lambda: transformer.transform(_html)))
+        )
+        results.append(
+            (
+                "%s: incremental" % _backend,
+                _time(lambda: incremental.transform(_versions.pop())),
+            )
+        )
+    _report("incremental: %s characters" % len(_html), results)
+
+
+def bench_coalesce():
+    """
+    Renders prose in which the text is split by dropped `span` and `font`
+    tags, against the same prose without them. ``to_markdown`` coalesces the
+    split text into a single token before processing it; the ratio of tokens
+    that were merged away is reported.
+
+    "render" times only ``to_markdown`` and the serializer on pre-tokenized
+    html, as parsing dominates the "transform" timings.
+    """
+    _paragraphs = 500
+    results = []
+    for (_label, _spans) in (("spans", True), ("plain", False)):
+        _html = _span_heavy_document(paragraphs=_paragraphs, spans=_spans)
+        transformer = Transformer(backend="html5lib-tokenizer")
+        _options = transformer._markdown_options()
+        _tokens = list(transformer._tokenize(_html))
+        _copies = [copy_tokens(_tokens) for _i in range(ROUNDS)]
+        results.append(
+            (
+                "render: %s" % _label,
+                _time(lambda: transformer._render(_copies.pop(), _options)),
+            )
+        )
+        (_coalesced, _merged) = coalesce_text_tokens(
+            _tokens, tag_names_kept, tags_sensitive=tag_names_coalesce_sensitive
+        )
+        print(
+            "%s: %s tokens, %s merged (%.1f%%)"
+            % (_label, len(_tokens), _merged, 100.0 * _merged / len(_tokens))
+        )
+    _report("coalesce: %s paragraphs" % _paragraphs, results)
+
+
+def bench_tokens():
+    """
+    A micro-benchmark of the per-token overhead of ``to_markdown``: renders
+    pre-tokenized documents, without parsing or serializing them, and reports
+    the time per token. The "blockquotes" document nests every block within
+    blockquotes, so each token is stamped with its blockquote depth.
+    """
+    _chapter = _chapter_document()
+    documents = (
+        ("chapter", _chapter),
+        ("document mix", "\n".join(_load_documents())),
+        ("blockquotes", "<blockquote>" * 3 + _chapter + "</blockquote>" * 3),
+    )
+    transformer = Transformer(backend="html5lib-tokenizer")
+    _options = transformer._markdown_options()
+    results = []
+    for (_label, _html) in documents:
+        _tokens = list(transformer._tokenize(_html))
+        _copies = [copy_tokens(_tokens) for _i in range(ROUNDS)]
+        _seconds = _time(lambda: to_markdown(_copies.pop(), **_options))
+        results.append(
+            (
+                "%s: %.2fus/token" % (_label, _seconds * 1000000 / len(_tokens)),
+                _seconds,
+            )
+        )
+    _report("tokens: to_markdown", results)
+
+
+def bench_compiled():
+    """
+    Reports which modules are compiled by the optional mypyc build, then
+    times the helpers of ``html5lib_to_markdown.utils`` against a pure Python
+    copy loaded from its source. Compare ``to_markdown`` between the two builds
+    with the "tokens" suite.
+    """
+    for _module_name in ("tokens", "transformer", "utils"):
+        print(
+            "html5lib_to_markdown.%s: %s"
+            % (
+                _module_name,
+                "compiled"
+                if _is_compiled("html5lib_to_markdown.%s" % _module_name)
+                else "pure python",
+            )
+        )
+    if not _is_compiled("html5lib_to_markdown.utils"):
+        print("build with `MD_MYPYC=1` to compare the compiled helpers")
+        return
+    from importlib.util import module_from_spec
+    from importlib.util import spec_from_file_location
+
+    _spec = spec_from_file_location(
+        "_utils_pure",
+        os.path.join(_dir_base, "src", "html5lib_to_markdown", "utils.py"),
+    )
+    utils_pure = module_from_spec(_spec)
+    _spec.loader.exec_module(utils_pure)
+    transformer = Transformer(backend="html5lib-tokenizer")
+    _tokens = list(transformer._tokenize(_chapter_document()))
+    results = []
+    for (_label, _normalize, _coalesce, _split) in (
+        ("compiled", normalize_characters, coalesce_text_tokens, split_blocks),
+        (
+            "pure python",
+            utils_pure.normalize_characters,
+            utils_pure.coalesce_text_tokens,
+            utils_pure.split_blocks,
+        ),
+    ):
+
+        def _helpers():
+            _normalize(_tokens)
+            _coalesce(
+                _tokens, tag_names_kept, tags_sensitive=tag_names_coalesce_sensitive
+            )
+            _split(_tokens)
+
+        results.append(("utils: %s" % _label, _time(_helpers)))
+    _report("compiled: %s tokens" % len(_tokens), results)
+
+
+# a new interpreter prints the seconds spent importing the package, building a
+# ``Transformer`` and converting a document; then converting it again
+_STARTUP_SCRIPT = """
+import sys
+import timeit
+_start = timeit.default_timer()
+import html5lib_to_markdown
+_imported = timeit.default_timer()
+if sys.argv[2] == "prewarm":
+    html5lib_to_markdown.prewarm()
+_warmed = timeit.default_timer()
+_transformer = html5lib_to_markdown.transformer.Transformer()
+_transformer.transform(sys.argv[1])
+_first = timeit.default_timer()
+_transformer.transform(sys.argv[1])
+_second = timeit.default_timer()
+print(_imported - _start, _warmed - _imported, _first - _warmed, _second - _first)
+"""
+
+
+def bench_startup():
+    """
+    Times the startup of a new interpreter, as on every CLI invocation or cold
+    serverless start: importing the package, which defers importing html5lib,
+    and the latency of the first conversion, which imports it. "prewarm" calls
+    ``prewarm`` after the import, as the parent of a prefork server would; the
+    first conversion of its workers is then as fast as the second.
+    """
+    _html = _load_documents()[0]
+    _env = dict(os.environ)
+    _env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(html5lib_to_markdown.__file__))]
+        + [_path for _path in (_env.get("PYTHONPATH"),) if _path]
+    )
+    results = []
+    for _mode in ("cold", "prewarm"):
+        _timings = []
+        for _i in range(ROUNDS):
+            _output = subprocess.check_output(
+                [sys.executable, "-c", _STARTUP_SCRIPT, _html, _mode], env=_env
+            )
+            _timings.append([float(_t) for _t in _output.split()])
+        (_import, _prewarm, _first, _second) = [min(_t) for _t in zip(*_timings)]
+        results.append(("%s: import" % _mode, _import))
+        if _mode == "prewarm":
+            results.append(("%s: prewarm" % _mode, _prewarm))
+        results.append(("%s: first conversion" % _mode, _first))
+        results.append(("%s: second conversion" % _mode, _second))
+    _report("startup: %s rounds" % ROUNDS, results)
+
+
+# ------------------------------------------------------------------------------
+
+
+SUITES = {
+    "attributes": bench_attributes,
+    "backends": bench_backends,
+    "cache": bench_cache,
+    "coalesce": bench_coalesce,
+    "compiled": bench_compiled,
+    "incremental": bench_incremental,
+    "parallel": bench_parallel,
+    "preview": bench_preview,
+    "prune": bench_prune,
+    "startup": bench_startup,
+    "tokens": bench_tokens,
+    "variants": bench_variants,
+}
+
+
+def main(argv):
+    suites = argv[1:] or sorted(SUITES.keys())
+    for _suite in suites:
+        if _suite not in SUITES:
+            raise ValueError("unknown suite: %s" % _suite)
+        SUITES[_suite]()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
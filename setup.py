@@ -24,6 +24,20 @@ install_requires = [
     "six",
 ]
 tests_require = []
+
+# `export MD_MYPYC=1` compiles `tokens`, `transformer` and `utils` with mypyc
+# (`pip install mypy`). the pure Python modules are installed either way, and
+# are imported whenever the compiled extensions are missing
+ext_modules = []
+if os.getenv("MD_MYPYC") == "1":
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(
+        [
+            os.path.join("src", "html5lib_to_markdown", _module)
+            for _module in ("tokens.py", "transformer.py", "utils.py")
+        ]
+    )
 testing_extras = (
     install_requires
     + tests_require
@@ -50,6 +64,7 @@ setup(
     package_dir={"": "src"},
     include_package_data=True,
     install_requires=install_requires,
+    ext_modules=ext_modules,
     tests_require=tests_require,
     extras_require={
         "testing": testing_extras,
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+from .transformer import prewarm  # noqa: F401
 from .transformer import Transformer
 
 # ==============================================================================
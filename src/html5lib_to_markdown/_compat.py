@@ -1,4 +1,30 @@
+# stdlib
+import os
+import sys
+
 # pypi
 from six import PY2
 from six import string_types
 from six import text_type
+from six import unichr
+from six.moves import html_parser
+from six.moves.html_entities import name2codepoint
+
+
+# ==============================================================================
+
+
+ENGINE_LEGACY = "legacy"
+ENGINE_PY3 = "py3"
+
+# the hot helpers which depend on the version of Python are in an engine module,
+# chosen here; `export MD_ENGINE=legacy` forces the Python 2 engine, so both
+# engines can be tested on Python 3
+if (sys.version_info >= (3, 7)) and (os.getenv("MD_ENGINE") != ENGINE_LEGACY):
+    from . import _engine3 as engine  # noqa: E402, F401
+
+    ENGINE = ENGINE_PY3
+else:
+    from . import _engine as engine  # type: ignore[no-redef]  # noqa: E402, F401
+
+    ENGINE = ENGINE_LEGACY
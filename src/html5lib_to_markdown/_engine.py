@@ -0,0 +1,126 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+The helpers on the hot paths whose implementation depends on the version of
+Python: they build or read attribute dicts, check for text, and format the
+Markdown of links and images.
+
+This is the engine for Python 2, and for Python 3 before 3.7, in which dicts
+do not keep their insertion order; ``_engine3`` is the engine for Python 3.7+.
+``_compat.engine`` is the one this interpreter uses.
+"""
+
+# stdlib
+from collections import OrderedDict
+
+# pypi
+from six import PY2
+from six import string_types
+
+
+# ==============================================================================
+
+
+# the type of the attribute dicts of a token
+Attributes = OrderedDict
+
+# the types of text in the data of a token; other data is an attribute dict
+text_types = string_types
+
+
+# ------------------------------------------------------------------------------
+
+
+def attributes_from_parser(attrs):
+    """
+    returns the attributes of a tag, keyed by `(namespace, name)`, from the
+    `(name, value)` pairs of ``html.parser``
+    """
+    attributes = OrderedDict()
+    for (_name, _value) in attrs:
+        _key = (None, _name)
+        # html5 keeps the first occurrence of a duplicate attribute
+        if _key not in attributes:
+            attributes[_key] = "" if _value is None else _value
+    return attributes
+
+
+def attributes_from_tokenizer(data):
+    """
+    returns the attributes of a tag, keyed by `(namespace, name)`, from the
+    `data` of a html5lib tokenizer token
+    """
+    return OrderedDict(((None, _k), _v) for (_k, _v) in data.items())
+
+
+def attributes_href(href):
+    """returns the attributes of an `a` tag which links to `href`"""
+    return OrderedDict([((None, "href"), href)])
+
+
+def bare_link_url(name, data):
+    """
+    returns the url of a bare link, such as ``<https://example.com/path>``,
+    which html5lib parses into a tag named for the scheme (`https:`) with an
+    attribute for each component of the path
+    """
+    _path_components = list(data.items())
+    if len(_path_components) == 1:
+        _path = _path_components
+    else:
+        # !!!: this bit is weird.
+        if PY2:
+            _path = [_path_components[1], _path_components[0]]
+            if len(_path_components) > 2:
+                _path.extend(_path_components[2:])
+        else:
+            _path = _path_components
+    _url = "%s//%s" % (name, "/".join(i[0][1] for i in _path))
+    if _path[-1][1]:
+        _url += "=" + _path[-1][1]
+    return _url
+
+
+def markdown_link(text, href, title, reference):
+    """
+    returns the Markdown of a link; a reference-style link if `reference` is
+    not ``None``. `title` must already be escaped.
+    """
+    if reference is not None:
+        return "[%s][%s]" % (text, reference)
+    if title:
+        return '[%s](%s "%s")' % (text, href, title)
+    return "[%s](%s)" % (text, href)
+
+
+def markdown_image(alt, src, title, reference):
+    """
+    returns the Markdown of an image; a reference-style image if `reference`
+    is not ``None``
+    """
+    if reference is not None:
+        return "[%s][%s]" % (alt, reference)
+    if title:
+        return '![%s](%s "%s")' % (alt, src, title)
+    return "![%s](%s)" % (alt, src)
+
+
+def markdown_reference(reference, href, title):
+    """returns the Markdown of a reference in the footer"""
+    if title:
+        return '[%s]: %s "%s"' % (reference, href, title)
+    return "[%s]: %s" % (reference, href)
+
+
+def lru_get(cache, key):
+    """
+    returns ``cache[key]`` from an ``OrderedDict``, and marks it as the most
+    recently used item
+
+    :raises KeyError: if `key` is not in `cache`
+    """
+    # python2's `OrderedDict` has no `move_to_end`
+    _value = cache.pop(key)
+    cache[key] = _value
+    return _value
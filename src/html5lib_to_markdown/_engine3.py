@@ -0,0 +1,104 @@
+"""
+The helpers on the hot paths whose implementation depends on the version of
+Python: they build or read attribute dicts, check for text, and format the
+Markdown of links and images.
+
+This is the engine for Python 3.7+, in which dicts keep their insertion order,
+so attributes are plain dicts, text is only ever `str`, and Markdown is
+formatted with f-strings. This module uses Python 3 syntax, and is never
+imported by Python 2; ``_engine`` is the engine for older versions.
+``_compat.engine`` is the one this interpreter uses.
+"""
+
+# ==============================================================================
+
+
+# the type of the attribute dicts of a token
+Attributes = dict
+
+# the types of text in the data of a token; other data is an attribute dict
+text_types = str
+
+
+# ------------------------------------------------------------------------------
+
+
+def attributes_from_parser(attrs):
+    """
+    returns the attributes of a tag, keyed by `(namespace, name)`, from the
+    `(name, value)` pairs of ``html.parser``
+    """
+    attributes = {}
+    _setdefault = attributes.setdefault
+    for (_name, _value) in attrs:
+        # html5 keeps the first occurrence of a duplicate attribute
+        _setdefault((None, _name), "" if _value is None else _value)
+    return attributes
+
+
+def attributes_from_tokenizer(data):
+    """
+    returns the attributes of a tag, keyed by `(namespace, name)`, from the
+    `data` of a html5lib tokenizer token
+    """
+    return {(None, _k): _v for (_k, _v) in data.items()}
+
+
+def attributes_href(href):
+    """returns the attributes of an `a` tag which links to `href`"""
+    return {(None, "href"): href}
+
+
+def bare_link_url(name, data):
+    """
+    returns the url of a bare link, such as ``<https://example.com/path>``,
+    which html5lib parses into a tag named for the scheme (`https:`) with an
+    attribute for each component of the path
+    """
+    _path = list(data.items())
+    _url = f"{name}//{'/'.join(i[0][1] for i in _path)}"
+    if _path[-1][1]:
+        return f"{_url}={_path[-1][1]}"
+    return _url
+
+
+def markdown_link(text, href, title, reference):
+    """
+    returns the Markdown of a link; a reference-style link if `reference` is
+    not ``None``. `title` must already be escaped.
+    """
+    if reference is not None:
+        return f"[{text}][{reference}]"
+    if title:
+        return f'[{text}]({href} "{title}")'
+    return f"[{text}]({href})"
+
+
+def markdown_image(alt, src, title, reference):
+    """
+    returns the Markdown of an image; a reference-style image if `reference`
+    is not ``None``
+    """
+    if reference is not None:
+        return f"[{alt}][{reference}]"
+    if title:
+        return f'![{alt}]({src} "{title}")'
+    return f"![{alt}]({src})"
+
+
+def markdown_reference(reference, href, title):
+    """returns the Markdown of a reference in the footer"""
+    if title:
+        return f'[{reference}]: {href} "{title}"'
+    return f"[{reference}]: {href}"
+
+
+def lru_get(cache, key):
+    """
+    returns ``cache[key]`` from an ``OrderedDict``, and marks it as the most
+    recently used item
+
+    :raises KeyError: if `key` is not in `cache`
+    """
+    cache.move_to_end(key)
+    return cache[key]
@@ -45,6 +45,13 @@ MARKDOWN_TAGS_ATTRIBUTES = {
     "img": ["src", "title", "alt", "height", "width"],
 }
 
+# a suggested value for the `prune_tags` option; these subtrees rarely contain
+# content that should be rendered
+MARKDOWN_TAGS_PRUNE = ["script", "style", "noscript", "svg", "template", "iframe"]
+
+# a suggested value for the `allowed_protocols` option, like `bleach`
+MARKDOWN_PROTOCOLS = ["http", "https", "mailto"]
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -54,4 +61,6 @@ __all__ = (
     "MARKDOWN_TAGS_PASSTHROUGH",
     "MARKDOWN_TAGS_PASSTHROUGH_BLOCKS",
     "MARKDOWN_TAGS_ATTRIBUTES",
+    "MARKDOWN_PROTOCOLS",
+    "MARKDOWN_TAGS_PRUNE",
 )
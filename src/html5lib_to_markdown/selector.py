@@ -0,0 +1,238 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+This file contains a minimal css selector engine, which selects a subtree from
+a stream of html5lib walker tokens.
+
+Only a simple subset of css is supported:
+
+* type selectors: ``article``, ``*``
+* id selectors: ``#content``
+* class selectors: ``.post``
+* attribute selectors: ``[role]``, ``[role=main]``, ``[role="main"]``
+* compound selectors: ``div#content.post[role=main]``
+* the descendant (``div p``) and child (``div > p``) combinators
+
+Like ``document.querySelector``, only the first matching element is selected.
+"""
+
+# stdlib
+import re
+
+
+# ==============================================================================
+
+
+RE_selector_token = re.compile(
+    r"""
+    \s*(?P<child>>)\s*
+    | (?P<descendant>\s+)
+    | (?P<name>\*|[a-zA-Z][\w-]*)
+    | \#(?P<id>[\w-]+)
+    | \.(?P<class>[\w-]+)
+    | \[\s*(?P<attribute>[\w:-]+)\s*
+        (?:=\s*(?P<value>"[^"]*"|'[^']*'|[^\]\s"']+)\s*)?
+      \]
+    """,
+    re.X | re.U,
+)
+
+COMBINATOR_CHILD = ">"
+COMBINATOR_DESCENDANT = " "
+
+
+# ------------------------------------------------------------------------------
+
+
+def _attribute(attributes, name):
+    """
+    returns the value of the attribute `name` in a token's `data`, which is
+    keyed by `(namespace, name)`; or ``None``
+    """
+    for (_key, _value) in attributes.items():
+        if _key[1] == name:
+            return _value
+    return None
+
+
+class _Compound(object):
+    """
+    a compound selector, such as ``div#content.post``
+    """
+
+    name = None
+    ids = None
+    classes = None
+    attributes = None
+
+    def __init__(self):
+        self.ids = []
+        self.classes = []
+        self.attributes = []
+
+    def matches(self, name, attributes):
+        if (self.name is not None) and (self.name != name):
+            return False
+        for _id in self.ids:
+            if _attribute(attributes, "id") != _id:
+                return False
+        if self.classes:
+            _classes = (_attribute(attributes, "class") or "").split()
+            for _class in self.classes:
+                if _class not in _classes:
+                    return False
+        for (_name, _value) in self.attributes:
+            _actual = _attribute(attributes, _name)
+            if _actual is None:
+                return False
+            if (_value is not None) and (_actual != _value):
+                return False
+        return True
+
+
+class Selector(object):
+    """
+    ``Selector`` compiles a css selector; see the module docstring for the
+    supported subset.
+
+    :raises ValueError: if the selector is empty or not supported
+    """
+
+    selector = None
+    _compounds = None
+    _combinators = None
+
+    def __init__(self, selector):
+        self.selector = selector
+        # `_combinators[i]` joins `_compounds[i - 1]` and `_compounds[i]`
+        self._compounds = []
+        self._combinators = []
+        _compound = None
+        _combinator = None
+        _pos = 0
+        _selector = selector.strip()
+        while _pos < len(_selector):
+            _match = RE_selector_token.match(_selector, _pos)
+            if (_match is None) or (_match.end() == _pos):
+                raise ValueError("unsupported selector: %s" % selector)
+            _pos = _match.end()
+            if _match.group("child") or _match.group("descendant"):
+                if (_compound is None) or (_combinator is not None):
+                    raise ValueError("unsupported selector: %s" % selector)
+                _combinator = (
+                    COMBINATOR_CHILD if _match.group("child") else COMBINATOR_DESCENDANT
+                )
+                _compound = None
+                continue
+            if _compound is None:
+                _compound = _Compound()
+                self._compounds.append(_compound)
+                self._combinators.append(_combinator)
+                _combinator = None
+            if _match.group("name"):
+                if (
+                    (_compound.name is not None)
+                    or _compound.ids
+                    or _compound.classes
+                    or _compound.attributes
+                ):
+                    raise ValueError("unsupported selector: %s" % selector)
+                if _match.group("name") != "*":
+                    _compound.name = _match.group("name").lower()
+            elif _match.group("id"):
+                _compound.ids.append(_match.group("id"))
+            elif _match.group("class"):
+                _compound.classes.append(_match.group("class"))
+            else:
+                _value = _match.group("value")
+                if _value and (_value[0] in ("'", '"')):
+                    _value = _value[1:-1]
+                _compound.attributes.append((_match.group("attribute"), _value))
+        if (not self._compounds) or (_combinator is not None):
+            raise ValueError("unsupported selector: %s" % selector)
+
+    def _matches_ancestors(self, idx_compound, ancestors, idx_ancestor):
+        """
+        does `_compounds[idx_compound]` (and every compound before it) match
+        the ancestors before `idx_ancestor`?
+        """
+        if idx_compound < 0:
+            return True
+        _compound = self._compounds[idx_compound]
+        if self._combinators[idx_compound + 1] == COMBINATOR_CHILD:
+            _idx = idx_ancestor - 1
+            return (
+                (_idx >= 0)
+                and _compound.matches(*ancestors[_idx])
+                and self._matches_ancestors(idx_compound - 1, ancestors, _idx)
+            )
+        for _idx in range(idx_ancestor - 1, -1, -1):
+            if _compound.matches(*ancestors[_idx]) and self._matches_ancestors(
+                idx_compound - 1, ancestors, _idx
+            ):
+                return True
+        return False
+
+    def matches(self, name, attributes, ancestors):
+        """
+        does the element match?
+
+        :arg string name: the element's tag
+        :arg dict attributes: the element's attributes, keyed by
+        `(namespace, name)`
+        :arg list ancestors: a list of `(name, attributes)` for each open
+        element, outermost first
+        """
+        if not self._compounds[-1].matches(name, attributes):
+            return False
+        return self._matches_ancestors(
+            len(self._compounds) - 2, ancestors, len(ancestors)
+        )
+
+
+def select_tokens(tokens, selector):
+    """
+    Yields the tokens of the first element that matches `selector`, including
+    the element's own tags. Nothing is yielded if no element matches.
+
+    :arg tokens: an iterable of balanced walker tokens
+
+    :arg selector: a css selector string, or a ``Selector``
+    """
+    if not isinstance(selector, Selector):
+        selector = Selector(selector)
+    _ancestors = []
+    _depth = 0
+    for token in tokens:
+        _type = token["type"]
+        if _depth:
+            yield token
+            if _type == "StartTag":
+                _depth += 1
+            elif _type == "EndTag":
+                _depth -= 1
+                if not _depth:
+                    return
+        elif _type == "StartTag":
+            _element = (token["name"], token["data"])
+            if selector.matches(token["name"], token["data"], _ancestors):
+                yield token
+                _depth = 1
+            else:
+                _ancestors.append(_element)
+        elif _type == "EndTag":
+            _ancestors.pop()
+        elif _type == "EmptyTag":
+            if selector.matches(token["name"], token["data"], _ancestors):
+                yield token
+                return
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+__all__ = (
+    "Selector",
+    "select_tokens",
+)
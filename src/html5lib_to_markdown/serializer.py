@@ -0,0 +1,69 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+This file contains the serializer which renders the tokens of ``to_markdown``.
+
+html5lib's ``HTMLSerializer`` does the serializing. Importing html5lib is most
+of the cost of importing this package, so it is imported by the first
+``MarkdownSerializer``, not by this module.
+"""
+
+
+# ==============================================================================
+
+
+class MarkdownSerializer(object):
+    """
+    renders the tokens of ``to_markdown`` with html5lib's ``HTMLSerializer``.
+    The ``HTMLSerializer`` options are accepted as keyword arguments, or as
+    class attributes of a subclass.
+    """
+
+    _html_serializer = None
+
+    def __init__(self, **kwargs):
+        from html5lib.serializer import HTMLSerializer
+
+        for _option in HTMLSerializer.options:
+            if hasattr(self, _option):
+                kwargs.setdefault(_option, getattr(self, _option))
+        self._html_serializer = HTMLSerializer(**kwargs)
+
+    def serialize(self, domtree, encoding=None):
+        """
+        If the token starts with a newline, there may be prefixes.
+        Our tokens are designed so prefixing only happens on the newline elements,
+        so this should not normal affect text elements
+
+        ``MarkdownSerializer`` unescapes the blockquote characters in markdown
+        text from "&gt;" to ">", producing valid Markdown but invalid HTML.
+        """
+        for (idx, token) in enumerate(
+            self._html_serializer.serialize(domtree, encoding)
+        ):
+            if token.startswith("\n") or (idx == 0):
+                # html5lib encoded the leading '>' to '&gt'; we need to encode it back.
+                # the most accurate way so far, is to split the token on a space char, and only transform the 0 element.
+                # we may have a 'newlines=2' object, so try that.
+                _token = token.split(" ")
+                _token[0] = _token[0].replace("&gt;", ">")
+                if len(_token) >= 2:
+                    if _token[1].startswith("\n&gt;"):
+                        _token[1] = _token[1].replace("&gt;", ">")
+                token = " ".join(_token)
+            yield token
+
+    def render(self, domtree, encoding=None):
+        """
+        serializes `domtree` into a string, like ``HTMLSerializer.render``
+        """
+        if encoding:
+            return b"".join(list(self.serialize(domtree, encoding)))
+        return "".join(list(self.serialize(domtree)))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+__all__ = ("MarkdownSerializer",)
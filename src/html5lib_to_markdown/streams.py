@@ -0,0 +1,494 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+This file contains token streams that do not require a html5lib tree.
+
+``to_markdown`` consumes the tokens generated by a html5lib tree walker.
+Tokens are just Python dicts:
+
+    {"type": "StartTag", "name": "p", "namespace": "...", "data": OrderedDict()}
+    {"type": "EndTag", "name": "p", "namespace": "..."}
+    {"type": "EmptyTag", "name": "img", "namespace": "...", "data": OrderedDict()}
+    {"type": "Characters", "data": "text"}
+    {"type": "SpaceCharacters", "data": "\n"}
+    {"type": "Comment", "data": "text"}
+
+The attributes in ``data`` are keyed by ``(namespace, name)``.
+
+``TokenStream`` receives parser events and emits the same tokens a html5lib
+walker would emit for the equivalent tree. It performs a small subset of the
+html5 tree-construction fixups (implied end tags, void elements, stray end
+tags) so well-formed and mostly-well-formed documents nest correctly.
+
+It is NOT a spec-compliant parser; untrusted or badly malformed documents
+should be processed with the default html5lib backend.
+
+``TokenStream`` can be driven by:
+
+* ``StdlibTokenizer`` - the stdlib ``html.parser``
+* ``html5lib_tokens`` - the html5lib tokenizer, which tokenizes exactly like
+  the html5lib parser but skips building (and then walking) a tree
+"""
+
+# local
+from ._compat import engine
+from ._compat import html_parser
+from ._compat import name2codepoint
+from ._compat import PY2
+from ._compat import unichr
+
+
+# ==============================================================================
+
+
+NAMESPACE_HTML = "http://www.w3.org/1999/xhtml"
+
+# a copy of `html5lib.constants.tokenTypes`. importing anything from html5lib
+# imports its parser, tree builders, tree walkers and serializer, so html5lib is
+# only imported once it is used
+tokenTypes = {
+    "Doctype": 0,
+    "Characters": 1,
+    "SpaceCharacters": 2,
+    "StartTag": 3,
+    "EndTag": 4,
+    "EmptyTag": 5,
+    "Comment": 6,
+    "ParseError": 7,
+}
+
+tt_Characters = tokenTypes["Characters"]
+tt_SpaceCharacters = tokenTypes["SpaceCharacters"]
+tt_StartTag = tokenTypes["StartTag"]
+tt_EndTag = tokenTypes["EndTag"]
+tt_Comment = tokenTypes["Comment"]
+
+# ``StdlibTokenizer.iter_tokens`` feeds ``html.parser`` this many characters
+# at a time
+CHUNK_SIZE = 8192
+
+# `html5lib.constants.spaceCharacters`
+SPACE_CHARACTERS = "\t\n\x0c \r"
+
+# `html5lib.constants.voidElements`
+VOID_ELEMENTS = frozenset(
+    (
+        "area",
+        "base",
+        "br",
+        "col",
+        "command",
+        "embed",
+        "event-source",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "param",
+        "source",
+        "track",
+    )
+)
+
+# a StartTag for one of these elements closes an open `p`
+CLOSES_P = frozenset(
+    (
+        "address",
+        "article",
+        "aside",
+        "blockquote",
+        "center",
+        "details",
+        "dialog",
+        "dir",
+        "div",
+        "dl",
+        "fieldset",
+        "figcaption",
+        "figure",
+        "footer",
+        "form",
+        "h1",
+        "h2",
+        "h3",
+        "h4",
+        "h5",
+        "h6",
+        "header",
+        "hgroup",
+        "hr",
+        "listing",
+        "main",
+        "menu",
+        "nav",
+        "ol",
+        "p",
+        "pre",
+        "section",
+        "summary",
+        "table",
+        "ul",
+    )
+)
+
+HEADINGS = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+
+# these elements drop a newline immediately after their StartTag
+DROPS_LEADING_NEWLINE = frozenset(("pre", "listing", "textarea"))
+
+# a `li` StartTag closes an open `li` unless one of these is closer
+LIST_SCOPE = frozenset(("ul", "ol"))
+
+# the html5lib tree-construction stage switches the tokenizer into these states
+# after these StartTags, so their content is not tokenized as markup
+TOKENIZER_STATES = {
+    "iframe": "rawtextState",
+    "noembed": "rawtextState",
+    "noframes": "rawtextState",
+    "plaintext": "plaintextState",
+    "script": "scriptDataState",
+    "style": "rawtextState",
+    "textarea": "rcdataState",
+    "title": "rcdataState",
+    "xmp": "rawtextState",
+}
+
+# `html5lib.constants.formattingElements`
+# if one of these is open when a `p` is implicitly closed, it is reopened
+# within the element that closed the `p`
+FORMATTING_ELEMENTS = frozenset(
+    (
+        "a",
+        "b",
+        "big",
+        "code",
+        "em",
+        "font",
+        "i",
+        "nobr",
+        "s",
+        "small",
+        "strike",
+        "strong",
+        "tt",
+        "u",
+    )
+)
+
+
+# ------------------------------------------------------------------------------
+
+
+def text_tokens(data):
+    """
+    Generates SpaceCharacters and Characters tokens for a run of text,
+    exactly like ``html5lib.treewalkers.base.TreeWalker.text``.
+    """
+    middle = data.lstrip(SPACE_CHARACTERS)
+    left = data[: len(data) - len(middle)]
+    if left:
+        yield {"type": "SpaceCharacters", "data": left}
+    data = middle
+    middle = data.rstrip(SPACE_CHARACTERS)
+    _len_middle = len(middle)
+    right = data[_len_middle:]
+    if middle:
+        yield {"type": "Characters", "data": middle}
+    if right:
+        yield {"type": "SpaceCharacters", "data": right}
+
+
+class TokenStream(object):
+    """
+    ``TokenStream`` collects parser events into a list of html5lib walker tokens.
+
+    Text is buffered until the next non-text event, so adjacent text events
+    become a single text node -- just like the html5lib tree builders.
+    """
+
+    tokens = None
+    _open = None
+    _open_attributes = None
+    _text = None
+    _drop_newline = None
+
+    def __init__(self):
+        self.tokens = []
+        self._open = []
+        self._open_attributes = []
+        self._text = []
+        self._drop_newline = False
+
+    def _flush_text(self):
+        if not self._text:
+            return
+        data = "".join(self._text)
+        self._text = []
+        if "\r" in data:
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
+        if "\x00" in data:
+            # html5 drops NULL characters in body content
+            data = data.replace("\x00", "")
+        if self._drop_newline:
+            self._drop_newline = False
+            if data.startswith("\n"):
+                data = data[1:]
+        self.tokens.extend(text_tokens(data))
+
+    def _close_until(self, name):
+        """
+        closes every open element up to and including `name`
+        returns a list of the formatting elements that were implicitly closed
+        """
+        tokens = self.tokens
+        _open = self._open
+        _open_attributes = self._open_attributes
+        _formatting = []
+        while _open:
+            _name = _open.pop()
+            _attributes = _open_attributes.pop()
+            tokens.append(
+                {"type": "EndTag", "name": _name, "namespace": NAMESPACE_HTML}
+            )
+            if _name == name:
+                break
+            if _name in FORMATTING_ELEMENTS:
+                _formatting.append((_name, _attributes))
+        return _formatting
+
+    def _push(self, name, attributes):
+        self._open.append(name)
+        self._open_attributes.append(attributes)
+        self.tokens.append(
+            {
+                "type": "StartTag",
+                "name": name,
+                "namespace": NAMESPACE_HTML,
+                "data": attributes,
+            }
+        )
+
+    def start_tag(self, name, attributes):
+        self._flush_text()
+        self._drop_newline = False
+        _open = self._open
+        _formatting = None
+        if _open:
+            if (name in CLOSES_P) and ("p" in _open):
+                _formatting = self._close_until("p")
+            if (name in HEADINGS) and (_open and _open[-1] in HEADINGS):
+                self._close_until(_open[-1])
+            elif name == "li":
+                for _name in reversed(_open):
+                    if _name == "li":
+                        self._close_until("li")
+                        break
+                    if _name in LIST_SCOPE:
+                        break
+            elif (name == "a") and ("a" in _open):
+                # html5 closes an open `a`; links can not be nested
+                self._close_until("a")
+            elif (name == "tr") and (_open[-1] == "table"):
+                # html5 inserts the implied `tbody`
+                self._push("tbody", engine.Attributes())
+        if name in VOID_ELEMENTS:
+            self.tokens.append(
+                {
+                    "type": "EmptyTag",
+                    "name": name,
+                    "namespace": NAMESPACE_HTML,
+                    "data": attributes,
+                }
+            )
+        else:
+            self._push(name, attributes)
+        if _formatting:
+            # html5 reconstructs the active formatting elements
+            for (_name, _attributes) in reversed(_formatting):
+                self._push(_name, _attributes.copy())
+        if name in DROPS_LEADING_NEWLINE:
+            self._drop_newline = True
+
+    def end_tag(self, name):
+        self._flush_text()
+        self._drop_newline = False
+        if name in self._open:
+            self._close_until(name)
+        elif name == "br":
+            # html5 treats `</br>` as `<br>`
+            self.start_tag(name, engine.Attributes())
+        elif name == "p":
+            # html5 treats a stray `</p>` as `<p></p>`
+            self._push(name, engine.Attributes())
+            self._close_until(name)
+        # otherwise this is a stray end tag, which html5 ignores
+
+    def characters(self, data):
+        if data:
+            self._text.append(data)
+
+    def comment(self, data):
+        self._flush_text()
+        self.tokens.append({"type": "Comment", "data": data})
+
+    def close(self):
+        self._flush_text()
+        while self._open:
+            self._close_until(self._open[-1])
+        return self.tokens
+
+    def drain(self):
+        """
+        returns the tokens emitted so far, and removes them from the stream.
+        this allows the tokens to be consumed while the text is being parsed.
+        """
+        tokens = self.tokens
+        self.tokens = []
+        return tokens
+
+
+class StdlibTokenizer(html_parser.HTMLParser, object):
+    """
+    ``StdlibTokenizer`` drives a ``TokenStream`` with the stdlib ``html.parser``.
+
+    This is several times faster than building a html5lib tree, but is only
+    suitable for trusted, well-formed input.
+    """
+
+    _stream = None
+
+    def __init__(self):
+        if PY2:
+            html_parser.HTMLParser.__init__(self)
+        else:
+            html_parser.HTMLParser.__init__(self, convert_charrefs=True)
+        self._stream = TokenStream()
+
+    def handle_starttag(self, tag, attrs):
+        self._stream.start_tag(tag, engine.attributes_from_parser(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        # html5 ignores the self-closing flag on non-void elements
+        self._stream.start_tag(tag, engine.attributes_from_parser(attrs))
+
+    def handle_endtag(self, tag):
+        self._stream.end_tag(tag)
+
+    def handle_data(self, data):
+        self._stream.characters(data)
+
+    def handle_entityref(self, name):
+        # only invoked under Python2, which lacks `convert_charrefs`
+        if name in name2codepoint:
+            self._stream.characters(unichr(name2codepoint[name]))
+        else:
+            self._stream.characters("&%s" % name)
+
+    def handle_charref(self, name):
+        # only invoked under Python2, which lacks `convert_charrefs`
+        try:
+            if name[0] in ("x", "X"):
+                _codepoint = int(name[1:], 16)
+            else:
+                _codepoint = int(name)
+            self._stream.characters(unichr(_codepoint))
+        except (ValueError, OverflowError):
+            self._stream.characters("&#%s" % name)
+
+    def handle_comment(self, data):
+        self._stream.comment(data)
+
+    def handle_pi(self, data):
+        # html5 parses processing instructions as bogus comments
+        self._stream.comment("?%s" % data)
+
+    def unknown_decl(self, data):
+        # html5 parses CDATA sections in html content as bogus comments
+        self._stream.comment("[%s]]" % data)
+
+    def handle_decl(self, decl):
+        # a doctype is ignored in a fragment
+        pass
+
+    def tokenize(self, text):
+        """
+        parses `text` and returns a list of html5lib walker tokens
+        """
+        self.feed(text)
+        self.close()
+        return self._stream.close()
+
+    def iter_tokens(self, text, chunk_size=CHUNK_SIZE):
+        """
+        parses `text` in chunks of `chunk_size` characters, and yields the
+        html5lib walker tokens of each chunk before the next one is parsed.
+        ``html.parser`` buffers incomplete markup across chunks, so the tokens
+        are identical to ``tokenize``.
+        """
+        _stream = self._stream
+        for _pos in range(0, len(text), chunk_size):
+            _end = _pos + chunk_size
+            self.feed(text[_pos:_end])
+            for token in _stream.drain():
+                yield token
+        self.close()
+        for token in _stream.close():
+            yield token
+
+
+def stdlib_tokens(text):
+    """
+    Tokenizes `text` with the stdlib ``html.parser`` and generates html5lib
+    walker tokens, suitable for ``to_markdown``.
+
+    The text is parsed lazily, as the tokens are consumed.
+    """
+    return StdlibTokenizer().iter_tokens(text)
+
+
+def html5lib_tokens(text):
+    """
+    Tokenizes `text` with the html5lib tokenizer and generates html5lib
+    walker tokens, suitable for ``to_markdown``.
+
+    No tree is built; the tokenizer's output is fed directly into a
+    ``TokenStream``, which performs the minimal tree-construction fixups.
+    The text is tokenized lazily, as the tokens are consumed.
+    """
+    from html5lib._tokenizer import HTMLTokenizer
+
+    stream = TokenStream()
+    tokenizer = HTMLTokenizer(text)
+    for token in tokenizer:
+        ttype = token["type"]
+        if (ttype == tt_Characters) or (ttype == tt_SpaceCharacters):
+            stream.characters(token["data"])
+        elif ttype == tt_StartTag:
+            name = token["name"]
+            stream.start_tag(name, engine.attributes_from_tokenizer(token["data"]))
+            if name in TOKENIZER_STATES:
+                tokenizer.state = getattr(tokenizer, TOKENIZER_STATES[name])
+        elif ttype == tt_EndTag:
+            stream.end_tag(token["name"])
+        elif ttype == tt_Comment:
+            stream.comment(token["data"])
+        # Doctype and ParseError tokens are ignored
+        if stream.tokens:
+            for _token in stream.drain():
+                yield _token
+    for _token in stream.close():
+        yield _token
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+__all__ = (
+    "StdlibTokenizer",
+    "TokenStream",
+    "html5lib_tokens",
+    "stdlib_tokens",
+    "text_tokens",
+)
@@ -49,12 +49,18 @@ currently these tags are considered block elements:
 """
 
 # stdlib
-from collections import OrderedDict
 import os
 
 # local
+from ._compat import engine
 from .utils import safe_title
 
+# the type comments are only read by mypy; `typing` is not in Python 2
+MYPY = False
+if MYPY:  # pragma: no cover
+    from typing import Any  # noqa: F401
+    from typing import Dict  # noqa: F401
+
 
 # ==============================================================================
 
@@ -94,11 +100,14 @@ mdTokenTypes = {
     "TokenStartCode": 24,
     "TokenStrong": 25,
     "TokenTab": 26,
-}
+}  # type: Dict[str, Any]
 if DEBUG_TOKENS:
     for k in list(mdTokenTypes.keys()):
         mdTokenTypes[k] = k
 
+# the name of each `_md_type`, for debugging
+mdTokenNames = dict((v, k) for (k, v) in mdTokenTypes.items())
+
 # ==============================================================================
 
 
@@ -107,15 +116,9 @@ def TokenAEndTag(href):
 
 
 def TokenAMarkdown(href, _link_text, title=None, reference=None):
-    title = safe_title(title)
-    title = ' "%s"' % title if title else ""
-    if reference is not None:
-        data = "[%s][%s]" % (_link_text, reference)
-    else:
-        data = "[%s](%s%s)" % (_link_text, href, title)
     token = {
         "type": "Characters",
-        "data": data,
+        "data": engine.markdown_link(_link_text, href, safe_title(title), reference),
         "_md_type": mdTokenTypes["TokenAMarkdown"],
     }
     return token
@@ -128,12 +131,9 @@ def TokenAMarkdownReference(href, reference, title=None):
 
     <a href="https://example.com" title="Title">link text</a>
     """
-    title = ' "%s"' % title if title else ""
-    data = "[%s]: %s%s" % (reference, href, title)
-
     token = {
         "type": "Characters",
-        "data": data,
+        "data": engine.markdown_reference(reference, href, title),
         "_md_type": mdTokenTypes["TokenAMarkdownReference"],
     }
     return token
@@ -156,7 +156,7 @@ def TokenAStartTag(href):
     return {
         "type": "StartTag",
         "name": "a",
-        "data": OrderedDict([((None, "href"), href)]),
+        "data": engine.attributes_href(href),
     }
 
 
@@ -214,12 +214,13 @@ def TokenEndBlockElement(block):
     """
     `TokenEndBlockElement` is used to denote that we are ending a block element.
     Under most circumstances, this token will not render anything.
+    `block` names the element, but is not stored; ``to_markdown(debug=True)``
+    records the tag each token was processed from as `_md_debug`.
     """
     return {
         "type": "SpaceCharacters",
         "data": "",
         "_md_type": mdTokenTypes["TokenEndBlockElement"],
-        "_md_debug": block,
     }
 
 
@@ -267,15 +268,9 @@ def TokenHR():
 
 
 def TokenImgMarkdown(src, alt=None, title=None, reference=None):
-    alt = alt or "Image"
-    title = ' "%s"' % title if title else ""
-    if reference is not None:
-        data = "[%s][%s]" % (alt, reference)
-    else:
-        data = "![%s](%s%s)" % (alt, src, title)
     token = {
         "type": "Characters",
-        "data": data,
+        "data": engine.markdown_image(alt or "Image", src, title, reference),
         "_md_type": mdTokenTypes["TokenImgMarkdown"],
     }
     return token
@@ -338,12 +333,13 @@ def TokenStartBlockElement(block):
     """
     `TokenStartBlockElement` is used to denote that we are starting a new block element.
     Under most circumstances, this token will not render anything.
+    `block` names the element, but is not stored; ``to_markdown(debug=True)``
+    records the tag each token was processed from as `_md_debug`.
     """
     return {
         "type": "SpaceCharacters",
         "data": "",
         "_md_type": mdTokenTypes["TokenStartBlockElement"],
-        "_md_block": block,
     }
 
 
@@ -396,6 +392,7 @@ def TokenTab():
 
 
 __all__ = (
+    "mdTokenNames",
     "mdTokenTypes",
     "TokenAEndTag",
     "TokenAMarkdown",
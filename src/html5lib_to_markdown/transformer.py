@@ -9,30 +9,35 @@ from __future__ import unicode_literals
 """
 
 # stdlib
+from array import array
+from collections import OrderedDict
 import logging
 import os
-
-# pypi
-from html5lib import getTreeBuilder
-from html5lib import getTreeWalker
-from html5lib import HTMLParser
-from html5lib.constants import tokenTypes
-from html5lib.serializer import HTMLSerializer
+import re
 
 # local
-from ._compat import PY2
+from ._compat import engine
 from ._compat import string_types
 from ._compat import text_type
 from .markdown_info import MARKDOWN_TAGS_ATTRIBUTES
 from .markdown_info import MARKDOWN_TAGS_CORE
 from .markdown_info import MARKDOWN_TAGS_PASSTHROUGH
 from .markdown_info import MARKDOWN_TAGS_PASSTHROUGH_BLOCKS
+from .selector import select_tokens
+from .serializer import MarkdownSerializer
+from .streams import html5lib_tokens
+from .streams import stdlib_tokens
+from .streams import text_tokens
+from .streams import tokenTypes
+from .tokens import DEBUG_TOKENS
+from .tokens import mdTokenNames
 from .tokens import mdTokenTypes
 from .tokens import TokenAEndTag
 from .tokens import TokenAMarkdown
 from .tokens import TokenAMarkdownReference
 from .tokens import TokenAMarkdownSimple
 from .tokens import TokenAStartTag
+from .tokens import TokenCharactersAdded
 from .tokens import TokenCharactersSplit
 from .tokens import TokenEmphasis
 from .tokens import TokenEndBlockElement
@@ -50,13 +55,36 @@ from .tokens import TokenStartBlockElement
 from .tokens import TokenStartBlockquote
 from .tokens import TokenStartCode
 from .tokens import TokenStrong
+from .trees import detect_treebuilder
+from .trees import document_body
+from .trees import prune_tokens
+from .trees import prune_tree
+from .trees import TREEBUILDER_ETREE
+from .trees import TREEBUILDERS
+from .trees import unwrap_fragment
+from .trees import walk_tree
 from .utils import clean_token_attributes
+from .utils import coalesce_text_tokens
+from .utils import compile_allowed_attributes
+from .utils import compile_allowed_tags
+from .utils import copy_tokens
+from .utils import fingerprint_tokens
+from .utils import FragmentReader
 from .utils import is_list_upcoming
-from .utils import RE_newlines_3p
+from .utils import is_url_allowed
+from .utils import normalize_characters
+from .utils import RE_markup_or_normalizable
 from .utils import RE_space_tab_only
-from .utils import RE_space_tab_p
-from .utils import RE_whitespace_meh
+from .utils import RE_trailing_whitespace
 from .utils import safe_title
+from .utils import split_blocks
+from .utils import truncate_tokens
+
+# the type comments are only read by mypy; `typing` is not in Python 2
+MYPY = False
+if MYPY:  # pragma: no cover
+    from typing import Any  # noqa: F401
+    from typing import Optional  # noqa: F401
 
 
 # ==============================================================================
@@ -68,12 +96,40 @@ DEBUG_STACKS_SIMPLE = bool(int(os.getenv("MD_DEBUG_STACKS_SIMPLE", 0)))
 
 # ------------------------------------------------------------------------------
 
+# text is parsed with html5lib's fragment parsing algorithm, in the context of
+# this container element. the container is not part of the parsed fragment, so
+# there is no wrapper element to strip from the tokens
+FRAGMENT_CONTAINER = "div"
+
+# the "etree" tree builder loses the elements which are foster parented out of
+# a `table` by a fragment parse, so with "etree" the text is parsed within this
+# wrapper element instead, which is then removed from the tree.
 # python-markdownify (http://github.com/matthewwithanm/python-markdownify) uses
-# a technique where content is tossed into a div so BeautifulSoup will parse the
-# fragment correctly. the same trick works for html5lib
+# a similar technique for BeautifulSoup
 FRAGMENT_TYPE = "html5libmarkdown"
-FRAGMENT_ID = "__CUSTOM_WRAPPER__"
-wrapped = '<%s id="%s">%%s</%s>' % (FRAGMENT_TYPE, FRAGMENT_ID, FRAGMENT_TYPE)
+wrapped_start = "<%s>" % FRAGMENT_TYPE
+wrapped_end = "</%s>" % FRAGMENT_TYPE
+
+# the parsers a ``Transformer`` can use to tokenize text
+# "html5lib": the spec-compliant html5lib parser; slow, but safe for any input
+# "html5lib-tokenizer": the html5lib tokenizer, without building a tree
+# "html.parser": the stdlib parser; several times faster, for trusted input
+BACKEND_HTML5LIB = "html5lib"
+BACKEND_HTML5LIB_TOKENIZER = "html5lib-tokenizer"
+BACKEND_STDLIB = "html.parser"
+BACKENDS = (BACKEND_HTML5LIB, BACKEND_HTML5LIB_TOKENIZER, BACKEND_STDLIB)
+
+# ``Transformer.transform_parallel`` groups the runs of blocks into this many
+# chunks per process, so a slow chunk does not hold up the entire pool
+PARALLEL_CHUNKS_PER_PROCESS = 4
+
+# reference-style links are rendered with a placeholder number when they are
+# collected by `to_markdown(reference_links=...)`, so they can be renumbered.
+# the parsers drop NULL characters, so these can not appear in the text
+REFERENCE_PLACEHOLDER = "\x00%s\x00"
+RE_reference_placeholder = re.compile(r"\]\[\x00(\d+)\x00\]")
+# rendered in place of the footer by `to_markdown(reference_footer=True)`
+REFERENCE_FOOTER = "\x00\x00"
 
 # There will be a lot of comparisons to the TagType, so cast it to an `int`
 # 1/2: this is our mapping. it is the `html5lib.constants.tokenTypes`
@@ -113,43 +169,68 @@ tt_md_TokenStrong = mdTokenTypes["TokenStrong"]
 tt_md_TokenTab = mdTokenTypes["TokenTab"]
 
 # these are tokens that will be filtered out of the final stack
-_tts_md_filtered = [
-    tt_md_TokenStartBlockElement,
-    tt_md_TokenEndBlockElement,
-    tt_md_TokenStartBlockquote,
-    tt_md_TokenEndBlockquote,
-]
+_tts_md_filtered = frozenset(
+    (
+        tt_md_TokenStartBlockElement,
+        tt_md_TokenEndBlockElement,
+        tt_md_TokenStartBlockquote,
+        tt_md_TokenEndBlockquote,
+    )
+)
 
 # whitespace tokens
-_tts_md_whitespace = [
-    tt_md_TokenSpace,
-    tt_md_TokenTab,
-    tt_md_TokenNewline,
-    tt_md_TokenNewlines,
-    tt_md_TokenNewlineBR,
-]
+_tts_md_whitespace = frozenset(
+    (
+        tt_md_TokenSpace,
+        tt_md_TokenTab,
+        tt_md_TokenNewline,
+        tt_md_TokenNewlines,
+        tt_md_TokenNewlineBR,
+    )
+)
 
-_tts_md_newlines_single = [tt_md_TokenNewline, tt_md_TokenNewlineBR]
+_tts_md_newlines_single = frozenset((tt_md_TokenNewline, tt_md_TokenNewlineBR))
 
-_tts_md_newlines_all = [tt_md_TokenNewline, tt_md_TokenNewlineBR, tt_md_TokenNewlines]
+_tts_md_newlines_all = frozenset(
+    (tt_md_TokenNewline, tt_md_TokenNewlineBR, tt_md_TokenNewlines)
+)
 
-_tts_md_startblocks = [tt_md_TokenStartBlockquote, tt_md_TokenStartBlockElement]
-_tts_md_endblocks = [tt_md_TokenEndBlockquote, tt_md_TokenEndBlockElement]
+_tts_md_startblocks = frozenset(
+    (tt_md_TokenStartBlockquote, tt_md_TokenStartBlockElement)
+)
+_tts_md_endblocks = frozenset((tt_md_TokenEndBlockquote, tt_md_TokenEndBlockElement))
 
-_tts_md_blocksall = _tts_md_startblocks + _tts_md_endblocks
+_tts_md_blocksall = _tts_md_startblocks | _tts_md_endblocks
 
-_tts_md_blockquotes = [tt_md_TokenStartBlockquote, tt_md_TokenEndBlockquote]
+_tts_md_blockquotes = frozenset((tt_md_TokenStartBlockquote, tt_md_TokenEndBlockquote))
 
-_tts_md_newlined_text_start = [tt_md_TokenHR, tt_md_TokenHNStart, tt_md_TokenLiStart]
+_tts_md_newlined_text_start = frozenset(
+    (tt_md_TokenHR, tt_md_TokenHNStart, tt_md_TokenLiStart)
+)
 
-_tts_md_newlined_text_end = [tt_md_TokenHR]
+_tts_md_newlined_text_end = frozenset((tt_md_TokenHR,))
 
-_tts_md_code = [tt_md_TokenStartCode, tt_md_TokenEndCode]
+_tts_md_code = frozenset((tt_md_TokenStartCode, tt_md_TokenEndCode))
 
 # these tags will render contents as-is
 tag_names_sensitive__block = ("pre", "script")  # as a block
 tag_names_sensitive__inline = ("code",)  # inline
 tag_names_sensitive = tag_names_sensitive__block + tag_names_sensitive__inline
+tag_names_core = frozenset(MARKDOWN_TAGS_CORE)
+# the tags which `to_markdown` does not drop, with the `allowed_tags`; text
+# is not coalesced within the sensitive tags, or `style`, which may be stripped
+tag_names_coalesce_sensitive = frozenset(tag_names_sensitive + ("style",))
+tag_names_kept = tag_names_core | tag_names_coalesce_sensitive
+
+
+# the options of `to_markdown` which `prepare_tokens` depends on
+OPTIONS_PREPARE = ("allowed_tags", "strip_comments")
+
+# a document may be split between these top-level blocks, to be rendered in
+# parallel; `div` and the pass-through blocks depend on the options
+tag_names_split = frozenset(
+    ("h1", "h2", "h3", "h4", "h5", "h6", "ol", "p", "pre", "ul")
+)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -219,7 +300,7 @@ def _stack__print_simple(stack):
     for idx, i in enumerate(stack):
         print(
             "%04d" % idx,
-            "%22s" % i.get("_md_type"),
+            "%22s" % mdTokenNames.get(i.get("_md_type"), ""),
             "%15s" % i.get("type"),
             ("%5s" % i.get("name", ""))[:5],
             "bq-%4s" % i.get("_md_bq", ""),
@@ -238,6 +319,25 @@ def _stack__print_full(stack):
     print("----------------")
 
 
+def _debug_process_token(process_token_idx, tokens):
+    """
+    wraps the token processor of ``to_markdown(debug=True)``, so each token it
+    returns records the tag (or type) of the token it was processed from as
+    `_md_debug`. This is not invoked unless debugging.
+    """
+
+    def wrapper(token_idx):
+        results = process_token_idx(token_idx)
+        if results:
+            _source = tokens[token_idx].get("name") or tokens[token_idx]["type"]
+            for _result in results if isinstance(results, tuple) else (results,):
+                if isinstance(_result, dict) and ("_md_debug" not in _result):
+                    _result["_md_debug"] = _source
+        return results
+
+    return wrapper
+
+
 def _stack__print(stack, stack_name="debug"):
     """debugging tool"""
     print("----------------")
@@ -250,73 +350,155 @@ def _stack__print(stack, stack_name="debug"):
     print("----------------")
 
 
+def _md_types_array(values=()):
+    """
+    returns an array of `_md_type` values, in which ``0`` is ``None``. The
+    types are bytes, unless `MD_DEBUG_TOKENS` named them (see ``tokens``).
+    """
+    if DEBUG_TOKENS:
+        return list(values)
+    return array("B", values)
+
+
+def _stack__arrays(stack):
+    """
+    returns the `_md_type` and `_md_bq` (blockquote depth) of each token in
+    `stack` as compact arrays for the post-processor, in which ``0`` is
+    ``None``. A ``0`` sentinel is appended to each array, so the neighbors of
+    every token can be read without a bounds check.
+    """
+    _types = _md_types_array([_token.get("_md_type") or 0 for _token in stack])
+    _types.append(0)
+    _bqs = array("H", [_token.get("_md_bq") or 0 for _token in stack])
+    _bqs.append(0)
+    return (_types, _bqs)
+
+
+def _stack__pop(stack, stack_types, stack_bqs):
+    """pops the last token off a post-processed stack and its arrays"""
+    stack_types.pop()
+    stack_bqs.pop()
+    return stack.pop()
+
+
+def _pending__build(md_type, blockquoted, codeblocked):
+    """builds the newline token of a pending separator"""
+    return _contextual_TokenNewlines(
+        newlines=2 if (md_type == tt_md_TokenNewlines) else 1,
+        blockquoted=blockquoted or None,
+        codeblocked=codeblocked,
+    )
+
+
+def _pending__token(pending, idx):
+    """
+    returns the token of the pending separator `pending[idx]`, which is only
+    built once it is needed
+
+    each separator is a tuple of `(md_type, blockquote, codeblock, token)`, in
+    which `token` is ``None`` until it is built by ``_pending__build``
+    """
+    (_md_type, _blockquoted, _codeblocked, _token) = pending[idx]
+    if _token is None:
+        _token = _pending__build(_md_type, _blockquoted, _codeblocked)
+        pending[idx] = (_md_type, _blockquoted, _codeblocked, _token)
+    return _token
+
+
+def _pending__flush(pending, stack, stack_types, stack_bqs):
+    """appends the pending separators to a post-processed stack"""
+    for (_md_type, _blockquoted, _codeblocked, _token) in pending:
+        if _token is None:
+            _token = _pending__build(_md_type, _blockquoted, _codeblocked)
+        stack.append(_token)
+        stack_types.append(_md_type)
+        stack_bqs.append(_blockquoted)
+    del pending[:]
+
+
+def _pending__last_type(pending, stack_types):
+    """
+    returns the `_md_type` of the last token of a post-processed stack and its
+    pending separators, or ``None``
+    """
+    if pending:
+        return pending[-1][0]
+    return stack_types[-1] if stack_types else None
+
+
 def cleanup_space_backwards(
-    stack, newlines_ensure=0, newline_blockquote=None, newline_codeblock=None, dbg=False
+    pending,
+    stack,
+    stack_types,
+    stack_bqs,
+    newlines_ensure=0,
+    newline_blockquote=0,
+    newline_codeblock=None,
 ):
     """
-    this functions rewinds a stack of tags to pop newline elements off the top
+    this functions rewinds the whitespace at the end of a post-processed stack,
+    and ensures it ends with `newlines_ensure` newlines
+
+    `stack_types` and `stack_bqs` are the `_md_type` and `_md_bq` of each token
+    in `stack`. The newlines are not added to `stack`, but to the `pending`
+    separators after it (see ``_pending__token``), which are only built into
+    tokens when the next token is added; so consecutive block boundaries
+    build a single newline token.
     """
-    _discarded = None  # an iteration of this function inspected this token
-    newline_prefix = (newline_blockquote,)
     while True:
-        _lt = stack__last_token(stack)
-        if _lt:
-            _md_type = _lt.get("_md_type")
-            if _md_type in _tts_md_whitespace:
-                if _md_type in _tts_md_newlines_all:
-                    _lt_blockquoted = _lt.get("_md_bq")
-                    _lt_codeblocked = _lt.get("_md_cb")
-                    _lt_prefix = (_lt_blockquoted,)
-                    if newline_prefix != _lt_prefix:
-                        newlines_ensure = 1
-                        if _md_type == tt_md_TokenNewlines:
-                            _discarded = stack.pop()
-                            _lt2 = stack__last_token(stack)
-                            if (
-                                _lt2
-                                and _lt2.get("_md_type") in _tts_md_newlined_text_end
-                            ):
-                                newlines_ensure = 0
-                                _tok = _contextual_TokenNewlines(
-                                    newlines=2,
-                                    blockquoted=_lt_blockquoted,
-                                    codeblocked=_lt_codeblocked,
-                                )
-                            else:
-                                _tok = _contextual_TokenNewlines(
-                                    newlines=1,
-                                    blockquoted=_lt_blockquoted,
-                                    codeblocked=_lt_codeblocked,
-                                )
-                            stack.append(_tok)
-                        break
-                _discarded = stack.pop()  # noqa: F841
-            else:
-                break
+        if pending:
+            _md_type = pending[-1][0]
+            _lt_blockquoted = pending[-1][1]
+        elif stack_types and (stack_types[-1] in _tts_md_whitespace):
+            _md_type = stack_types[-1]
+            _lt_blockquoted = stack_bqs[-1]
         else:
             break
+        if (_md_type in _tts_md_newlines_all) and (
+            newline_blockquote != _lt_blockquoted
+        ):
+            newlines_ensure = 1
+            if _md_type == tt_md_TokenNewlines:
+                if pending:
+                    _lt_codeblocked = pending.pop()[2]
+                else:
+                    _lt_codeblocked = _stack__pop(stack, stack_types, stack_bqs).get(
+                        "_md_cb"
+                    )
+                if _pending__last_type(pending, stack_types) in (
+                    _tts_md_newlined_text_end
+                ):
+                    newlines_ensure = 0
+                    _md_type = tt_md_TokenNewlines
+                else:
+                    _md_type = tt_md_TokenNewline
+                pending.append((_md_type, _lt_blockquoted, _lt_codeblocked, None))
+            break
+        if pending:
+            pending.pop()
+        else:
+            _stack__pop(stack, stack_types, stack_bqs)
 
     if newlines_ensure:
         # wait, is the last item a HR?
-        _lt = stack__last_token(stack)
-        if not _lt:
-            newlines_ensure -= 1
-        elif _lt and (_lt.get("_md_type") in _tts_md_newlined_text_end):
+        _lt_md_type = _pending__last_type(pending, stack_types)
+        if (_lt_md_type is None) or (_lt_md_type in _tts_md_newlined_text_end):
             newlines_ensure -= 1
 
         if newlines_ensure:
-            _blockquoted = newline_blockquote
-            _codeblocked = newline_codeblock
-            _tok = _contextual_TokenNewlines(
-                newlines_ensure, blockquoted=_blockquoted, codeblocked=_codeblocked
+            pending.append(
+                (
+                    tt_md_TokenNewlines
+                    if (newlines_ensure == 2)
+                    else tt_md_TokenNewline,
+                    newline_blockquote,
+                    newline_codeblock,
+                    None,
+                )
             )
-            stack.append(_tok)
 
-    # stack.extend(_discards)
-    return stack
 
-
-def _render_code_as_block_backwards(stack_post):
+def _render_code_as_block_backwards(stack_post, stack_post_types):
     """
     Given a post-processed stack `stack_post`, iterate backwards looking for tokens
     that will let us know if we are in a new block or not
@@ -324,8 +506,7 @@ def _render_code_as_block_backwards(stack_post):
     idx = len(stack_post)
     while idx >= 1:
         idx -= 1
-        tok = stack_post[idx]
-        tok_mdtype = tok.get("_md_type")
+        tok_mdtype = stack_post_types[idx]
         if not tok_mdtype:
             # likely `Characters` or a tag
             return False
@@ -334,23 +515,23 @@ def _render_code_as_block_backwards(stack_post):
         elif tok_mdtype == tt_md_TokenStartBlockElement:
             return True
         elif tok_mdtype == tt_md_TokenStartBlockNative:
+            tok = stack_post[idx]
             if tok.get("name") == "pre":
                 tok["_md_code_compress"] = 1
                 return True
     return True
 
 
-def _render_code_as_block_frontwards(stack, idx):
+def _render_code_as_block_frontwards(stack, stack_types, idx):
     """
     given a stack the postprocesser is currently looking at, iterate forwards
     looking for a token that indicates our codelblock type
     """
     maxlen = len(stack)
     _endcode_seen = False
-    while idx <= maxlen:
+    while idx < maxlen - 1:
         idx += 1
-        tok = stack[idx]
-        tok_mdtype = tok.get("_md_type")
+        tok_mdtype = stack_types[idx]
         if not _endcode_seen:
             if tok_mdtype == tt_md_TokenEndCode:
                 _endcode_seen = True
@@ -363,12 +544,53 @@ def _render_code_as_block_frontwards(stack, idx):
         elif tok_mdtype == tt_md_TokenEndBlockElement:
             return True
         elif tok_mdtype == tt_md_TokenEndBlockNative:
+            tok = stack[idx]
             if tok.get("name") == "pre":
                 tok["_md_code_compress"] = 1
                 return True
     return True
 
 
+def prepare_tokens(dom_walker, allowed_tags=None, strip_comments=False):
+    """
+    runs the stages of ``to_markdown`` which do not depend on how the tokens
+    are rendered, so several renderings can share them: the text which is split
+    by dropped tags is merged into a single token, and the whitespace of all
+    the text is normalized. `allowed_tags` and `strip_comments` decide which
+    tags are dropped, so they must match those of the ``to_markdown``.
+
+    :returns: a `(tokens, coalesced, characters, characters_block)` tuple for
+    the `prepared` argument of ``to_markdown``, which alters it; render a
+    ``copy_prepared`` of it to render it more than once
+    """
+    allowed_tags = compile_allowed_tags(
+        MARKDOWN_TAGS_PASSTHROUGH if allowed_tags is None else allowed_tags
+    )
+
+    # an early version of this used a generator to iterate over tokens
+    # however...
+    # searching forwards and backwards was needed, so iterating over them is used
+    list_walker = [i for i in dom_walker]
+
+    # text which is split by dropped tags is merged into a single token
+    (list_walker, _coalesced) = coalesce_text_tokens(
+        list_walker,
+        tag_names_kept | allowed_tags,
+        tags_sensitive=tag_names_coalesce_sensitive,
+        strip_comments=strip_comments,
+    )
+
+    # the whitespace of all the text is normalized up front, in a single pass
+    (_characters, _characters_block) = normalize_characters(list_walker)
+    return (list_walker, _coalesced, _characters, _characters_block)
+
+
+def copy_prepared(prepared):
+    """copies the result of ``prepare_tokens``, so it can be rendered again"""
+    (tokens, coalesced, characters, characters_block) = prepared
+    return (copy_tokens(tokens), coalesced, list(characters), list(characters_block))
+
+
 def to_markdown(
     dom_walker,
     a_as_tag=True,
@@ -389,6 +611,14 @@ def to_markdown(
     character_unordered_listitem=None,
     pre_behavior=None,
     is_fragment=None,
+    allowed_protocols=None,
+    allowed_styles=None,
+    strip_styles=False,
+    reference_links=None,
+    reference_footer=False,
+    debug=None,
+    stats=None,
+    prepared=None,
 ):
     """
     translate a html5lib iterable tree to markdown
@@ -437,7 +667,9 @@ def to_markdown(
 
     :arg dict allowed_tags_attributes:  keys are tags, values are a list of
     attributes for that tag. default is ``None``, which will invoke
-    ``markdown_info.MARKDOWN_TAGS_ATTRIBUTES``.
+    ``markdown_info.MARKDOWN_TAGS_ATTRIBUTES``. Like ``bleach``, a value may
+    instead be a callable which accepts the arguments `(tag, attribute, value)`
+    and returns ``True`` if the attribute should be kept.
 
     :arg string character_italic: What character should be the default for italic text.
     Markdown supports an asterisk "*" or underscores "_"; and will render 1 of this character. Default: "_"
@@ -456,17 +688,63 @@ def to_markdown(
     option 1: non-code "pre" becomes markdown "code"
     option 2: non-code "pre" becomes a paragraph
 
-    :arg bool is_fragment: is this being processed as a fragment? if so, we
-    should pop out the container.
+    :arg bool is_fragment: deprecated and ignored. Fragments were once parsed
+    within a wrapper element, which had to be stripped from the tokens.
+
+    :arg list allowed_protocols: list of protocols allowed in the `href` and
+    `src` attributes and in Markdown links and images, such as
+    ``markdown_info.MARKDOWN_PROTOCOLS``. Relative urls are always allowed.
+    A disallowed attribute is removed; a Markdown link is rendered as its text
+    and a Markdown image is removed. default is ``None``, which allows any
+    protocol.
+
+    :arg list allowed_styles: list of css properties allowed in a `style`
+    attribute, if the attribute is allowed. default is ``None``, which will
+    not filter the `style` attribute.
+
+    :arg bool strip_styles: Should style tags, and their contents, be stripped?
+    default ``False``, which strips the tags but renders their contents as text.
+
+    :arg list reference_links: if provided, the `(href, title)` of every
+    reference-style link and image is appended to this list instead of being
+    rendered as a footer, and each reference is rendered as
+    ``REFERENCE_PLACEHOLDER % number`` so the caller can renumber it.
+    default ``None``.
+
+    :arg bool reference_footer: if ``True``, ``REFERENCE_FOOTER`` is rendered
+    in place of the footer of collected `reference_links`, even if there are
+    none, so the caller can render the references of several documents as a
+    single footer. default ``False``.
+
+    :arg dict stats: if provided, this is updated with `tokens`, the number of
+    walker tokens; `tokens_coalesced`, the number of text tokens which were
+    merged into the text before them; and `coalesce_ratio`, the ratio of the
+    two. default ``None``.
+
+    :arg bool debug: if ``True``, each processed token records the tag it was
+    processed from as `_md_debug`, whitespace tokens record the rule which
+    standardized them as `_md_whitespace_standardized`, and the raw and
+    processed token stacks are printed. default ``None``, which is ``True``
+    if the `MD_DEBUG_STACKS` environment variable is set. Otherwise, none of
+    this is paid for.
+
+    :arg tuple prepared: the result of ``prepare_tokens`` with the same
+    `allowed_tags` and `strip_comments`, which is rendered instead of
+    `dom_walker`. default ``None``, which prepares `dom_walker`.
     """
     # defaults
-    allowed_tags = MARKDOWN_TAGS_PASSTHROUGH if allowed_tags is None else allowed_tags
-    allowed_tags_blocks = (
+    debug = DEBUG_STACKS if debug is None else debug
+    # the allowlists are tested for every tag, so they are compiled into sets;
+    # a `Transformer` compiles them once, so this will not copy them again
+    allowed_tags = compile_allowed_tags(
+        MARKDOWN_TAGS_PASSTHROUGH if allowed_tags is None else allowed_tags
+    )
+    allowed_tags_blocks = compile_allowed_tags(
         MARKDOWN_TAGS_PASSTHROUGH_BLOCKS
         if allowed_tags_blocks is None
         else allowed_tags_blocks
     )
-    allowed_tags_attributes = (
+    allowed_tags_attributes = compile_allowed_attributes(
         MARKDOWN_TAGS_ATTRIBUTES
         if allowed_tags_attributes is None
         else allowed_tags_attributes
@@ -493,83 +771,73 @@ def to_markdown(
         "codeblock": None,  # True/False
         "_sensitive": 0,  # are we in a sensitive block? (code, pre, script)
         "_strip_script": 0,  # are we in a script? if so, we may be stripping it so this is treated separately
+        "_strip_style": 0,  # are we in a style that is being stripped?
         "list": [],  # depth tracing, should be a list of lists, where main list is depth and inner list is a dict of type+count that we're on
     }
     _referenced_links__order = []
     _referenced_links__data = {}
 
+    def _reference_link(href, title):
+        """returns the 1-based number of the reference for `href`"""
+        try:
+            _reference = _referenced_links__order.index(href) + 1
+        except ValueError:
+            _referenced_links__order.append(href)
+            _referenced_links__data[href] = (title,)
+            _reference = len(_referenced_links__order)
+        if reference_links is not None:
+            return REFERENCE_PLACEHOLDER % _reference
+        return _reference
+
+    def _clean_token_attributes(token, name=None):
+        return clean_token_attributes(
+            token, name, allowed_tags_attributes, allowed_protocols, allowed_styles
+        )
+
     # this will be a list of nodes
     token_stack = []
 
-    # an early version of this used a generator to iterate over tokens
-    # however...
-    # searching forwards and backwards was needed, so iterating over them is used
-    list_walker = [i for i in dom_walker]
+    if prepared is None:
+        prepared = prepare_tokens(dom_walker, allowed_tags, strip_comments)
+    (list_walker, _coalesced, _characters, _characters_block) = prepared
+    if stats is not None:
+        _tokens = len(list_walker) + _coalesced
+        stats["tokens"] = _tokens
+        stats["tokens_coalesced"] = _coalesced
+        stats["coalesce_ratio"] = (float(_coalesced) / _tokens) if _tokens else 0.0
+    if _coalesced:
+        log.debug(
+            "coalesced text tokens: %s of %s merged",
+            _coalesced,
+            len(list_walker) + _coalesced,
+        )
     len_walker = len(list_walker)
 
     def _handle_bare_link(name, token):
         """this logic can be invoked in multiple places"""
-        _path_components = list(token.get("data").items())
-        if len(_path_components) == 1:
-            _path = _path_components
-        else:
-            # !!!: this bit is weird.
-            if PY2:
-                _path = [_path_components[1], _path_components[0]]
-                if len(_path_components) > 2:
-                    _path.extend(_path_components[2:])
-            else:
-                _path = _path_components
-        _url_reconstructed = "%s//%s" % (
-            name,
-            "/".join(i[0][1] for i in _path),
-        )
-        if _path[-1][1]:
-            _url_reconstructed += "=" + _path[-1][1]
+        _url_reconstructed = engine.bare_link_url(name, token.get("data"))
+        if not is_url_allowed(_url_reconstructed, allowed_protocols):
+            return None
 
         if a_simple_links:
             return TokenAMarkdownSimple(_url_reconstructed)
 
         if a_as_tag:
-            return (TokenAStartTag, _url_reconstructed, TokenAEndTag)
+            return (
+                TokenAStartTag(_url_reconstructed),
+                TokenCharactersAdded(_url_reconstructed),
+                TokenAEndTag(_url_reconstructed),
+            )
         return TokenAMarkdown(_url_reconstructed, _url_reconstructed)
 
-    def possibly_nested(func):
-        """
-        This is a decorator used to stash the blockquote depth and prefix into
-        each processed token. This function does not apply the prefix to the
-        token's "data", but updates the token's dict with the prefix information.
-        """
-
-        def wrapper(*args):
-            results = func(*args)
-            if results is None:
-                return None
-            # it is possible to receive a tuple of nodes from the function
-            if not isinstance(results, tuple):
-                results = (results,)
-            rval = []
-            for _result in results:
-                # result could be None
-                if _result:
-                    if _in["blockquote"]:
-                        _result["_md_bq"] = _in["blockquote"]
-                    if _in["codeblock"]:
-                        _result["_md_cb"] = True
-                    rval.append(_result)
-            rval = tuple(rval) if rval else None
-            return rval
-
-        return wrapper
-
-    @possibly_nested
     def _process_token_idx(token_idx):
         """
         ``_process_token_sequence``
         instead of __iter__ we use a `custom_slider_a`
 
         handling of nested blockquotes?
-        instead of recursively calling a function on a tree, use a decorator
+        instead of recursively calling a function on a tree, the caller stamps
+        the blockquote depth and codeblock into each processed token
         """
         token = list_walker[token_idx]
         _token_idx__next = token_idx + 1
@@ -601,6 +869,16 @@ def to_markdown(
                         return None
                 return None
 
+        # are we stripping style tags?
+        if strip_styles:
+            if _in["_strip_style"]:
+                if (name == "style") and (ttype == tt_EndTag):
+                    _in["_strip_style"] = 0
+                return None
+            if (name == "style") and (ttype == tt_StartTag):
+                _in["_strip_style"] = 1
+                return None
+
         # if we are in a sensitive block, check to see if it is eligible to get out of
         if _in["_sensitive"]:
             if name not in tag_names_sensitive:  # ('code', 'pre', 'script', )
@@ -728,9 +1006,7 @@ def to_markdown(
                     _render_tag = True if _render_tag__a() else False
                     if _render_tag:
                         _in["a__tag"] += 1
-                        return clean_token_attributes(
-                            token, "a", allowed_tags_attributes
-                        )
+                        return _clean_token_attributes(token, "a")
                     else:
                         _href = None
                         # _link_text
@@ -740,13 +1016,18 @@ def to_markdown(
                         # grab the next token from
                         if token_next["type"] != "Characters":
                             raise ValueError("DEBUG!!!!! this should never happen!")
-                        _link_text = token_next["data"]
-                        token_next["data"] = ""
                         for _key, _value in token["data"].items():
                             if _key[1] == "href":
                                 _href = _value
                             elif _key[1] == "title":
                                 _title = safe_title(_value)
+                        if not is_url_allowed(_href, allowed_protocols):
+                            # render the link text; the `EndTag` is dropped
+                            return None
+                        _link_text = token_next["data"]
+                        # the link text is rendered here, not as `Characters`
+                        _characters[_token_idx__next] = ""
+                        _characters_block[_token_idx__next] = ""
 
                         if a_simple_links:
                             if (not _link_text or (_link_text == _href)) and (
@@ -755,12 +1036,7 @@ def to_markdown(
                                 return TokenAMarkdownSimple(_href)
 
                         if reference_style_link:
-                            try:
-                                _reference = _referenced_links__order.index(_href)
-                            except ValueError:
-                                _referenced_links__order.append(_href)
-                                _referenced_links__data[_href] = (_title,)
-                                _reference = len(_referenced_links__order)
+                            _reference = _reference_link(_href, _title)
                         return TokenAMarkdown(
                             _href, _link_text, title=_title, reference=_reference
                         )
@@ -772,9 +1048,7 @@ def to_markdown(
                         _in["a__tag"] -= 1
                         _render_tag = True
                     if _render_tag:
-                        return clean_token_attributes(
-                            token, "a", allowed_tags_attributes
-                        )
+                        return _clean_token_attributes(token, "a")
                     else:
                         return None
 
@@ -821,7 +1095,7 @@ def to_markdown(
                             _in["_strip_script"] -= 1
                             return None
                     # continue as normal
-                _token = clean_token_attributes(token, name, allowed_tags_attributes)
+                _token = _clean_token_attributes(token, name)
                 if ttype == tt_StartTag:
                     # _in[name] += 1
                     _in["_sensitive"] += 1
@@ -867,10 +1141,16 @@ def to_markdown(
                         # this is a bare mailto
                         if ttype == tt_StartTag:
                             _address = name
+                            if not is_url_allowed(_address, allowed_protocols):
+                                return None
                             if a_simple_links:
                                 return TokenAMarkdownSimple(_address)
                             if a_as_tag:
-                                return (TokenAStartTag, _address, TokenAEndTag)
+                                return (
+                                    TokenAStartTag(_address),
+                                    TokenCharactersAdded(_address[7:]),
+                                    TokenAEndTag(_address),
+                                )
                             return TokenAMarkdown(_address, _address[7:])
                         else:
                             return None
@@ -878,14 +1158,12 @@ def to_markdown(
                         return None
 
                 # debug:
-                if name == FRAGMENT_TYPE:
-                    return None
-                elif name in MARKDOWN_TAGS_CORE:
+                if name in tag_names_core:
                     # this should have been converted
                     raise ValueError("DEBUG!!!!! this should never happen!", token)
                 elif name in allowed_tags:
                     # sanitize the token
-                    token = clean_token_attributes(token, name, allowed_tags_attributes)
+                    token = _clean_token_attributes(token, name)
                     if name in allowed_tags_blocks:
                         if ttype == tt_StartTag:
                             return (TokenStartBlockElement(name), token)
@@ -905,9 +1183,7 @@ def to_markdown(
             if name == "img":
                 # note: img
                 if img_as_tag:
-                    token = clean_token_attributes(
-                        token, "img", allowed_tags_attributes
-                    )
+                    token = _clean_token_attributes(token, "img")
                     return token
                 else:
                     _href = None
@@ -921,13 +1197,10 @@ def to_markdown(
                             _alt = _value
                         elif _key[1] == "title":
                             _title = safe_title(_value)
+                    if not is_url_allowed(_href, allowed_protocols):
+                        return None
                     if reference_style_img:
-                        try:
-                            _reference = _referenced_links__order.index(_href)
-                        except ValueError:
-                            _referenced_links__order.append(_href)
-                            _referenced_links__data[_href] = (_title,)
-                            _reference = len(_referenced_links__order)
+                        _reference = _reference_link(_href, _title)
 
                     return TokenImgMarkdown(
                         _href, alt=_alt, title=_title, reference=_reference
@@ -960,29 +1233,18 @@ def to_markdown(
                 )
 
             else:
-                return clean_token_attributes(token, None, allowed_tags_attributes)
+                return _clean_token_attributes(token, None)
 
         elif ttype == tt_Characters:
             # note: tokenType Characters
 
-            # dereference this first
-            _data = token["data"]
-
-            # remove extraneous newlines
-            _data = RE_newlines_3p.sub("\n\n", _data)
-
-            # remove extraneous spaces/tabs
-            _data = RE_space_tab_p.sub(" ", _data)
-
-            # drop leading space, but avoid nested lists
-            _data = RE_whitespace_meh.sub("\n", _data)
-
+            # the whitespace was normalized by `normalize_characters`
             if _in["p-div"]:
                 # if we're in a p/div block, then we pretty much ignore whitespace
                 # this is to pull the text out as if we are a browser
-                _data = _data.replace("\n\n", " ")
-                _data = _data.replace("\n", " ")
-                _data = RE_space_tab_p.sub(" ", _data)
+                _data = _characters_block[token_idx]
+            else:
+                _data = _characters[token_idx]
 
             # remove leading/trailing whitespace
             token["data"] = _data.strip()
@@ -1027,7 +1289,7 @@ def to_markdown(
                 elif _last_sig_md in _tts_md_endblocks:
                     # did we just end a block element?  if so, NEWLINES
                     token = TokenNewlines()
-                    if __debug__:
+                    if debug:
                         token["_md_whitespace_standardized"] = 0
                     return token
 
@@ -1036,12 +1298,12 @@ def to_markdown(
             _newlines = None
             if _data == "\n\n":
                 token = TokenNewlines()
-                if __debug__:
+                if debug:
                     token["_md_whitespace_standardized"] = 1
                 _newlines = 2
             elif _data == "\n":
                 token = TokenNewline()
-                if __debug__:
+                if debug:
                     token["_md_whitespace_standardized"] = 2
                 _newlines = 1
             else:
@@ -1051,7 +1313,7 @@ def to_markdown(
                     # if this is only space/tabs, collapse to a single space
                     token = TokenSpace()
                     token["data"] = _data = " "
-                    if __debug__:
+                    if debug:
                         token["_md_whitespace_standardized"] = 3
                     _newlines = 0
                 else:
@@ -1062,12 +1324,12 @@ def to_markdown(
                         raise ValueError("DEBUG!!!! Not sure what to do: %s" % token)
                     if _newlines >= 2:
                         token = TokenNewlines()
-                        if __debug__:
+                        if debug:
                             token["_md_whitespace_standardized"] = 4
                         _newlines = 2
                     elif _newlines == 1:
                         token = TokenNewline()
-                        if __debug__:
+                        if debug:
                             token["_md_whitespace_standardized"] = 5
                         _newlines = 2
 
@@ -1101,7 +1363,7 @@ def to_markdown(
                 if token.get("_md_type") in _tts_md_newlines_all:
                     _dicarded = token_stack.pop()  # noqa: F841
                     token = TokenNewlines()
-                    if __debug__:
+                    if debug:
                         token["_md_whitespace_standardized"] = 6
 
             return token
@@ -1149,27 +1411,42 @@ def to_markdown(
     so we can keep track of the last yielded tag.
     """
 
+    if debug:
+        _process_token_idx = _debug_process_token(_process_token_idx, list_walker)
+
     for idx in range(0, len_walker):
         tokens_converted = _process_token_idx(idx)
         if not tokens_converted:  # faster than checking for `None`
             continue
+        # stash the blockquote depth and codeblock into each processed token;
+        # this does not apply the prefix to the token's "data"
+        _bq = _in["blockquote"]
+        _cb = _in["codeblock"]
         # if we return a tuple, the first element should be a `TokenStartBlockElement`
         if isinstance(tokens_converted, tuple):
-            token_stack.extend(tokens_converted)
+            for _token in tokens_converted:
+                # result could be None
+                if _token:
+                    if _bq:
+                        _token["_md_bq"] = _bq
+                    if _cb:
+                        _token["_md_cb"] = True
+                    token_stack.append(_token)
         else:
+            if _bq:
+                tokens_converted["_md_bq"] = _bq
+            if _cb:
+                tokens_converted["_md_cb"] = True
             token_stack.append(tokens_converted)
 
-    # !!!: STEP 2a- strip the temporary wrapper we added
-    if is_fragment:
-        if token_stack:
-            _tok = token_stack[0]
-            if (_tok.get("name") == FRAGMENT_TYPE) and (
-                _tok.get("data", {}).get((None, "id")) == FRAGMENT_ID
-            ):
-                token_stack = token_stack[1:-1]
-
     # !!!: STEP 3- merge in any link references for img/a
-    if _referenced_links__order:
+    if reference_links is not None:
+        # the caller renders the references
+        reference_links.extend(
+            (_href, _referenced_links__data[_href][0])
+            for _href in _referenced_links__order
+        )
+    if reference_footer or ((reference_links is None) and _referenced_links__order):
         _last_sig = stack__last_token(token_stack)
         if _last_sig:
             _t_md = _last_sig.get("_md_type")
@@ -1179,37 +1456,60 @@ def to_markdown(
                 _discarded = token_stack.pop()
             token_stack.append(TokenNewlines())
             token_stack.append(TokenStartBlockElement("reflinks-start"))
-            for (_idx, _href) in enumerate(_referenced_links__order):
-                _reference = _idx + 1
-                (_title,) = _referenced_links__data[_href]
-                token_stack.append(TokenNewline())
-                tok = TokenAMarkdownReference(_href, _reference, _title)
+            if debug:
+                token_stack[-1]["_md_debug"] = "reflinks-start"
+            if reference_footer:
+                # the caller renders the references in place of the placeholder
+                tok = TokenAMarkdownReference(None, None)
+                tok["data"] = REFERENCE_FOOTER
                 token_stack.append(tok)
+            else:
+                for (_idx, _href) in enumerate(_referenced_links__order):
+                    _reference = _idx + 1
+                    (_title,) = _referenced_links__data[_href]
+                    if _idx:
+                        # the block start ensures the blank line before the first
+                        token_stack.append(TokenNewline())
+                    tok = TokenAMarkdownReference(_href, _reference, _title)
+                    token_stack.append(tok)
             token_stack.append(TokenEndBlockElement("reflinks-end"))
+            if debug:
+                token_stack[-1]["_md_debug"] = "reflinks-end"
 
     # used for debugging
-    if __debug__:
-        if DEBUG_STACKS:
-            _stack__print(token_stack, "raw")
+    if debug:
+        _stack__print(token_stack, "raw")
 
     # !!!: STEP 4- postprocess the tree
     # - goal 1: correct whitespace
     # - goal 2: toggle blockquote
+    # the types and blockquote depths of the tokens are read into arrays once,
+    # so the neighbors of a token are integer lookups instead of dict lookups.
+    # the post-processed stack keeps its own arrays in sync, for the backwards
+    # scans of the code handling.
+    # the newlines between blocks are held back as pending separators (see
+    # `_pending__token`) until the next token is added, so
+    # `cleanup_space_backwards` reconciles them without building tokens
+    (_types, _bqs) = _stack__arrays(token_stack)
     token_stack__post = []
+    _post_types = _md_types_array()
+    _post_bqs = array("H")
+    _post = (token_stack__post, _post_types, _post_bqs)
+    _pending = []
     _last_codeblock = None
     _codeblocked = None
     for (token_idx, token) in enumerate(token_stack):
-        _t_md = token.get("_md_type")
-        _t_md_blockquote = token.get("_md_bq", None)
-        token_prev = token_stack[token_idx - 1] if token_idx else None
-        _t_prev_md = token_prev.get("_md_type") if token_prev else None
-        try:
-            token_next = token_stack[token_idx + 1]
-        except IndexError:
-            token_next = None
-        _t_next_md = token_next.get("_md_type") if token_next else None
+        _t_md = _types[token_idx]
+        _t_md_blockquote = _bqs[token_idx]
+        # the first token reads the sentinel at the end of the arrays
+        _t_prev_md = _types[token_idx - 1]
+        _t_next_md = _types[token_idx + 1]
 
-        if (
+        if not _t_md:
+            # text and html tokens are only prefixed, below
+            pass
+
+        elif (
             _t_md in _tts_md_startblocks
         ):  # (tt_md_TokenStartBlockquote, tt_md_TokenStartBlockElement, )
             # if we're going block-to-block, skip to the next block
@@ -1221,17 +1521,17 @@ def to_markdown(
                 continue
 
             _newlines_ensure = 2
-            _newline_blockquote = _t_md_blockquote if _newlines_ensure else None
+            _newline_blockquote = _t_md_blockquote
             if _t_next_md in _tts_md_newlined_text_start:
                 _newlines_ensure = 1
-                _newline_blockquote = token_next.get("_md_bq") if token_next else None
+                _newline_blockquote = _bqs[token_idx + 1]
 
             # needing a newline is now contingent on our last block...
-            token_stack__post = cleanup_space_backwards(
-                token_stack__post,
+            cleanup_space_backwards(
+                _pending,
+                *_post,
                 newlines_ensure=_newlines_ensure,
                 newline_blockquote=_newline_blockquote,
-                dbg=True,
             )
 
         elif (
@@ -1249,11 +1549,11 @@ def to_markdown(
             if _t_prev_md in _tts_md_newlined_text_end:
                 _newlines_ensure = 1
 
-            _newline_blockquote = _t_md_blockquote if _newlines_ensure else None
-            token_stack__post = cleanup_space_backwards(
-                token_stack__post,
+            cleanup_space_backwards(
+                _pending,
+                *_post,
                 newlines_ensure=_newlines_ensure,
-                newline_blockquote=_newline_blockquote,
+                newline_blockquote=_t_md_blockquote,
             )
             continue
 
@@ -1262,42 +1562,36 @@ def to_markdown(
                 # if the next token is an endblock, ignore this token
                 continue
 
-            _last_sig = stack__last_token(token_stack__post)
-            if _last_sig:
-                _last_sig_md = _last_sig.get("_md_type") if _last_sig else None
-                if _last_sig_md:
-                    # optimize some whitespace here...
-                    if _t_md in _tts_md_newlines_all:
-                        if _last_sig_md in _tts_md_newlines_all:
-                            _discarded = token_stack__post.pop()  # noqa: F841
-                            _tok = _contextual_TokenNewlines(
-                                newlines=2, blockquoted=None, codeblocked=None
-                            )
-                            token_stack__post.append(_tok)
+            _last_sig_md = _pending__last_type(_pending, _post_types)
+            if _last_sig_md:
+                # optimize some whitespace here...
+                if _t_md in _tts_md_newlines_all:
+                    if _last_sig_md in _tts_md_newlines_all:
+                        if _pending:
+                            _pending.pop()
+                        else:
+                            _discarded = _stack__pop(*_post)  # noqa: F841
+                        _pending.append((tt_md_TokenNewlines, 0, None, None))
+                        continue
+                    elif _last_sig_md in _tts_md_newlined_text_end:
+                        if _t_next_md in _tts_md_startblocks:
+                            # if the next token is an startblock, ignore this token; a cleanup will catch it
+                            continue
+                        elif _t_md == tt_md_TokenNewlines:
+                            # replace 2 newlines with 1
+                            _pending.append((tt_md_TokenNewline, 0, None, None))
+                            continue
+                        elif _t_md in _tts_md_newlines_single:
+                            # just ignore this newline
                             continue
-                        elif _last_sig_md in _tts_md_newlined_text_end:
-                            if _t_next_md in _tts_md_startblocks:
-                                # if the next token is an startblock, ignore this token; a cleanup will catch it
-                                continue
-                            elif _t_md == tt_md_TokenNewlines:
-                                # replace 2 newlines with 1
-                                _tok = _contextual_TokenNewlines(
-                                    newlines=1, blockquoted=None, codeblocked=None
-                                )
-                                token_stack__post.append(_tok)
-                                continue
-                            elif _t_md in _tts_md_newlines_single:
-                                # just ignore this newline
-                                continue
 
         elif _t_md == tt_md_TokenStartBlockNative:
             # special case: native blocks MUST be rendered and have newline requirements
-            _newlines_ensure = 2
-            _newline_blockquote = _t_md_blockquote if _newlines_ensure else None
-            token_stack__post = cleanup_space_backwards(
-                token_stack__post,
-                newlines_ensure=_newlines_ensure,
-                newline_blockquote=_newline_blockquote,
+            cleanup_space_backwards(
+                _pending,
+                *_post,
+                newlines_ensure=2,
+                newline_blockquote=_t_md_blockquote,
             )
 
         elif _t_md == tt_md_TokenEndBlockNative:
@@ -1306,49 +1600,57 @@ def to_markdown(
                 continue
 
         elif _t_md == tt_md_TokenHR:
-            _newlines_ensure = 1
-            _newline_blockquote = _t_md_blockquote if _newlines_ensure else None
-            token_stack__post = cleanup_space_backwards(
-                token_stack__post,
-                newlines_ensure=_newlines_ensure,
-                newline_blockquote=_newline_blockquote,
+            cleanup_space_backwards(
+                _pending,
+                *_post,
+                newlines_ensure=1,
+                newline_blockquote=_t_md_blockquote,
             )
 
         elif _t_md in _tts_md_code:
             if _t_md == tt_md_TokenStartCode:
                 if _render_code_as_block_backwards(
-                    token_stack__post
-                ) and _render_code_as_block_frontwards(token_stack, token_idx):
+                    token_stack__post, _post_types
+                ) and _render_code_as_block_frontwards(token_stack, _types, token_idx):
                     # token['type'] = 'Characters'
                     # token['data'] = '{{CODE}}'
                     _last_codeblock = "BLOCK"
                     _codeblocked = 1
                     # this value gets set by our `code` handling
-                    if token_stack__post and token_stack__post[-1].get(
-                        "_md_code_compress"
+                    if (
+                        (not _pending)
+                        and token_stack__post
+                        and token_stack__post[-1].get("_md_code_compress")
                     ):
-                        _discarded_pre = token_stack__post.pop()  # noqa: F841
-                    lt = token_stack__post[-1]
-                    if lt.get("_md_type") in _tts_md_newlines_single:
+                        _discarded_pre = _stack__pop(*_post)  # noqa: F841
+                    _lt_md_type = _pending__last_type(_pending, _post_types)
+                    if _lt_md_type in _tts_md_newlines_single:
                         token_apply_prefix(
-                            lt, blockquote=_t_md_blockquote, codeblock=_codeblocked
+                            _pending__token(_pending, -1)
+                            if _pending
+                            else token_stack__post[-1],
+                            blockquote=_t_md_blockquote,
+                            codeblock=_codeblocked,
                         )
-                    elif lt.get("_md_type") == tt_md_TokenNewlines:
-                        _discarded_lines = token_stack__post.pop()  # noqa: F841
-                        tok = _contextual_TokenNewlines(
-                            newlines=1, blockquoted=_t_md_blockquote, codeblocked=False
+                    elif _lt_md_type == tt_md_TokenNewlines:
+                        if _pending:
+                            _pending.pop()
+                        else:
+                            _discarded_lines = _stack__pop(*_post)  # noqa: F841
+                        _pending.append(
+                            (tt_md_TokenNewline, _t_md_blockquote, False, None)
                         )
-                        token_stack__post.append(tok)
-                        tok = _contextual_TokenNewlines(
-                            newlines=1,
-                            blockquoted=_t_md_blockquote,
-                            codeblocked=_codeblocked,
+                        _pending.append(
+                            (tt_md_TokenNewline, _t_md_blockquote, _codeblocked, None)
                         )
-                        token_stack__post.append(tok)
                     else:
-                        raise ValueError(
-                            "DEBUG!!!! edge. this has never been triggered"
-                        )
+                        # there is no newline before the code to indent it as a
+                        # block, e.g. it starts the document or ends a truncated
+                        # preview; render it inline instead
+                        token["type"] = "Characters"
+                        token["data"] = "`"  # INLINE CODE
+                        _last_codeblock = "INLINE"
+                        _codeblocked = None
                 else:
                     token["type"] = "Characters"
                     token["data"] = "`"  # INLINE CODE
@@ -1369,8 +1671,11 @@ def to_markdown(
         if _t_md not in _tts_md_filtered:
 
             if not _t_md:
-                _last_sig = stack__last_token(token_stack__post)
-                if _last_sig and (_last_sig.get("_md_type") == tt_md_TokenStartCode):
+                if (
+                    (not _pending)
+                    and token_stack__post
+                    and (_post_types[-1] == tt_md_TokenStartCode)
+                ):
                     if token.get("type") == "SpaceCharacters":
                         if token.get("data") in ("\n", "\n\n"):
                             continue
@@ -1381,29 +1686,38 @@ def to_markdown(
                     token, blockquote=_t_md_blockquote, codeblock=_codeblocked
                 )
 
+            if _pending:
+                _pending__flush(_pending, *_post)
             token_stack__post.append(token)
+            _post_types.append(_t_md)
+            _post_bqs.append(_t_md_blockquote)
 
+    _pending__flush(_pending, *_post)
     token_stack = token_stack__post
 
     # step 4b
     # TODO: migrate this situation into the previous loop
     # TODO: probably handled by isolating this into a protected block
-    token_stack__post = []
-    for (token_idx, token) in enumerate(token_stack):
-        _t_md = token.get("_md_type")
-        if _t_md not in (tt_md_TokenHR,):
-            token_stack__post.append(token)
-        else:
-            _bq = token.get("_md_bq")
-            _cb = token.get("_md_cb")
-            t1 = _contextual_TokenNewlines(newlines=1, blockquoted=_bq, codeblocked=_cb)
-            token["data"] = TokenHR()[
-                "data"
-            ].strip()  # replace this with a raw TokenHR's data
-            t3 = _contextual_TokenNewlines(newlines=1, blockquoted=_bq, codeblocked=_cb)
-            token_stack__post.extend([t1, token, t3])
-
-    token_stack = token_stack__post
+    # the type array is scanned in C, so a stack without a HR is not copied
+    if tt_md_TokenHR in _post_types:
+        token_stack__post = []
+        for (token_idx, token) in enumerate(token_stack):
+            if _post_types[token_idx] != tt_md_TokenHR:
+                token_stack__post.append(token)
+            else:
+                _bq = _post_bqs[token_idx] or None
+                _cb = token.get("_md_cb")
+                t1 = _contextual_TokenNewlines(
+                    newlines=1, blockquoted=_bq, codeblocked=_cb
+                )
+                token["data"] = TokenHR()[
+                    "data"
+                ].strip()  # replace this with a raw TokenHR's data
+                t3 = _contextual_TokenNewlines(
+                    newlines=1, blockquoted=_bq, codeblocked=_cb
+                )
+                token_stack__post.extend([t1, token, t3])
+        token_stack = token_stack__post
 
     # !!!: STEP 5- last postprocess
     # a) strip off trailing spaces
@@ -1423,7 +1737,7 @@ def to_markdown(
                     # but if we have a raw img node...
                     #   _lt == OrderedDict([((None, 'src'), '/path/to/src')])
                     # in the case of an OrderedDict, we clean the tag via `clean_token_attributes`
-                    if isinstance(_data, string_types):
+                    if isinstance(_data, engine.text_types):
                         _lt["data"] = _data.rstrip("\n")
                 break
         else:
@@ -1443,74 +1757,136 @@ def to_markdown(
                     # but if we have a raw img node...
                     #   _lt == OrderedDict([((None, 'src'), '/path/to/src')])
                     # in the case of an OrderedDict, we clean the tag via `clean_token_attributes`
-                    if isinstance(_data, string_types):
+                    if isinstance(_data, engine.text_types):
                         _ft["data"] = _data.lstrip("\n")
                 break
         else:
             break
 
-    if __debug__:
-        if DEBUG_STACKS:
-            _stack__print(token_stack, "output")
+    if debug:
+        _stack__print(token_stack, "output")
 
     return token_stack
 
 
-class MarkdownSerializer(HTMLSerializer):
-    def serialize(self, domtree, encoding=None):
-        """
-        If the token starts with a newline, there may be prefixes.
-        Our tokens are designed so prefixing only happens on the newline elements,
-        so this should not normal affect text elements
+def render_run(tokens, first, markdown_options, filters, serializer, footer=False):
+    """
+    renders a run of top-level blocks from ``utils.split_blocks``, for
+    ``Transformer.transform_parallel``
 
-        ``MarkdownSerializer`` unescapes the blockquote characters in markdown
-        text from "&gt;" to ">", producing valid Markdown but invalid HTML.
-        """
-        for (idx, token) in enumerate(
-            super(MarkdownSerializer, self).serialize(domtree, encoding)
-        ):
-            if token.startswith("\n") or (idx == 0):
-                # html5lib encoded the leading '>' to '&gt'; we need to encode it back.
-                # the most accurate way so far, is to split the token on a space char, and only transform the 0 element.
-                # we may have a 'newlines=2' object, so try that.
-                _token = token.split(" ")
-                _token[0] = _token[0].replace("&gt;", ">")
-                if len(_token) >= 2:
-                    if _token[1].startswith("\n&gt;"):
-                        _token[1] = _token[1].replace("&gt;", ">")
-                token = " ".join(_token)
-            yield token
+    :arg list tokens: the run's walker tokens
+
+    :arg bool first: is this the first run of the document?
+
+    :arg bool footer: should ``REFERENCE_FOOTER`` be rendered after the run?
+    see ``Transformer._stitch_runs``
+
+    :returns: a tuple of the rendered text and the `(href, title)` of each
+    reference-style link; the references are rendered as placeholders
+    """
+    reference_links = []
+    _options = markdown_options.copy()
+    _options["reference_links"] = reference_links
+    _options["reference_footer"] = footer
+    dom_markdown = to_markdown(tokens, **_options)
+    if (not first) and dom_markdown:
+        # the separator before the run was stripped along with the whitespace
+        # that leads a document; it is restored, so the serializer escapes the
+        # first line as it would within the document, then removed again
+        if dom_markdown[0].get("_md_type") in _tts_md_whitespace:
+            dom_markdown[0]["data"] = "\n\n" + dom_markdown[0]["data"]
+        else:
+            dom_markdown.insert(0, TokenNewlines())
+    for filter_class in filters:
+        dom_markdown = filter_class(source=dom_markdown)
+    rendered = serializer.render(dom_markdown)
+    if not first:
+        rendered = rendered[2:]
+    return (rendered, reference_links)
+
+
+# the arguments to `render_run` in a worker process of the pool
+_worker_options = None  # type: Any
+
+
+def _worker_initializer(markdown_options, filters, serializer):
+    global _worker_options
+    _worker_options = (markdown_options, filters, serializer)
+
+
+def _worker_render(run):
+    (tokens, first, footer) = run
+    return render_run(tokens, first, *_worker_options, footer=footer)
+
+
+def _renders_references(markdown_options):
+    """
+    can ``to_markdown`` render reference-style links with these options? if
+    so, the last run of a document is rendered with the footer placeholder
+    """
+    return bool(
+        markdown_options["reference_style_link"]
+        or markdown_options["reference_style_img"]
+    )
+
+
+def _chunk_runs(runs, chunks):
+    """
+    groups consecutive `runs` into about `chunks` lists of tokens, of a
+    similar length
+    """
+    _target = sum(len(_run) for _run in runs) // chunks
+    _chunks = [[]]
+    for _run in runs:
+        if _chunks[-1] and (len(_chunks[-1]) + len(_run) > _target):
+            _chunks.append([])
+        _chunks[-1].extend(_run)
+    return _chunks
 
 
 class Transformer(object):
     """
     ``Transformer`` is basically a factory for creating configurable transformations
 
-    The returned object has two methods:
+    The returned object has these methods:
 
     ``transform`` accepts text and returns text
+    ``transform_variants`` accepts text and returns several renderings of it
+    ``render_tree`` accepts a html5lib tree and returns text
     ``adapt`` accepts a html5lib tree and returns an adapted tree
 
     """
 
-    _parser = None
-    _walker = None
-    _builder = None
-    _serializer = None
-
-    _a_as_tag = None
-    _a_simple_links = None
-    _parse_markdown_simplelink = None
-    _img_as_tag = None
-    _strip_comments = None
-    _strip_scripts = None
-    _reference_style_link = None
-    _reference_style_img = None
-    _div_as_block = None
-    _character_italic = None
-    _character_bold = None
-    _character_italicbold = None
-    _character_unordered_listitem = None
+    _backend = None  # type: Any
+    _treebuilder = None  # type: Any
+    _plaintext_fastpath = True
+    _parser = None  # type: Any
+    _walker = None  # type: Any
+    _builder = None  # type: Any
+    _serializer = None  # type: Any
+
+    _a_as_tag = None  # type: Any
+    _a_simple_links = None  # type: Any
+    _parse_markdown_simplelink = None  # type: Any
+    _img_as_tag = None  # type: Any
+    _strip_comments = None  # type: Any
+    _strip_scripts = None  # type: Any
+    _reference_style_link = None  # type: Any
+    _reference_style_img = None  # type: Any
+    _div_as_block = None  # type: Any
+    _character_italic = None  # type: Any
+    _character_bold = None  # type: Any
+    _character_italicbold = None  # type: Any
+    _character_unordered_listitem = None  # type: Any
+    _strip_styles = None  # type: Any
+    _prune_tags = None  # type: Any
+    _prune = None  # type: Any
+    _max_output_chars = None  # type: Any
+    _max_blocks = None  # type: Any
+    _debug = None  # type: Any
+    _block_cache = None  # type: Any
+    _pool = None  # type: Any
+    _pool_processes = None  # type: Any
 
     def __init__(
         self,
@@ -1532,6 +1908,17 @@ class Transformer(object):
         allowed_tags_blocks=None,
         allowed_tags_attributes=None,
         serializer=None,
+        backend=None,
+        treebuilder=None,
+        allowed_protocols=None,
+        allowed_styles=None,
+        strip_styles=False,
+        prune_tags=None,
+        prune=None,
+        max_output_chars=None,
+        max_blocks=None,
+        block_cache=None,
+        debug=None,
     ):
         """
         Initializes a ``Transformer``.
@@ -1557,13 +1944,71 @@ class Transformer(object):
         :arg list allowed_tags: see ``to_markdown``
         :arg list allowed_tags_blocks: see ``to_markdown``
         :arg dict allowed_tags_attributes: see ``to_markdown``
-
-        :arg object serializer:  an instance of a ``html5lib.serializer.HTMLSerializer``
-        object. default is ``None``, which will create an instance of this
-        package's ``MarkdownSerializer`` with some default values.
+        :arg list allowed_protocols: see ``to_markdown``
+        :arg list allowed_styles: see ``to_markdown``
+        :arg bool strip_styles: see ``to_markdown``
+        :arg bool debug: see ``to_markdown``
+
+        :arg list prune_tags: list of tags whose entire subtree is removed from
+        the parsed html before it is walked, such as
+        ``markdown_info.MARKDOWN_TAGS_PRUNE``. Pruning `script` is faster than
+        ``strip_scripts``, which walks every token in the script, but the
+        output can differ: an element that only contained a script becomes
+        empty, and is removed. default is ``None``.
+
+        :arg callable prune: a predicate which accepts the arguments
+        `(tag, attributes)`, in which `attributes` is a dict of attribute names
+        to values, and returns ``True`` if the element's subtree should be
+        pruned. default is ``None``.
+
+        :arg int max_output_chars: renders a preview, by stopping once this many
+        characters of text have been rendered. Open lists, blockquotes, code and
+        emphasis are closed cleanly. Markdown syntax and html tags are not
+        counted, so the output may be slightly longer. default is ``None``.
+
+        :arg int max_blocks: renders a preview, by stopping once this many blocks
+        (paragraphs, headings, lists, etc) have been rendered. default is
+        ``None``.
+
+        :arg int block_cache: the number of rendered runs of top-level blocks
+        (see ``utils.split_blocks``) that ``transform`` keeps in a
+        ``BlockCache``, so boilerplate which repeats across documents (such as
+        headers, footers and disclaimers) is only rendered once. The cache is
+        shared by every ``transform`` of this ``Transformer``, and is
+        available as ``block_cache``. default is ``None``, which does not cache.
+
+        :arg object serializer:  an object with a ``render`` method, such as a
+        ``html5lib.serializer.HTMLSerializer``. default is ``None``, which will
+        create an instance of this package's ``MarkdownSerializer`` with some
+        default values.
         ``MarkdownSerializer`` unescapes the blockquote characters in markdown
         text from "&gt;" to ">", producing valid Markdown but invalid HTML.
+
+        :arg string backend: which parser should tokenize the text? default
+        ``None``, which will invoke ``"html5lib"``. Options are:
+        "html5lib": the spec-compliant html5lib parser. slow, but safe for any input.
+        "html5lib-tokenizer": the html5lib tokenizer feeds tokens directly into
+        ``to_markdown``, skipping the construction and walking of a tree. Only
+        the minimal tree-construction fixups are performed, so it is only
+        suitable for mostly well-formed input.
+        "html.parser": the stdlib ``html.parser``. Several times faster, but it
+        only performs minimal nesting fixups, so it is only suitable for trusted,
+        well-formed input.
+
+        :arg string treebuilder: which html5lib tree builder and walker should be
+        used by the "html5lib" backend? default ``None``, which will invoke
+        ``"etree"``. Options are "etree", "dom" and "lxml" (which requires the
+        ``lxml`` package). The walkers' token differences are normalized by
+        ``trees.walk_tree``, so all options render identically.
         """
+        backend = BACKEND_HTML5LIB if backend is None else backend
+        if backend not in BACKENDS:
+            raise ValueError("invalid backend: %s" % backend)
+        treebuilder = TREEBUILDER_ETREE if treebuilder is None else treebuilder
+        if treebuilder not in TREEBUILDERS:
+            raise ValueError("invalid treebuilder: %s" % treebuilder)
+        self._backend = backend
+        self._treebuilder = treebuilder
         self.filters = filters or []
 
         self._a_as_tag = a_as_tag
@@ -1579,12 +2024,38 @@ class Transformer(object):
         self._character_bold = character_bold
         self._character_italicbold = character_italicbold
         self._character_unordered_listitem = character_unordered_listitem
-        self.allowed_tags = allowed_tags
-        self.allowed_tags_blocks = allowed_tags_blocks
-        self.allowed_tags_attributes = allowed_tags_attributes
-
-        self._builder = getTreeBuilder("etree")
-        self._walker = getTreeWalker("etree")
+        # compile the allowlists once, instead of on every ``to_markdown`` call
+        self.allowed_tags = compile_allowed_tags(
+            MARKDOWN_TAGS_PASSTHROUGH if allowed_tags is None else allowed_tags
+        )
+        self.allowed_tags_blocks = compile_allowed_tags(
+            MARKDOWN_TAGS_PASSTHROUGH_BLOCKS
+            if allowed_tags_blocks is None
+            else allowed_tags_blocks
+        )
+        self.allowed_tags_attributes = compile_allowed_attributes(
+            MARKDOWN_TAGS_ATTRIBUTES
+            if allowed_tags_attributes is None
+            else allowed_tags_attributes
+        )
+        self.allowed_protocols = allowed_protocols
+        self.allowed_styles = allowed_styles
+        self._strip_styles = strip_styles
+        self._prune_tags = frozenset(prune_tags or ())
+        self._prune = prune
+        self._max_output_chars = max_output_chars
+        self._max_blocks = max_blocks
+        self._debug = debug
+        if block_cache is not None:
+            self._block_cache = BlockCache(block_cache)
+
+        # html5lib is imported by the first ``Transformer``, not by this module
+        from html5lib import getTreeBuilder
+        from html5lib import getTreeWalker
+        from html5lib import HTMLParser
+
+        self._builder = getTreeBuilder(treebuilder)
+        self._walker = getTreeWalker(treebuilder)
         self._parser = HTMLParser(self._builder)
         if serializer is None:
             serializer = MarkdownSerializer(
@@ -1599,16 +2070,44 @@ class Transformer(object):
             )
         self._serializer = serializer
 
-    def transform(self, text):
+    def _markdown_options(self):
         """
-        Cleans text and returns sanitized result as unicode
+        returns the keyword arguments this ``Transformer`` will invoke
+        ``to_markdown`` with
+        """
+        return {
+            "a_as_tag": self._a_as_tag,
+            "a_simple_links": self._a_simple_links,
+            "parse_markdown_simplelink": self._parse_markdown_simplelink,
+            "img_as_tag": self._img_as_tag,
+            "strip_comments": self._strip_comments,
+            "strip_scripts": self._strip_scripts,
+            "reference_style_link": self._reference_style_link,
+            "reference_style_img": self._reference_style_img,
+            "div_as_block": self._div_as_block,
+            "allowed_tags": self.allowed_tags,
+            "allowed_tags_blocks": self.allowed_tags_blocks,
+            "allowed_tags_attributes": self.allowed_tags_attributes,
+            "allowed_protocols": self.allowed_protocols,
+            "allowed_styles": self.allowed_styles,
+            "strip_styles": self._strip_styles,
+            "character_italic": self._character_italic,
+            "character_bold": self._character_bold,
+            "character_italicbold": self._character_italicbold,
+            "character_unordered_listitem": self._character_unordered_listitem,
+            "debug": self._debug,
+        }
+
+    def _tokenize(self, text):
+        """
+        normalizes `text` and tokenizes it with the configured backend
 
-        :arg str text: text to be cleaned
+        :arg str text: text to be tokenized
 
-        :returns: sanitized text as unicode
+        :returns: an iterable of html5lib walker tokens, or ``None`` if there
+        is no text
 
         :raises TypeError: if ``text`` is not a text type
-
         """
         if not isinstance(text, string_types):
             message = (
@@ -1619,44 +2118,72 @@ class Transformer(object):
             raise TypeError(message)
 
         if not text:
-            return ""
+            return None
 
         # bleach.utils.force_unicode
         if not isinstance(text, text_type):
             text = text_type(text, "utf-8", "strict")
 
-        text = "\n".join(
-            [i.rstrip() for i in text.split("\n")]
-        )  # normalize trailing whitespace
+        # normalize trailing whitespace
+        # this returns `text` itself, without a copy, if there is nothing to strip
+        text = RE_trailing_whitespace.sub("", text)
+
+        if self._plaintext_fastpath and not RE_markup_or_normalizable.search(text):
+            # plain text (no tags or entities) would be parsed into a single
+            # text node, so the walker tokens can be generated directly
+            return text_tokens(text)
+
+        _prune = self._prune_tags or (self._prune is not None)
 
-        text = wrapped % text
-        dom = self._parser.parseFragment(text)
+        if self._backend in (BACKEND_STDLIB, BACKEND_HTML5LIB_TOKENIZER):
+            # the stream backends emit walker tokens directly
+            if self._backend == BACKEND_STDLIB:
+                tokens = stdlib_tokens(text)
+            else:
+                tokens = html5lib_tokens(text)
+            if _prune:
+                tokens = prune_tokens(tokens, self._prune_tags, self._prune)
+            return tokens
+
+        if self._treebuilder == TREEBUILDER_ETREE:
+            # html5lib reads the wrapper and text as one stream, without
+            # concatenating them into another copy of the text
+            dom = self._parser.parseFragment(
+                FragmentReader(wrapped_start, text, wrapped_end)
+            )
+            unwrap_fragment(dom, FRAGMENT_TYPE)
+        else:
+            dom = self._parser.parseFragment(text, container=FRAGMENT_CONTAINER)
 
         # reset the parser
         # TODO: is this needed? does `parseFragment` not reset first?
         self._parser.reset()
+        if _prune:
+            # the subtrees are removed before they are walked
+            prune_tree(dom, self._treebuilder, self._prune_tags, self._prune)
+        return walk_tree(self._walker, dom, self._treebuilder)
+
+    def _truncate(self, tokens):
+        """
+        applies the `max_output_chars` and `max_blocks` limits to `tokens`
+        """
+        if (self._max_output_chars is not None) or (self._max_blocks is not None):
+            # the tokens after the limit are never walked or post-processed
+            tokens = truncate_tokens(
+                tokens, max_chars=self._max_output_chars, max_blocks=self._max_blocks
+            )
+        return tokens
+
+    def _render(self, tokens, markdown_options, prepared=None):
+        """
+        invokes ``to_markdown`` on `tokens`, applies the filters, and serializes
+        the result; `prepared` is rendered instead, if provided
+        """
+        if prepared is None:
+            tokens = self._truncate(tokens)
+        dom_markdown = to_markdown(tokens, prepared=prepared, **markdown_options)
 
         # Apply any filters after the
-        dom_markdown = to_markdown(
-            self._walker(dom),
-            a_as_tag=self._a_as_tag,
-            a_simple_links=self._a_simple_links,
-            parse_markdown_simplelink=self._parse_markdown_simplelink,
-            img_as_tag=self._img_as_tag,
-            strip_comments=self._strip_comments,
-            strip_scripts=self._strip_scripts,
-            reference_style_link=self._reference_style_link,
-            reference_style_img=self._reference_style_img,
-            div_as_block=self._div_as_block,
-            allowed_tags=self.allowed_tags,
-            allowed_tags_blocks=self.allowed_tags_blocks,
-            allowed_tags_attributes=self.allowed_tags_attributes,
-            character_italic=self._character_italic,
-            character_bold=self._character_bold,
-            character_italicbold=self._character_italicbold,
-            character_unordered_listitem=self._character_unordered_listitem,
-            is_fragment=True,
-        )
         for filter_class in self.filters:
             dom_markdown = filter_class(source=dom_markdown)
 
@@ -1664,6 +2191,370 @@ class Transformer(object):
 
         return rendered
 
+    def transform(self, text, root=None):
+        """
+        Cleans text and returns sanitized result as unicode
+
+        :arg str text: text to be cleaned
+
+        :arg root: a css selector for the element to render, such as
+        ``"article"``, ``"#content"`` or ``"div.post > .body"``; see
+        ``selector`` for the supported subset. Only the first matching element
+        (and its contents) is rendered; if no element matches, the result is
+        empty. default ``None``, which renders the entire text.
+
+        :returns: sanitized text as unicode
+
+        :raises TypeError: if ``text`` is not a text type
+
+        :raises ValueError: if ``root`` is not a supported selector
+
+        """
+        tokens = self._tokenize(text)
+        if tokens is None:
+            return ""
+        if root is not None:
+            tokens = list(select_tokens(tokens, root))
+            if not tokens:
+                return ""
+        if (self._block_cache is not None) and (
+            (self._max_output_chars is None) and (self._max_blocks is None)
+        ):
+            return self._render_cached(tokens, self._markdown_options())
+        return self._render(tokens, self._markdown_options())
+
+    @property
+    def block_cache(self):
+        # type: () -> Optional[BlockCache]
+        """the ``BlockCache`` of rendered runs, or ``None``"""
+        return self._block_cache
+
+    def _render_cached(self, tokens, markdown_options):
+        """
+        renders `tokens` like ``_render``, but renders each run of top-level
+        blocks with ``render_run`` only if it is not in the ``BlockCache``
+        """
+        cache = self._block_cache
+
+        def _render_run(tokens, first, fingerprint, footer=False, keep=False):
+            # the runs begin at the top level, outside of any blockquote, list
+            # or code, so only the first run is rendered in another context
+            _key = (first, footer, fingerprint)
+            _result = cache.get(_key)
+            if _result is None:
+                if keep:
+                    # `render_run` alters the tokens
+                    tokens = copy_tokens(tokens)
+                _result = render_run(
+                    tokens,
+                    first,
+                    markdown_options,
+                    self.filters,
+                    self._serializer,
+                    footer=footer,
+                )
+                cache.set(_key, _result)
+            return _result
+
+        runs = self._split_runs(tokens)
+        footer = _renders_references(markdown_options)
+        rendered = []
+        for (_idx, _run) in enumerate(runs):
+            _fingerprint = fingerprint_tokens(_run)
+            _last = (_run, _idx == 0, _fingerprint)
+            if _idx == len(runs) - 1:
+                # the tokens are kept in case the run must be rendered again
+                _result = _render_run(*_last, footer=footer, keep=footer)
+            else:
+                _result = _render_run(*_last)
+            rendered.append(_result)
+        return self._stitch_runs(
+            rendered, footer, lambda: _render_run(*_last, footer=not footer)
+        )
+
+    def transform_variants(self, text, variants):
+        """
+        Cleans text once and renders it with several sets of options.
+
+        The text is parsed, walked and truncated a single time, and the
+        stages of ``to_markdown`` which do not depend on the options (see
+        ``prepare_tokens``) run once for all the variants which keep this
+        ``Transformer``'s `allowed_tags` and `strip_comments`. The rest of
+        ``to_markdown``, the filters and the serializer run once per variant,
+        on a copy of the prepared tokens.
+
+        :arg str text: text to be cleaned
+
+        :arg dict variants: keys are variant names, values are a dict of
+        ``to_markdown`` options that override this ``Transformer``'s options.
+        For example:
+
+            {
+                "site": {"a_as_tag": True, "img_as_tag": True},
+                "feed": {"a_as_tag": False, "reference_style_link": True},
+            }
+
+        :returns: a dict of variant names to sanitized text as unicode
+
+        :raises TypeError: if ``text`` is not a text type
+
+        :raises ValueError: if a variant specifies an unknown option
+        """
+        markdown_options = self._markdown_options()
+        for (_name, _options) in variants.items():
+            for _option in _options:
+                if _option not in markdown_options:
+                    raise ValueError(
+                        "variant `%s` has an invalid option: %s" % (_name, _option)
+                    )
+
+        tokens = self._tokenize(text)
+        if tokens is None:
+            return dict((_name, "") for _name in variants)
+
+        tokens = list(self._truncate(tokens))
+        # the variants which override these options drop other tags, so they
+        # prepare a copy of the tokens themselves, before the shared variants
+        _own = [
+            _name
+            for _name in variants
+            if any(_option in variants[_name] for _option in OPTIONS_PREPARE)
+        ]
+        _shared = [_name for _name in variants if _name not in _own]
+        rendered = {}
+        for _name in _own:
+            _options = markdown_options.copy()
+            _options.update(variants[_name])
+            _prepared = prepare_tokens(
+                copy_tokens(tokens),
+                _options["allowed_tags"],
+                strip_comments=_options["strip_comments"],
+            )
+            rendered[_name] = self._render(None, _options, prepared=_prepared)
+        if _shared:
+            prepared = prepare_tokens(
+                tokens, self.allowed_tags, strip_comments=self._strip_comments
+            )
+            for _name in _shared:
+                _options = markdown_options.copy()
+                _options.update(variants[_name])
+                # `to_markdown` alters what it renders, so every variant except
+                # for the last one is rendered from a copy
+                _prepared = (
+                    prepared if (_name == _shared[-1]) else copy_prepared(prepared)
+                )
+                rendered[_name] = self._render(None, _options, prepared=_prepared)
+        return dict((_name, rendered[_name]) for _name in variants)
+
+    def _split_runs(self, tokens):
+        """
+        splits `tokens` into runs of top-level blocks with ``split_blocks``
+        """
+        _block_tags = set(tag_names_split)
+        _block_tags.update(self.allowed_tags_blocks)
+        if self._div_as_block:
+            _block_tags.add("div")
+        return split_blocks(list(tokens), _block_tags)
+
+    def _stitch_runs(self, rendered, footer, render_last):
+        """
+        joins the runs rendered by ``render_run``, and renumbers their
+        reference-style links into a single footer
+
+        :arg list rendered: the `(text, reference_links)` of each run, in order
+
+        :arg bool footer: was the last run rendered with
+        ``render_run(footer=True)``? the whitespace before the footer depends
+        on how the last run ends, so the last run must be rendered with the
+        footer if, and only if, the document has reference-style links. This
+        is ``_renders_references``, as those are only known once every run is
+        rendered.
+
+        :arg callable render_last: renders the last run again, with the footer
+        if `footer` is ``False`` and without it otherwise; it is only invoked
+        if the options render reference-style links but the document has none
+        """
+        if footer != any(_reference_links for (_text, _reference_links) in rendered):
+            rendered = rendered[:-1] + [render_last()]
+        # renumber the references, in the order they appear in the document
+        _references = []  # (href, title)
+        _numbers = {}  # href: number
+        _texts = []
+        for (_text, _reference_links) in rendered:
+            if _reference_links:
+                _renumbered = {}
+                for (_idx, (_href, _title)) in enumerate(_reference_links):
+                    if _href not in _numbers:
+                        _references.append((_href, _title))
+                        _numbers[_href] = len(_references)
+                    _renumbered["%s" % (_idx + 1)] = "][%s]" % _numbers[_href]
+                _text = RE_reference_placeholder.sub(
+                    lambda m: _renumbered[m.group(1)], _text
+                )
+            if _text:
+                _texts.append(_text)
+        if _references:
+            _footer = []
+            for (_idx, (_href, _title)) in enumerate(_references):
+                if _idx:
+                    _footer.append(TokenNewline())
+                _footer.append(TokenAMarkdownReference(_href, _idx + 1, _title))
+            _texts[-1] = _texts[-1].replace(
+                REFERENCE_FOOTER, self._serializer.render(_footer)
+            )
+        return "\n\n".join(_texts)
+
+    def transform_parallel(self, text, processes=None):
+        """
+        Cleans text like ``transform``, but renders very large documents (such
+        as book chapters or exported wikis) in a pool of processes.
+
+        The text is parsed once, then split into runs of top-level blocks (see
+        ``utils.split_blocks``) which are rendered in parallel. The rendered
+        runs are joined with a blank line, and the reference-style links are
+        renumbered into a single footer, so the result is the same as that of
+        ``transform``.
+
+        Only the top-level blocks are split, so text which is wrapped in a
+        single element (such as an `article`, or a `div` when `div_as_block`)
+        has one run. That text, and text which is rendered with the
+        ``max_output_chars`` or ``max_blocks`` limits, is rendered in this
+        process. The whole text is parsed in this process too, before the
+        runs are rendered.
+
+        The pool of processes is kept by this ``Transformer`` and reused by the
+        next call with the same number of `processes`; ``close`` terminates
+        it.
+
+        :arg str text: text to be cleaned
+
+        :arg int processes: the number of worker processes. default ``None``,
+        which uses the number of CPUs. If ``1``, the runs are rendered in this
+        process. The options of this ``Transformer`` (such as a callable in
+        ``allowed_tags_attributes``) must be picklable on platforms which
+        spawn the worker processes instead of forking them.
+
+        :returns: sanitized text as unicode
+
+        :raises TypeError: if ``text`` is not a text type
+        """
+        tokens = self._tokenize(text)
+        if tokens is None:
+            return ""
+        markdown_options = self._markdown_options()
+        if (self._max_output_chars is not None) or (self._max_blocks is not None):
+            # a preview never renders most of the text
+            return self._render(tokens, markdown_options)
+
+        runs = self._split_runs(tokens)
+        if len(runs) == 1:
+            return self._render(runs[0], markdown_options)
+
+        import multiprocessing
+
+        processes = processes or multiprocessing.cpu_count()
+        chunks = _chunk_runs(runs, processes * PARALLEL_CHUNKS_PER_PROCESS)
+        footer = _renders_references(markdown_options)
+        chunks = [
+            (_chunk, (_idx == 0), (footer and (_idx == len(chunks) - 1)))
+            for (_idx, _chunk) in enumerate(chunks)
+        ]
+        _renderer = (markdown_options, self.filters, self._serializer)
+        _last = chunks[-1]
+        if processes == 1:
+            if footer:
+                # `render_run` alters the tokens, which may be rendered again
+                _last = (copy_tokens(_last[0]), _last[1], _last[2])
+            rendered = [
+                render_run(_chunk, _first, *_renderer, footer=_footer)
+                for (_chunk, _first, _footer) in chunks
+            ]
+        else:
+            # the tokens are only altered by the copies sent to the pool
+            rendered = self._get_pool(processes).map(_worker_render, chunks)
+
+        return self._stitch_runs(
+            rendered,
+            footer,
+            lambda: render_run(_last[0], _last[1], *_renderer, footer=not footer),
+        )
+
+    def _get_pool(self, processes):
+        """
+        returns the pool of `processes` worker processes for
+        ``transform_parallel``, which is created by the first call
+        """
+        if (self._pool is not None) and (self._pool_processes != processes):
+            self.close()
+        if self._pool is None:
+            import multiprocessing
+
+            self._pool = multiprocessing.Pool(
+                processes,
+                initializer=_worker_initializer,
+                initargs=(self._markdown_options(), self.filters, self._serializer),
+            )
+            self._pool_processes = processes
+        return self._pool
+
+    def close(self):
+        """
+        terminates the pool of worker processes kept by ``transform_parallel``,
+        if there is one. The next call creates a new pool.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pool_processes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """``close`` is called when the ``with`` block exits"""
+        self.close()
+
+    def incremental(self):
+        """
+        returns an ``IncrementalTransform``, which re-converts a document as it
+        is edited, with the options of this ``Transformer``
+        """
+        return IncrementalTransform(self)
+
+    def render_tree(self, tree, root=None):
+        """
+        Renders a tree that was already parsed by html5lib, without reparsing.
+
+        This is useful in pipelines which have already parsed the html with
+        html5lib, such as for sanitization.
+
+        :arg tree: a document or fragment built by html5lib with any of the
+        "etree", "dom" or "lxml" tree builders. If a complete document is
+        provided, only the contents of its `body` are rendered.
+
+        :arg root: a css selector for the element to render; see ``transform``
+
+        :returns: sanitized text as unicode
+
+        ``transform`` strips trailing whitespace from each line of the html
+        before parsing it; a tree parsed from html that was not normalized the
+        same way may render with extra whitespace.
+        """
+        treebuilder = detect_treebuilder(tree)
+        tree = document_body(tree, treebuilder)
+        from html5lib import getTreeWalker
+
+        tokens = walk_tree(getTreeWalker(treebuilder), tree, treebuilder)
+        if self._prune_tags or (self._prune is not None):
+            # the tree belongs to the caller, so it is not altered
+            tokens = prune_tokens(tokens, self._prune_tags, self._prune)
+        if root is not None:
+            tokens = list(select_tokens(tokens, root))
+            if not tokens:
+                return ""
+        return self._render(tokens, self._markdown_options())
+
     def adapt(self, dom):
         """
         invokes the tree adapter to_markdown
@@ -1688,29 +2579,204 @@ class Transformer(object):
 
         # Apply any filters after the
         dom_markdown = to_markdown(
-            self._walker(dom),
-            a_as_tag=self._a_as_tag,
-            a_simple_links=self._a_simple_links,
-            parse_markdown_simplelink=self._parse_markdown_simplelink,
-            img_as_tag=self._img_as_tag,
-            strip_comments=self._strip_comments,
-            strip_scripts=self._strip_scripts,
-            reference_style_link=self._reference_style_link,
-            reference_style_img=self._reference_style_img,
-            div_as_block=self._div_as_block,
-            allowed_tags=self.allowed_tags,
-            allowed_tags_blocks=self.allowed_tags_blocks,
-            allowed_tags_attributes=self.allowed_tags_attributes,
-            character_italic=self._character_italic,
-            character_bold=self._character_bold,
-            character_italicbold=self._character_italicbold,
-            character_unordered_listitem=self._character_unordered_listitem,
-            is_fragment=False,
+            walk_tree(self._walker, dom, self._treebuilder), **self._markdown_options()
         )
         return dom_markdown
 
 
-# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class BlockCache(object):
+    """
+    ``BlockCache`` is a least-recently-used cache of the runs of top-level
+    blocks rendered by ``render_run``, for ``Transformer(block_cache=)``. The
+    keys hold the fingerprint of the run's tokens (see
+    ``utils.fingerprint_tokens``).
+    """
+
+    maxsize = None  # type: Any
+    hits = 0
+    misses = 0
+    _cache = None  # type: Any
+
+    def __init__(self, maxsize):
+        """
+        :arg int maxsize: the number of runs to keep
+        """
+        if maxsize < 1:
+            raise ValueError("invalid block_cache: %s" % maxsize)
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        """returns the rendered run for `key`, or ``None``"""
+        try:
+            _value = engine.lru_get(self._cache, key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _value
+
+    def set(self, key, value):
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
 
+    def clear(self):
+        self._cache.clear()
+        self.hits = self.misses = 0
 
-__all__ = ("Transformer", "to_markdown")
+
+class IncrementalTransform(object):
+    """
+    ``IncrementalTransform`` re-converts a document that is edited over time,
+    such as on every autosave of an editor. Create one with
+    ``Transformer.incremental``:
+
+        incremental = Transformer(backend="html.parser").incremental()
+        markdown = incremental.transform(html)
+        markdown = incremental.transform(html_edited)
+
+    Each run of top-level blocks (see ``utils.split_blocks``) is fingerprinted
+    by its tokens, and its Markdown is kept until the next call. Only the runs
+    whose html changed are rendered again, then the document is reassembled
+    and its reference-style links are renumbered. The result is the same as
+    that of ``Transformer.transform``.
+
+    The text is still parsed in full on every call, so a fast backend is
+    recommended. Only the top-level blocks are split, so an edit anywhere
+    within text which is wrapped in a single element (such as an `article`)
+    renders all of it again.
+    """
+
+    transformer = None  # type: Any
+    runs_rendered = 0  # the number of runs rendered by the last call
+    runs_reused = 0  # the number of runs reused by the last call
+    _markdown_options = None  # type: Any
+    _rendered = (
+        None
+    )  # type: Any  # (first, footer, fingerprint): (text, reference_links)
+
+    def __init__(self, transformer):
+        """
+        :arg transformer: the ``Transformer`` to convert with
+        """
+        self.transformer = transformer
+        self._markdown_options = transformer._markdown_options()
+        self._rendered = {}
+
+    def transform(self, text):
+        """
+        Cleans text and returns sanitized result as unicode
+
+        :arg str text: text to be cleaned
+
+        :returns: sanitized text as unicode
+
+        :raises TypeError: if ``text`` is not a text type
+        """
+        transformer = self.transformer
+        self.runs_rendered = self.runs_reused = 0
+        tokens = transformer._tokenize(text)
+        if tokens is None:
+            self._rendered = {}
+            return ""
+        if (transformer._max_output_chars is not None) or (
+            transformer._max_blocks is not None
+        ):
+            # a preview never renders most of the text
+            return transformer._render(tokens, self._markdown_options)
+
+        rendered = {}
+        results = []
+        runs = transformer._split_runs(tokens)
+        footer = _renders_references(self._markdown_options)
+        for (_idx, _run) in enumerate(runs):
+            # the first run is rendered differently, see `render_run`
+            _first = _idx == 0
+            _fingerprint = fingerprint_tokens(_run)
+            if _idx == len(runs) - 1:
+                if footer:
+                    # `render_run` alters the tokens, which may be rendered again
+                    _last = (copy_tokens(_run), _first, _fingerprint)
+                results.append(
+                    self._render_run(rendered, _run, _first, _fingerprint, footer)
+                )
+            else:
+                results.append(self._render_run(rendered, _run, _first, _fingerprint))
+        markdown = transformer._stitch_runs(
+            results,
+            footer,
+            lambda: self._render_run(rendered, *_last, footer=not footer),
+        )
+        # only the runs of this version of the document are kept
+        self._rendered = rendered
+        return markdown
+
+    def _render_run(self, rendered, tokens, first, fingerprint, footer=False):
+        """
+        renders a run with ``render_run``, unless it was rendered by this call
+        or by the previous one
+
+        :arg dict rendered: the runs rendered by this call
+        """
+        _key = (first, footer, fingerprint)
+        _result = rendered.get(_key) or self._rendered.get(_key)
+        if _result is None:
+            _result = render_run(
+                tokens,
+                first,
+                self._markdown_options,
+                self.transformer.filters,
+                self.transformer._serializer,
+                footer=footer,
+            )
+            self.runs_rendered += 1
+        else:
+            self.runs_reused += 1
+        rendered[_key] = _result
+        return _result
+
+
+# ------------------------------------------------------------------------------
+
+
+# a small document with the markup of most `to_markdown` branches
+PREWARM_HTML = (
+    "<h1>a</h1><p><b>b</b> <i>c</i> <code>d</code> <a href='/e'>e</a> "
+    "<img src='/f.png' alt='f'/></p><ul><li>g</li></ul><ol><li>h</li></ol>"
+    "<blockquote><p>i</p></blockquote><pre>j</pre><hr/><br/>"
+)
+
+
+def prewarm(transformer=None):
+    """
+    Imports html5lib and renders a small document, so the first conversion of
+    a process does not pay for them. A prefork server should call this before
+    its workers are forked, so they share the imported modules.
+
+    :arg transformer: the ``Transformer`` to warm; by default, a ``Transformer``
+    with the default options is built. Any of the backends may be used later,
+    so the html5lib tokenizer is imported as well.
+
+    :returns: the ``Transformer``
+    """
+    import html5lib._tokenizer  # noqa: F401
+
+    if transformer is None:
+        transformer = Transformer()
+    transformer.transform(PREWARM_HTML)
+    return transformer
+
+
+__all__ = (
+    "BlockCache",
+    "IncrementalTransform",
+    "Transformer",
+    "copy_prepared",
+    "prepare_tokens",
+    "prewarm",
+    "to_markdown",
+)
@@ -0,0 +1,399 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+This file contains utilities for the html5lib tree builders and walkers.
+
+html5lib can build a tree with several libraries:
+
+* "etree" - ``xml.etree.ElementTree``; the C accelerated version on CPython
+* "dom" - ``xml.dom.minidom``
+* "lxml" - ``lxml.etree``; requires the ``lxml`` package
+
+Each of the tree walkers yields a slightly different token stream for the same
+html. ``to_markdown`` was developed against the "etree" walker, so the
+differences are normalized here:
+
+* "dom": text is split into multiple adjacent text nodes (e.g. at entities).
+  These are merged back into a single run of text, like the "etree" walker.
+* "lxml": attribute names which are not valid XML names are coerced by
+  html5lib's ``InfosetFilter`` (e.g. ``b?x`` becomes ``bU0003Fx``). These are
+  restored to their original names.
+
+Trees which were built elsewhere (e.g. by ``html5lib.parse``) can be inspected
+with ``detect_treebuilder`` and ``document_body``.
+
+Whole subtrees can be removed before they are walked with ``prune_tree``, or
+from a stream of tokens with ``prune_tokens``. A subtree is pruned if its tag
+is in `prune_tags`, or if the `prune` predicate returns ``True`` when invoked
+with the arguments `(tag, attributes)`; `attributes` is a dict of attribute
+names to values.
+"""
+
+# stdlib
+import re
+
+# local
+from ._compat import string_types
+from ._compat import unichr
+from .streams import text_tokens
+
+
+# ==============================================================================
+
+
+TREEBUILDER_DOM = "dom"
+TREEBUILDER_ETREE = "etree"
+TREEBUILDER_LXML = "lxml"
+TREEBUILDERS = (TREEBUILDER_ETREE, TREEBUILDER_DOM, TREEBUILDER_LXML)
+
+# `html5lib._ihatexml.InfosetFilter.replacementRegexp`
+RE_coerced_name = re.compile(r"U[\dA-F]{5,5}")
+
+
+# `xml.dom.Node.DOCUMENT_NODE`, `xml.dom.Node.ELEMENT_NODE`
+DOM_DOCUMENT_NODE = 9
+DOM_ELEMENT_NODE = 1
+
+
+# ------------------------------------------------------------------------------
+
+
+def _local_name(tag):
+    """strips the namespace from an etree/lxml tag: `{namespace}name` -> `name`"""
+    if not isinstance(tag, string_types):
+        # lxml comments and processing instructions have a function as a tag
+        return None
+    if tag[0] == "{":
+        return tag.rsplit("}", 1)[1]
+    return tag
+
+
+def detect_treebuilder(tree):
+    """
+    returns the name of the html5lib tree builder which created `tree`
+
+    :arg tree: a document or fragment built by html5lib
+    """
+    if isinstance(tree, list):
+        # `parseFragment` returns a list with the "lxml" tree builder
+        return TREEBUILDER_LXML
+    if type(tree).__module__.startswith("lxml"):
+        return TREEBUILDER_LXML
+    if hasattr(tree, "nodeType"):
+        return TREEBUILDER_DOM
+    return TREEBUILDER_ETREE
+
+
+def document_body(tree, treebuilder=TREEBUILDER_ETREE):
+    """
+    If `tree` is a complete html document, returns its `body` element so the
+    `head` is not rendered; otherwise returns `tree` as-is.
+
+    :arg tree: a document or fragment built by html5lib
+
+    :arg string treebuilder: the name of the html5lib tree builder which
+    created the tree; one of ``TREEBUILDERS``
+    """
+    if treebuilder == TREEBUILDER_DOM:
+        if tree.nodeType == DOM_DOCUMENT_NODE:
+            _html = tree.documentElement
+            for _node in _html.childNodes:
+                if (_node.nodeType == DOM_ELEMENT_NODE) and (_node.localName == "body"):
+                    return _node
+        return tree
+    if isinstance(tree, list):
+        return tree
+    _root = tree.getroot() if hasattr(tree, "getroot") else tree
+    if _local_name(_root.tag) == "html":
+        for _node in _root:
+            if _local_name(_node.tag) == "body":
+                return _node
+    return tree
+
+
+def unwrap_fragment(fragment, name):
+    """
+    Replaces each top-level element of an "etree" `fragment` named `name` with
+    its contents, in place.
+
+    The "etree" tree builder drops the elements which html5lib moves out of a
+    `table` (foster parenting) when the text is parsed in the context of a
+    container, so text is parsed within a wrapper element, removed with this.
+    If the text ends within a comment or an element with raw text, such as an
+    unclosed `script`, that node swallows the wrapper's end tag; it is trimmed
+    from the node's text.
+    """
+    _end_tag = "</%s>" % name
+    _children = []
+    _text = [fragment.text]
+
+    def _append_text(text):
+        if not text:
+            return
+        if _children:
+            _children[-1].tail = (_children[-1].tail or "") + text
+        else:
+            _text[0] = (_text[0] or "") + text
+
+    for _node in list(fragment):
+        if _local_name(_node.tag) != name:
+            _children.append(_node)
+            continue
+        _last = _node
+        while len(_last):
+            _last = _last[-1]
+        if (_last is not _node) and _last.text and _last.text.endswith(_end_tag):
+            _last.text = _last.text[: -len(_end_tag)]
+        _inner = list(_node)
+        _append_text(_node.text)
+        for _child in _inner:
+            _children.append(_child)
+        _append_text(_node.tail)
+    fragment[:] = _children
+    fragment.text = _text[0]
+    return fragment
+
+
+def _is_pruned(name, attributes, prune_tags, prune):
+    """
+    should the subtree of `name` be pruned?
+
+    :arg attributes: a callable that returns the attributes as a dict, so they
+    are only built for the `prune` predicate
+    """
+    if name in prune_tags:
+        return True
+    if prune is not None:
+        return prune(name, attributes())
+    return False
+
+
+def _prune_elements(root, prune_tags, prune):
+    """
+    prunes an "etree" or "lxml" tree in place; the `tail` text of a pruned
+    element is kept
+    """
+    _stack = [root]
+    while _stack:
+        _parent = _stack.pop()
+        _previous = None
+        for _node in list(_parent):
+            _name = _local_name(_node.tag)
+            if (_name is not None) and _is_pruned(
+                _name, lambda: dict(_node.attrib), prune_tags, prune
+            ):
+                _tail = _node.tail
+                # lxml removes the `tail` with the element; etree does not
+                _parent.remove(_node)
+                if _tail:
+                    if _previous is None:
+                        _parent.text = (_parent.text or "") + _tail
+                    else:
+                        _previous.tail = (_previous.tail or "") + _tail
+            else:
+                _previous = _node
+                _stack.append(_node)
+
+
+def _prune_lxml_fragment(fragment, prune_tags, prune):
+    """
+    prunes a "lxml" fragment, which is a list of text and elements, in place
+    """
+    _items = []
+    for _item in fragment:
+        if isinstance(_item, string_types):
+            _items.append(_item)
+            continue
+        _name = _local_name(_item.tag)
+        if (_name is not None) and _is_pruned(
+            _name, lambda: dict(_item.attrib), prune_tags, prune
+        ):
+            _tail = _item.tail
+            if _tail:
+                if not _items:
+                    _items.append(_tail)
+                elif isinstance(_items[-1], string_types):
+                    _items[-1] += _tail
+                else:
+                    _items[-1].tail = (_items[-1].tail or "") + _tail
+            continue
+        _prune_elements(_item, prune_tags, prune)
+        _items.append(_item)
+    fragment[:] = _items
+
+
+def _prune_dom(root, prune_tags, prune):
+    """
+    prunes a "dom" tree in place
+    """
+    _stack = [root]
+    while _stack:
+        _parent = _stack.pop()
+        for _node in list(_parent.childNodes):
+            if _node.nodeType != DOM_ELEMENT_NODE:
+                continue
+            if _is_pruned(
+                _node.localName,
+                lambda: dict(_node.attributes.items()),
+                prune_tags,
+                prune,
+            ):
+                _parent.removeChild(_node)
+            else:
+                _stack.append(_node)
+
+
+def prune_tree(tree, treebuilder=TREEBUILDER_ETREE, prune_tags=(), prune=None):
+    """
+    Removes whole subtrees from `tree`, in place, so they are never walked.
+
+    :arg tree: the tree (or fragment) to prune
+
+    :arg string treebuilder: the name of the html5lib tree builder which
+    created the tree; one of ``TREEBUILDERS``
+
+    :arg prune_tags: a collection of tags to prune
+
+    :arg callable prune: an optional predicate, see the module docstring
+
+    :returns: `tree`
+    """
+    if treebuilder == TREEBUILDER_DOM:
+        _prune_dom(tree, prune_tags, prune)
+    elif isinstance(tree, list):
+        _prune_lxml_fragment(tree, prune_tags, prune)
+    else:
+        if hasattr(tree, "getroot"):
+            tree = tree.getroot()
+        _prune_elements(tree, prune_tags, prune)
+    return tree
+
+
+def _prune_tokens(tokens, prune_tags, prune):
+    _pruning = None
+    _depth = 0
+    for token in tokens:
+        _type = token["type"]
+        if _pruning is not None:
+            # only elements named like the pruned element can close it
+            if token.get("name") == _pruning:
+                if _type == "StartTag":
+                    _depth += 1
+                elif _type == "EndTag":
+                    _depth -= 1
+                    if not _depth:
+                        _pruning = None
+            continue
+        if (_type == "StartTag") or (_type == "EmptyTag"):
+            _name = token["name"]
+            if _is_pruned(
+                _name,
+                lambda: dict((_k[1], _v) for (_k, _v) in token["data"].items()),
+                prune_tags,
+                prune,
+            ):
+                if _type == "StartTag":
+                    _pruning = _name
+                    _depth = 1
+                continue
+        yield token
+
+
+def prune_tokens(tokens, prune_tags=(), prune=None):
+    """
+    Removes whole subtrees from a stream of walker tokens. The text around a
+    pruned subtree is merged, as it would be by ``prune_tree``.
+
+    :arg tokens: an iterable of walker tokens
+
+    :arg prune_tags: a collection of tags to prune
+
+    :arg callable prune: an optional predicate, see the module docstring
+    """
+    return merge_text_tokens(_prune_tokens(tokens, prune_tags, prune))
+
+
+def _uncoerce_name(name):
+    """reverses `html5lib._ihatexml.InfosetFilter.coerceAttribute`"""
+    return RE_coerced_name.sub(lambda m: unichr(int(m.group(0)[1:], 16)), name)
+
+
+def merge_text_tokens(tokens):
+    """
+    Merges runs of adjacent text tokens into a single text node, then splits
+    them into SpaceCharacters/Characters exactly like the "etree" walker.
+    """
+    _text = []
+    for token in tokens:
+        if token["type"] in ("Characters", "SpaceCharacters"):
+            _text.append(token)
+            continue
+        if _text:
+            if len(_text) == 1:
+                yield _text[0]
+            else:
+                for _token in text_tokens("".join(i["data"] for i in _text)):
+                    yield _token
+            _text = []
+        yield token
+    if _text:
+        if len(_text) == 1:
+            yield _text[0]
+        else:
+            for _token in text_tokens("".join(i["data"] for i in _text)):
+                yield _token
+
+
+def uncoerce_attribute_names(tokens):
+    """
+    Restores the attribute names which the "lxml" tree builder coerced into
+    valid XML names.
+    """
+    for token in tokens:
+        if token["type"] in ("StartTag", "EmptyTag"):
+            _data = token["data"]
+            for _key in _data:
+                if RE_coerced_name.search(_key[1]):
+                    token["data"] = _data.__class__(
+                        ((_k[0], _uncoerce_name(_k[1])), _v)
+                        for (_k, _v) in _data.items()
+                    )
+                    break
+        yield token
+
+
+def walk_tree(walker, tree, treebuilder=TREEBUILDER_ETREE):
+    """
+    Walks `tree` with the html5lib `walker` and yields tokens that are
+    normalized to the "etree" walker's format.
+
+    :arg walker: a html5lib TreeWalker class, from ``html5lib.getTreeWalker``
+
+    :arg tree: the tree (or fragment) to walk
+
+    :arg string treebuilder: the name of the html5lib tree builder which
+    created the tree; one of ``TREEBUILDERS``
+    """
+    tokens = walker(tree)
+    if treebuilder == TREEBUILDER_DOM:
+        return merge_text_tokens(tokens)
+    elif treebuilder == TREEBUILDER_LXML:
+        return uncoerce_attribute_names(tokens)
+    return tokens
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+__all__ = (
+    "TREEBUILDERS",
+    "detect_treebuilder",
+    "document_body",
+    "merge_text_tokens",
+    "prune_tokens",
+    "prune_tree",
+    "uncoerce_attribute_names",
+    "unwrap_fragment",
+    "walk_tree",
+)
@@ -5,6 +5,11 @@ from __future__ import unicode_literals
 # stdlib
 import re
 
+# the type comments are only read by mypy; `typing` is not in Python 2
+MYPY = False
+if MYPY:  # pragma: no cover
+    from typing import Any  # noqa: F401
+
 
 # ==============================================================================
 
@@ -16,10 +21,101 @@ RE_space_tab_only = re.compile(r"^[\ \t]+$")
 RE_space_tab_p = re.compile(r"[\ \t]+")
 RE_whitespace_meh = re.compile(r"\n[\ \t]+(?![\d\*])")
 
+# trailing whitespace on every line; this is equivalent to
+#   "\n".join([i.rstrip() for i in text.split("\n")])
+# the lookbehind anchors a match to the start of a whitespace run, so long runs
+# of whitespace within a line are not rescanned from every position
+RE_trailing_whitespace = re.compile(r"(?<![^\S\n])[^\S\n]+$", re.M | re.U)
+
+# joins the text of many tokens, so each whitespace regex is run once over all
+# of them; the parsers drop NULL characters, so this can not appear in text
+TEXT_SENTINEL = "\x00"
+
+# if text does not match this, html5lib would parse it into a single text node
+# with its data unchanged: there are no tags or entities, and nothing for the
+# input stream to normalize (carriage returns, NULL characters)
+RE_markup_or_normalizable = re.compile(r"[<&\r\x00]")
+
+# browsers ignore whitespace and control characters within a url's scheme, so
+# `java\tscript:` is `javascript:`; these are removed before the scheme is read
+RE_url_ignored = re.compile(r"[`\x00-\x20\x7f-\xa0\s]+", re.U)
+RE_url_scheme = re.compile(r"^([a-z][a-z0-9+.\-]*):")
+
+# elements which are counted by the `max_blocks` option of `truncate_tokens`
+BLOCK_TAGS = frozenset(
+    (
+        "blockquote",
+        "div",
+        "h1",
+        "h2",
+        "h3",
+        "h4",
+        "h5",
+        "h6",
+        "hr",
+        "ol",
+        "p",
+        "pre",
+        "table",
+        "ul",
+    )
+)
+
+# the text of these elements is not rendered, so it is not counted by the
+# `max_chars` option of `truncate_tokens`
+UNCOUNTED_TAGS = frozenset(("script", "style"))
+
+# attributes that contain a url, which are checked against `allowed_protocols`
+URL_ATTRIBUTES = frozenset(("href", "src"))
+
 
 # ------------------------------------------------------------------------------
 
 
+class FragmentReader(object):
+    """
+    A minimal file-like object that serves `parts` as one stream of text.
+
+    html5lib reads its input in chunks, so wrapping text in a fragment
+    container with this does not create a concatenated copy of the text.
+    """
+
+    _parts = None  # type: Any
+    _idx = None  # type: Any
+    _pos = None  # type: Any
+
+    def __init__(self, *parts):
+        self._parts = parts
+        self._idx = 0
+        self._pos = 0
+
+    def read(self, size=-1):
+        _parts = self._parts
+        _chunks = []
+        while self._idx < len(_parts):
+            _part = _parts[self._idx]
+            _start = self._pos
+            if size < 0:
+                _chunk = _part[_start:]
+            else:
+                _end = _start + size
+                _chunk = _part[_start:_end]
+                size -= len(_chunk)
+            if _chunk:
+                _chunks.append(_chunk)
+            if _start + len(_chunk) < len(_part):
+                # we stopped within this part
+                self._pos += len(_chunk)
+                break
+            self._idx += 1
+            self._pos = 0
+            if size == 0:
+                break
+        if len(_chunks) == 1:
+            return _chunks[0]
+        return "".join(_chunks)
+
+
 # escaping attributes
 def safe_title(title):
     if title and '"' in title:
@@ -54,21 +150,477 @@ def is_list_upcoming(tokens):
     return False
 
 
-def clean_token_attributes(token, name=None, allowed_attributes=None):
+def copy_tokens(tokens):
+    """
+    copies a list of tokens, so they can be processed by ``to_markdown`` again.
+    ``to_markdown`` alters tokens and their attribute dicts in place, so those
+    are copied; the strings within them are immutable and shared.
+    """
+    _copied = []
+    for token in tokens:
+        token = token.copy()
+        _data = token.get("data")
+        if isinstance(_data, dict):
+            token["data"] = _data.copy()
+        _copied.append(token)
+    return _copied
+
+
+def fingerprint_tokens(tokens):
+    """
+    returns a hashable fingerprint of a list of walker tokens, which is equal
+    for equal tokens. This is computed before ``to_markdown`` alters them.
+    """
+    _fingerprint = []
+    for token in tokens:
+        _data = token.get("data")
+        if isinstance(_data, dict):
+            _data = tuple(_data.items())
+        _fingerprint.append((token["type"], token.get("name"), _data))
+    return tuple(_fingerprint)
+
+
+def _normalize_whitespace(text):
+    """
+    returns a tuple of `text` with its whitespace normalized, and normalized
+    as within a `p` or `div`, where newlines are spaces
+    """
+    # remove extraneous newlines
+    text = RE_newlines_3p.sub("\n\n", text)
+    # remove extraneous spaces/tabs
+    text = RE_space_tab_p.sub(" ", text)
+    # drop leading space, but avoid nested lists
+    text = RE_whitespace_meh.sub("\n", text)
+    text_block = text.replace("\n\n", " ").replace("\n", " ")
+    text_block = RE_space_tab_p.sub(" ", text_block)
+    return (text, text_block)
+
+
+def normalize_characters(tokens):
+    """
+    Normalizes the whitespace of every `Characters` token in `tokens`, as
+    ``to_markdown`` does. The text of all the tokens is joined by a sentinel,
+    so each regex is run once over the document instead of once per token.
+
+    The tokens are not altered.
+
+    :returns: a tuple of two lists parallel to `tokens`, which hold the
+    normalized text of each `Characters` token (or ``None``): as it appears
+    outside and within a `p` or `div`
+    """
+    normalized = [None] * len(tokens)
+    normalized_block = [None] * len(tokens)
+    _idxs = [idx for (idx, token) in enumerate(tokens) if token["type"] == "Characters"]
+    if not _idxs:
+        return (normalized, normalized_block)
+    _text = TEXT_SENTINEL.join([tokens[idx]["data"] for idx in _idxs])
+    if _text.count(TEXT_SENTINEL) == len(_idxs) - 1:
+        (_text, _text_block) = _normalize_whitespace(_text)
+        for (idx, _data, _data_block) in zip(
+            _idxs, _text.split(TEXT_SENTINEL), _text_block.split(TEXT_SENTINEL)
+        ):
+            normalized[idx] = _data
+            normalized_block[idx] = _data_block
+    else:
+        # the tokens did not come from a parser; normalize them one at a time
+        for idx in _idxs:
+            (normalized[idx], normalized_block[idx]) = _normalize_whitespace(
+                tokens[idx]["data"]
+            )
+    return (normalized, normalized_block)
+
+
+def coalesce_text_tokens(tokens, tags_kept, tags_sensitive=(), strip_comments=False):
+    """
+    Merges each run of `Characters` tokens which is only split by tags that
+    ``to_markdown`` drops, comments that it strips, and spaces, into a single
+    `Characters` token. The dropped tags within a run are removed, and the
+    tokens are not altered.
+
+    A run is not merged if it is within one of `tags_sensitive`, where
+    ``to_markdown`` renders the tags, or if it follows an `a` StartTag, as
+    that would change how the link is rendered. The first text is not merged
+    either, as the serializer unescapes the first word it renders. Spaces
+    which contain a newline are never merged, as ``to_markdown`` renders those
+    differently from the newlines in text, nor are spaces which are split by a
+    dropped tag, as each of those is rendered. Text which starts or ends with
+    other whitespace, such as a non-breaking space, is not merged either:
+    ``to_markdown`` strips it from each text token, so it must not end up
+    within the merged text.
+
+    :arg tokens: a list of walker tokens
+
+    :arg tags_kept: the tags which ``to_markdown`` renders; tags which are not
+    in this (and are not a bare link, such as `mailto:`) are dropped
+
+    :returns: a tuple of the coalesced list of tokens, and the number of
+    tokens that were merged away
+    """
+    coalesced = []
+    _depth = 0
+    _text = False
+    _idx = 0
+    _len = len(tokens)
+    while _idx < _len:
+        token = tokens[_idx]
+        _type = token["type"]
+        if _type != "Characters":
+            if (_type == "StartTag") or (_type == "EndTag"):
+                if token["name"] in tags_sensitive:
+                    if _type == "StartTag":
+                        _depth += 1
+                    elif _depth:
+                        _depth -= 1
+            coalesced.append(token)
+            _idx += 1
+            continue
+        _data = token["data"]
+        if (
+            _depth
+            or (not _text)
+            or (_data != _data.strip())
+            or (
+                (coalesced[-1]["type"] == "StartTag") and (coalesced[-1]["name"] == "a")
+            )
+        ):
+            _text = _text or not _depth
+            coalesced.append(token)
+            _idx += 1
+            continue
+        # find the last `Characters` token which can be merged into this one
+        _idx_end = _idx
+        _idx_next = _idx + 1
+        _space = False
+        while _idx_next < _len:
+            _token = tokens[_idx_next]
+            _type = _token["type"]
+            if _type == "Characters":
+                _data = _token["data"]
+                if _data != _data.strip():
+                    break
+                _idx_end = _idx_next
+                _space = False
+            elif (_type == "StartTag") or (_type == "EndTag"):
+                _name = _token["name"]
+                if (_name in tags_kept) or (":" in _name):
+                    break
+            elif _type == "SpaceCharacters":
+                # `to_markdown` renders each run of spaces and tabs as a space;
+                # `RE_space_tab_only` is not used, as its `$` matches before a
+                # trailing newline
+                if _space or _token["data"].strip(" \t"):
+                    break
+                _space = True
+            elif (_type != "Comment") or not strip_comments:
+                break
+            _idx_next += 1
+        if _idx_end == _idx:
+            coalesced.append(token)
+        else:
+            _idx_stop = _idx_end + 1
+            _data = [
+                _token["data"]
+                for _token in tokens[_idx:_idx_stop]
+                if _token["type"] in ("Characters", "SpaceCharacters")
+            ]
+            coalesced.append({"type": "Characters", "data": "".join(_data)})
+        _idx = _idx_end + 1
+    return (coalesced, _len - len(coalesced))
+
+
+def truncate_tokens(tokens, max_chars=None, max_blocks=None):
+    """
+    Generates `tokens` until either limit is reached, then closes every open
+    element and stops. `tokens` is consumed lazily, so nothing after the limit
+    is walked (or, with the stream backends, parsed).
+
+    :arg tokens: an iterable of balanced walker tokens
+
+    :arg int max_chars: the maximum number of text characters. The text is cut
+    on a word boundary when possible. Markdown syntax and html tags are not
+    counted, so the rendered output may be slightly longer.
+
+    :arg int max_blocks: the maximum number of blocks (paragraphs, headings,
+    lists, etc; see ``BLOCK_TAGS``). Only the innermost blocks are counted, so
+    a `div` that wraps the entire document does not count as a single block.
+    """
+    _open = []  # open StartTag tokens
+    _blocks = []  # for each open block: does it contain a counted block?
+    # StartTag and SpaceCharacters tokens are held until some content follows
+    # them, so the elements which were opened after the limit was reached are
+    # dropped instead of being rendered empty
+    _pending = []
+    _pending_starts = 0
+    _uncounted = 0
+    _chars = 0
+    _count = 0
+    _limited = False
+    for token in tokens:
+        _type = token["type"]
+        if _type == "StartTag":
+            _name = token["name"]
+            _open.append(token)
+            if _name in BLOCK_TAGS:
+                _blocks.append(False)
+            elif _name in UNCOUNTED_TAGS:
+                _uncounted += 1
+            _pending.append(token)
+            _pending_starts += 1
+            continue
+        elif _type == "SpaceCharacters":
+            _pending.append(token)
+            continue
+        elif _type == "Characters":
+            if max_chars is not None and not _uncounted:
+                _data = token["data"]
+                if _chars + len(_data) >= max_chars:
+                    _limited = True
+                    _cut = max_chars - _chars
+                    _head = _data[:_cut]
+                    if (
+                        (_cut < len(_data))
+                        and not _data[_cut].isspace()
+                        and not _head[-1:].isspace()
+                    ):
+                        # do not split a word. if the word is the only text
+                        # before the cut, nothing is kept
+                        _words = _head.rsplit(None, 1)
+                        _head = _words[0] if (len(_words) == 2) else ""
+                    _data = _head
+                    _data = _data.rstrip()
+                    if not _data:
+                        break
+                    token = token.copy()
+                    token["data"] = _data
+                _chars += len(_data)
+        elif _type == "EndTag":
+            _name = _open.pop()["name"]
+            if _name in BLOCK_TAGS:
+                if not _blocks.pop():
+                    _count += 1
+                if _blocks:
+                    _blocks[-1] = True
+                if (max_blocks is not None) and (_count >= max_blocks):
+                    _limited = True
+            elif _name in UNCOUNTED_TAGS:
+                _uncounted -= 1
+        elif (_type == "EmptyTag") and (token["name"] in BLOCK_TAGS):
+            _count += 1
+            if _blocks:
+                _blocks[-1] = True
+            if (max_blocks is not None) and (_count >= max_blocks):
+                _limited = True
+        if _pending:
+            for _token in _pending:
+                yield _token
+            _pending = []
+            _pending_starts = 0
+        yield token
+        if _limited:
+            break
+    else:
+        for _token in _pending:
+            yield _token
+        _pending_starts = 0
+    if _pending_starts:
+        # these elements were never yielded
+        del _open[-_pending_starts:]
+    while _open:
+        _token = _open.pop()
+        yield {
+            "type": "EndTag",
+            "name": _token["name"],
+            "namespace": _token.get("namespace"),
+        }
+
+
+def split_blocks(tokens, block_tags=BLOCK_TAGS):
+    """
+    Splits a list of balanced walker tokens into runs of top-level blocks,
+    which can be rendered independently and joined with a blank line.
+
+    A run only ends where a top-level element in `block_tags` is followed by
+    another, with nothing but whitespace between them. The exceptions are
+    rendered differently depending on the blocks around them, so they are
+    never split from their neighbors:
+
+    * adjacent lists, which are rendered as one
+    * a block that contains a blockquote
+    * a block that does not open with text, such as an empty block or a block
+      that opens with `code` (which may be rendered as a code block)
+
+    :arg list tokens: the walker tokens
+
+    :arg block_tags: the tags which are rendered as blocks
+
+    :returns: a list of lists of tokens
+    """
+    _runs = [[]]
+    _depth = 0
+    _last = None  # the top-level block that was just closed, if any
+    _content = False  # does the current run have any content yet?
+    _leading = False  # is the current top-level block the run's first content?
+    _opening = False  # is the current top-level block still opening?
+    _joined = False  # must the current top-level block be kept with its neighbors?
+    for token in tokens:
+        _type = token["type"]
+        if _depth:
+            if _type == "StartTag":
+                _depth += 1
+                if token["name"] == "blockquote":
+                    _joined = True
+                elif _opening and (token["name"] == "code"):
+                    _joined = True
+            elif _type == "EndTag":
+                _depth -= 1
+            elif (_type == "Characters") or (_type == "EmptyTag"):
+                _content = True
+            if _opening and (_type != "SpaceCharacters") and (_type != "StartTag"):
+                _opening = False
+                if _type != "Characters":
+                    _joined = True
+            _runs[-1].append(token)
+            if not _depth:
+                if _joined:
+                    if _leading and (len(_runs) > 1):
+                        _run = _runs.pop()
+                        _runs[-1].extend(_run)
+                    _last = None
+                elif token["name"] in block_tags:
+                    _last = token["name"]
+                else:
+                    _last = None
+            continue
+        if _type == "StartTag":
+            _name = token["name"]
+            if (
+                (_last is not None)
+                and (_name in block_tags)
+                and not ((_last in ("ul", "ol")) and (_name in ("ul", "ol")))
+            ):
+                _runs.append([])
+                _content = False
+            _depth = 1
+            _leading = not _content
+            _opening = True
+            _joined = _name == "blockquote"
+        elif _type != "SpaceCharacters":
+            _last = None
+            _content = True
+        _runs[-1].append(token)
+    return _runs
+
+
+def is_url_allowed(url, allowed_protocols=None):
+    """
+    Is the protocol of `url` in `allowed_protocols`?
+    Relative urls have no protocol and are always allowed.
+
+    :arg string url: the url
+    :arg list allowed_protocols: list of allowed protocols, such as "https".
+    if ``None``, every url is allowed.
+    """
+    if allowed_protocols is None or url is None:
+        return True
+    _scheme = RE_url_scheme.match(RE_url_ignored.sub("", url).lower())
+    if _scheme is None:
+        return True
+    return _scheme.group(1) in allowed_protocols
+
+
+def clean_style(style, allowed_styles):
+    """
+    Removes the declarations in a `style` attribute whose property is not in
+    `allowed_styles`.
+    """
+    _declarations = []
+    for _declaration in style.split(";"):
+        if ":" not in _declaration:
+            continue
+        (_property, _value) = _declaration.split(":", 1)
+        _property = _property.strip().lower()
+        if _property in allowed_styles:
+            _declarations.append("%s: %s;" % (_property, _value.strip()))
+    return " ".join(_declarations)
+
+
+def compile_allowed_tags(allowed_tags):
+    """
+    returns a list of tags as a ``frozenset``, for fast membership tests
+    """
+    if isinstance(allowed_tags, frozenset):
+        return allowed_tags
+    return frozenset(allowed_tags)
+
+
+def compile_allowed_attributes(allowed_attributes):
+    """
+    returns `allowed_attributes` with each tag's list of attributes compiled
+    into a ``frozenset``; callables are kept as-is. If every value is already
+    compiled, `allowed_attributes` is returned unchanged.
+    """
+    _compiled = {}
+    _changed = False
+    for (_tag, _allowed) in allowed_attributes.items():
+        if not (callable(_allowed) or isinstance(_allowed, frozenset)):
+            _allowed = frozenset(_allowed)
+            _changed = True
+        _compiled[_tag] = _allowed
+    return _compiled if _changed else allowed_attributes
+
+
+def clean_token_attributes(
+    token,
+    name=None,
+    allowed_attributes=None,
+    allowed_protocols=None,
+    allowed_styles=None,
+):
+    """
+    Removes the attributes of `token` which are not allowed.
+
+    The attributes are not deleted from the token's dict; a new dict of the
+    allowed attributes is built in a single pass, and replaces it.
+
+    :arg dict allowed_attributes: keys are tags, values are either a list of
+    attributes for that tag (ideally compiled by ``compile_allowed_attributes``),
+    or a callable which accepts the arguments `(tag, attribute, value)` and
+    returns ``True`` if the attribute is allowed.
+    :arg list allowed_protocols: see ``is_url_allowed``
+    :arg list allowed_styles: if not ``None``, the `style` attribute is
+    filtered to these properties with ``clean_style``
+    """
     if name is None:
         name = token.get("name")
     if "data" in token:
-        if name in allowed_attributes:
-            _data = token["data"]
-            for _key in list(_data.keys()):
-                # _key = `(namespace, name)`
-                # usually this is `(None, name)`
-                if _key[1] not in allowed_attributes[name]:
-                    del _data[_key]
-                else:
-                    _data[_key] = _data[_key].strip()
-        else:
+        _allowed = allowed_attributes.get(name)
+        if _allowed is None:
             token["data"] = {}
+            return token
+        _data = token["data"]
+        if not _data:
+            return token
+        _allowed_callable = callable(_allowed)
+        _cleaned = _data.__class__()
+        for (_key, _value) in _data.items():
+            # _key = `(namespace, name)`
+            # usually this is `(None, name)`
+            _attribute = _key[1]
+            if _allowed_callable:
+                if not _allowed(name, _attribute, _value):
+                    continue
+            elif _attribute not in _allowed:
+                continue
+            _value = _value.strip()
+            if _attribute in URL_ATTRIBUTES:
+                if not is_url_allowed(_value, allowed_protocols):
+                    continue
+            elif (_attribute == "style") and (allowed_styles is not None):
+                _value = clean_style(_value, allowed_styles)
+                if not _value:
+                    continue
+            _cleaned[_key] = _value
+        token["data"] = _cleaned
     return token
 
 
@@ -2,11 +2,33 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 # stdlib
+from collections import OrderedDict
+import contextlib
 import os
+import sys
 import unittest
+import warnings
+
+# pypi
+import html5lib
+from six import StringIO
 
 # local
+from html5lib_to_markdown.markdown_info import MARKDOWN_PROTOCOLS
+from html5lib_to_markdown.markdown_info import MARKDOWN_TAGS_PRUNE
+from html5lib_to_markdown.transformer import copy_prepared
+from html5lib_to_markdown.transformer import prepare_tokens
+from html5lib_to_markdown.transformer import to_markdown
 from html5lib_to_markdown.transformer import Transformer
+from html5lib_to_markdown.utils import coalesce_text_tokens
+from html5lib_to_markdown.utils import FragmentReader
+from html5lib_to_markdown.utils import normalize_characters
+from html5lib_to_markdown.utils import RE_trailing_whitespace
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
 
 
 # ==============================================================================
@@ -54,6 +76,20 @@ def _get_test_data_alt(filestring, alt):
     return _md
 
 
+@contextlib.contextmanager
+def _captured_stdout():
+    """
+    yields a ``StringIO`` which replaces `sys.stdout` within the block;
+    ``contextlib.redirect_stdout`` is not in Python 2
+    """
+    _stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = _stdout
+
+
 # ==============================================================================
 
 
@@ -76,8 +112,14 @@ class _TestTransformations(object):
 
     """
 
+    # the `Transformer` backend/treebuilder; ``None`` uses the default
+    _backend = None
+    _treebuilder = None
+
     def _makeOne(self, **kwargs_override):
         kwargs_default = {
+            "backend": self._backend,
+            "treebuilder": self._treebuilder,
             "a_as_tag": False,
             "a_simple_links": False,
             "img_as_tag": False,
@@ -350,7 +392,992 @@ class TestHtmlToMarkdown(unittest.TestCase, _TestTransformations):
     _test_actual = _TestTransformations._test_html_to_markdown
 
 
+class TestHtmlToMarkdownStdlib(unittest.TestCase, _TestTransformations):
+    """
+    the stdlib ``html.parser`` backend must render the fixtures identically
+    """
+
+    _backend = "html.parser"
+    _test_actual = _TestTransformations._test_html_to_markdown
+
+
+class TestHtmlToMarkdownTokenizer(unittest.TestCase, _TestTransformations):
+    """
+    the "html5lib-tokenizer" backend must render the fixtures identically
+    """
+
+    _backend = "html5lib-tokenizer"
+    _test_actual = _TestTransformations._test_html_to_markdown
+
+
+class TestHtmlToMarkdownDom(unittest.TestCase, _TestTransformations):
+    """
+    the "dom" treebuilder must render the fixtures identically
+    """
+
+    _treebuilder = "dom"
+    _test_actual = _TestTransformations._test_html_to_markdown
+
+
+@unittest.skipIf(lxml is None, "lxml is not installed")
+class TestHtmlToMarkdownLxml(unittest.TestCase, _TestTransformations):
+    """
+    the "lxml" treebuilder must render the fixtures identically
+    """
+
+    _treebuilder = "lxml"
+    _test_actual = _TestTransformations._test_html_to_markdown
+
+
 if False:
 
     class TestMarkdownToMarkdown(unittest.TestCase, _TestTransformations):
         _test_actual = _TestTransformations._test_markdown_to_markdown
+
+
+class TestPlaintextFastpath(unittest.TestCase):
+    """
+    markup-free text bypasses html5lib; the output must be identical
+    """
+
+    def _makeTransformers(self):
+        transformer = Transformer(a_as_tag=False, img_as_tag=False)
+        transformer_parsed = Transformer(a_as_tag=False, img_as_tag=False)
+        transformer_parsed._plaintext_fastpath = False
+        return (transformer, transformer_parsed)
+
+    def test_fixtures(self):
+        (transformer, transformer_parsed) = self._makeTransformers()
+        _tested = 0
+        for _fname in sorted(os.listdir(_dir_fixtures)):
+            with open(os.path.join(_dir_fixtures, _fname), "r") as fh:
+                _text = fh.read()
+            if ("<" in _text) or ("&" in _text):
+                continue
+            _tested += 1
+            self.assertEqual(
+                transformer_parsed.transform(_text), transformer.transform(_text)
+            )
+        self.assertTrue(_tested)
+
+    def test_whitespace(self):
+        (transformer, transformer_parsed) = self._makeTransformers()
+        for _text in (
+            " ",
+            "\n\n\n",
+            "  leading and trailing  \n",
+            "a\n\n\n\nb",
+            "a \t b\n  c\n\t\n d",
+            "> quoted\n> text\n\n>> nested",
+            "* one\n  * two\n\n1. three",
+            "    indented\n    code",
+            "x > y",
+        ):
+            self.assertEqual(
+                transformer_parsed.transform(_text), transformer.transform(_text)
+            )
+
+
+class TestFragment(unittest.TestCase):
+    """
+    fragments keep the content which html5lib moves out of a `table`, with
+    every tree builder
+    """
+
+    def _treebuilders(self):
+        return ("etree", "dom") if lxml is None else ("etree", "dom", "lxml")
+
+    def test_table_foster_parenting(self):
+        for _treebuilder in self._treebuilders():
+            transformer = Transformer(treebuilder=_treebuilder)
+            for (_html, _expected) in (
+                ("<table><code>q</code><p>h</p></table>", "`q`\n\nh"),
+                ("<p>x</p><table>hello<p>y</p></table>", "x\n\nhello\n\ny"),
+                (
+                    "<table><tr><td>a</td></tr><b>b</b></table>",
+                    "**b**\n\n<table><tbody><tr><td>a</td></tr></tbody></table>",
+                ),
+            ):
+                self.assertEqual(transformer.transform(_html), _expected)
+
+    def test_unclosed(self):
+        """the wrapper's end tag is not swallowed by an unclosed node"""
+        for _treebuilder in self._treebuilders():
+            transformer = Transformer(
+                treebuilder=_treebuilder, strip_comments=False, strip_scripts=False
+            )
+            for (_html, _expected) in (
+                ("a <!-- b", "a <!-- b-->"),
+                ("<p>a<script>x", "a\n\n<script>x</script>"),
+                ("<textarea>q", "q"),
+            ):
+                self.assertEqual(transformer.transform(_html), _expected)
+
+
+class TestNormalizeWhitespace(unittest.TestCase):
+    def test_trailing_whitespace(self):
+        for _text in (
+            "",
+            "a",
+            "a \nb\t\n c \t",
+            " \n\n \t \n",
+            "a  b  \x0c\n\n",
+            "a\r\nb\r\n",
+            "a\xa0\nb　",
+        ):
+            self.assertEqual(
+                "\n".join([i.rstrip() for i in _text.split("\n")]),
+                RE_trailing_whitespace.sub("", _text),
+            )
+
+    def test_fragment_reader(self):
+        _parts = ("<w>", "abcdef", "", "</w>")
+        self.assertEqual(FragmentReader(*_parts).read(), "<w>abcdef</w>")
+        for _size in (1, 2, 3, 4, 7, 100):
+            reader = FragmentReader(*_parts)
+            _chunks = []
+            while True:
+                _chunk = reader.read(_size)
+                if not _chunk:
+                    break
+                self.assertLessEqual(len(_chunk), _size)
+                _chunks.append(_chunk)
+            self.assertEqual("".join(_chunks), "<w>abcdef</w>")
+        self.assertEqual(FragmentReader().read(), "")
+
+    def test_normalize_characters(self):
+        _texts = (
+            "",
+            "a",
+            " a  \t b ",
+            "a\n\n\n\nb",
+            "a\n  b\n  1. c\n  * d",
+            "\n \n",
+            "a\n\nb\nc",
+        )
+        tokens = [{"type": "Characters", "data": _text} for _text in _texts]
+        tokens.insert(2, {"type": "SpaceCharacters", "data": "\n  "})
+        _expected = (
+            [
+                "",
+                "a",
+                None,
+                " a b ",
+                "a\n\nb",
+                "a\nb\n 1. c\n * d",
+                "\n\n",
+                "a\n\nb\nc",
+            ],
+            ["", "a", None, " a b ", "a b", "a b 1. c * d", " ", "a b c"],
+        )
+        self.assertEqual(normalize_characters(tokens), _expected)
+        # a sentinel within the text is normalized token by token
+        _tokens = tokens + [{"type": "Characters", "data": "a\x00"}]
+        self.assertEqual(
+            normalize_characters(_tokens),
+            (_expected[0] + ["a\x00"], _expected[1] + ["a\x00"]),
+        )
+        self.assertEqual(
+            normalize_characters(tokens[4:7]),
+            (
+                ["a\n\nb", "a\nb\n 1. c\n * d", "\n\n"],
+                ["a b", "a b 1. c * d", " "],
+            ),
+        )
+
+
+class TestCoalesceText(unittest.TestCase):
+    def _tokens(self, html):
+        return list(Transformer(backend="html5lib-tokenizer")._tokenize(html))
+
+    def test_coalesce(self):
+        tokens = self._tokens(
+            "<p>first</p><p>a <span>b</span> <font>c</font>d<!-- e --> f</p>"
+        )
+        (_coalesced, _merged) = coalesce_text_tokens(
+            tokens, frozenset(("p",)), strip_comments=True
+        )
+        self.assertEqual(_merged, 12)
+        self.assertEqual(
+            [(token["type"], token.get("data")) for token in _coalesced[3:5]],
+            [("StartTag", {}), ("Characters", "a b cd f")],
+        )
+        # the comment is not stripped
+        (_coalesced, _merged) = coalesce_text_tokens(tokens, frozenset(("p",)))
+        self.assertEqual(_coalesced[4]["data"], "a b cd")
+
+    def test_not_coalesced(self):
+        for _html in (
+            # the first text
+            "a<span>b</span>",
+            # spaces split by a dropped tag, or with a newline
+            "<p>x</p>a <span> b</span>",
+            "<p>x</p>a\n<span>b</span>",
+            # within a sensitive tag
+            "<p>x</p><pre>a<span>b</span></pre>",
+            # link text
+            "<p>x</p><a href='/'>a<span>b</span></a>",
+            # a non-breaking space at the edge of the text, which is stripped
+            "<p>x</p>a<span>\xa0b</span>",
+            "<p>x</p>a\xa0<span>b</span>",
+            # a space with a newline after a tab
+            "<p>x</p>a\t\n<span>b</span>",
+        ):
+            tokens = self._tokens(_html)
+            (_coalesced, _merged) = coalesce_text_tokens(
+                tokens, frozenset(("a", "p", "pre")), tags_sensitive=("pre",)
+            )
+            self.assertEqual(_merged, 0, _html)
+            self.assertEqual(_coalesced, tokens)
+
+    def test_transform(self):
+        transformer = Transformer(strip_comments=True)
+        for (_html, _expected) in (
+            ("<p>a <span>b</span> <font>c</font>d<!-- e --> f</p>", "a b cd f"),
+            ("<p>a <span>b</span> <span> c</span></p>", "a b  c"),
+            ("<p>a <a href='/x'>b<span>c</span>d</a></p>", 'a <a href="/x">bcd</a>'),
+            ("<p>x <code>a<span>b</span></code></p>", "x `a<span>b</span>`"),
+            # the non-breaking space is stripped from its own text token, as it
+            # was before text was coalesced, next to any dropped tag
+            ("x<span>a</span>&nbsp;c", "xac"),
+            ("x<span>a<span>b</span>&nbsp;</span>c", "xabc"),
+            ("x<b>a</b>&nbsp;c", "x**a**c"),
+            ("<p>a</p><font>b<sup>c</sup>\t\n<sup>d</sup></font>", "a\n\nbc\nd"),
+        ):
+            self.assertEqual(transformer.transform(_html), _expected)
+
+    def test_stats(self):
+        transformer = Transformer()
+        tokens = list(transformer._tokenize("<p>x</p><p>a<span>b</span>c</p>"))
+        stats = {}
+        to_markdown(tokens, stats=stats)
+        self.assertEqual(
+            stats, {"tokens": 10, "tokens_coalesced": 4, "coalesce_ratio": 0.4}
+        )
+
+
+class TestTransformVariants(unittest.TestCase):
+    variants = OrderedDict(
+        (
+            ("site", {"a_as_tag": True, "img_as_tag": True}),
+            # this drops the comment, so it prepares its own tokens
+            (
+                "plain",
+                {"a_as_tag": False, "img_as_tag": False, "strip_comments": True},
+            ),
+            (
+                "feed",
+                {
+                    "a_as_tag": False,
+                    "img_as_tag": False,
+                    "a_simple_links": False,
+                    "reference_style_link": True,
+                    "reference_style_img": True,
+                },
+            ),
+        )
+    )
+    html = '<p>a <a href="/x">b</a> <img src="/i.png" alt="i"/><!-- c --></p><p>d</p>'
+
+    def test_variants(self):
+        transformer = Transformer()
+        self.assertEqual(
+            transformer.transform_variants(self.html, self.variants),
+            {
+                "site": 'a <a href="/x">b</a> <img alt="i" src="/i.png"><!-- c -->'
+                "\n\nd",
+                "plain": "a [b](/x) ![i](/i.png)\n\nd",
+                "feed": "a [b][1] [i][2]<!-- c -->\n\nd\n\n[1]: /x\n[2]: /i.png",
+            },
+        )
+        # the variants do not alter each other's tokens
+        rendered = transformer.transform_variants(
+            self.html, dict(self.variants, again=self.variants["site"])
+        )
+        self.assertEqual(rendered["again"], rendered["site"])
+
+    def test_bare_links(self):
+        # `a_as_tag` is toggled over a base which does not render simple links
+        html = "<p>a <https://example.com/x> <mailto:b@example.com> c</p>"
+        variants = {"tag": {"a_as_tag": True}, "markdown": {"a_as_tag": False}}
+        transformer = Transformer(a_simple_links=False)
+        self.assertEqual(
+            transformer.transform_variants(html, variants),
+            {
+                "tag": 'a <a href="https://example.com/x">https://example.com/x</a>'
+                ' <a href="mailto:b@example.com">b@example.com</a> c',
+                "markdown": "a [https://example.com/x](https://example.com/x)"
+                " [b@example.com](mailto:b@example.com) c",
+            },
+        )
+        for (_name, _options) in variants.items():
+            _transformer = Transformer(a_simple_links=False, **_options)
+            self.assertEqual(
+                transformer.transform_variants(html, variants)[_name],
+                _transformer.transform(html),
+            )
+
+    def test_truncated(self):
+        transformer = Transformer(max_blocks=1)
+        rendered = transformer.transform_variants(self.html, self.variants)
+        self.assertEqual(rendered["plain"], "a [b](/x) ![i](/i.png)")
+        self.assertEqual(
+            rendered["feed"], "a [b][1] [i][2]<!-- c -->\n\n[1]: /x\n[2]: /i.png"
+        )
+
+    def test_prepared(self):
+        tokens = list(Transformer()._tokenize(self.html))
+        prepared = prepare_tokens(tokens)
+        _expected = "a [b][1] [i][2]<!-- c -->"
+        for _prepared in (copy_prepared(prepared), prepared):
+            _rendered = Transformer()._serializer.render(
+                to_markdown(
+                    None,
+                    a_as_tag=False,
+                    img_as_tag=False,
+                    reference_style_link=True,
+                    reference_style_img=True,
+                    prepared=_prepared,
+                )
+            )
+            self.assertTrue(_rendered.startswith(_expected), _rendered)
+
+    def test_empty(self):
+        transformer = Transformer()
+        self.assertEqual(
+            transformer.transform_variants("", self.variants),
+            {"site": "", "feed": "", "plain": ""},
+        )
+
+    def test_invalid_option(self):
+        transformer = Transformer()
+        with self.assertRaises(ValueError):
+            transformer.transform_variants("<p>a</p>", {"bad": {"serializer": None}})
+
+
+class TestRenderTree(unittest.TestCase):
+    """
+    rendering a tree parsed by html5lib must match ``transform``
+    """
+
+    def _test_treebuilder(self, treebuilder):
+        transformer = Transformer()
+        for _fname in sorted(os.listdir(_dir_fixtures)):
+            if not _fname.endswith(".html"):
+                continue
+            with open(os.path.join(_dir_fixtures, _fname), "r") as fh:
+                _html = fh.read()
+            _expected = transformer.transform(_html)
+            # `transform` normalizes the html before parsing
+            _html = RE_trailing_whitespace.sub("", _html)
+            with warnings.catch_warnings():
+                # the lxml treebuilder warns when it coerces invalid XML names
+                warnings.simplefilter("ignore")
+                _document = html5lib.parse(_html, treebuilder=treebuilder)
+                _fragment = html5lib.parseFragment(_html, treebuilder=treebuilder)
+            self.assertEqual(_expected, transformer.render_tree(_document))
+            self.assertEqual(_expected, transformer.render_tree(_fragment))
+
+    def test_etree(self):
+        self._test_treebuilder("etree")
+
+    def test_dom(self):
+        self._test_treebuilder("dom")
+
+    @unittest.skipIf(lxml is None, "lxml is not installed")
+    def test_lxml(self):
+        self._test_treebuilder("lxml")
+
+    def test_document_head(self):
+        transformer = Transformer()
+        _document = html5lib.parse(
+            "<html><head><title>t</title></head><body><p>a</p></body></html>"
+        )
+        self.assertEqual(transformer.render_tree(_document), "a")
+
+
+class TestSanitize(unittest.TestCase):
+    html = (
+        '<p><a href="java\tscript:alert(1)">x</a> <a href="/path">y</a> '
+        '<a href="https://example.com" onclick="alert(1)">z</a> '
+        '<img src="javascript:alert(1)" alt="a"><img src="https://example.com/i.png">'
+        "</p>"
+    )
+
+    def test_protocols_tag(self):
+        transformer = Transformer(allowed_protocols=MARKDOWN_PROTOCOLS)
+        self.assertEqual(
+            transformer.transform(self.html),
+            '<a>x</a> <a href="/path">y</a> <a href="https://example.com">z</a> '
+            '<img alt="a"><img src="https://example.com/i.png">',
+        )
+
+    def test_protocols_markdown(self):
+        transformer = Transformer(
+            a_as_tag=False, img_as_tag=False, allowed_protocols=MARKDOWN_PROTOCOLS
+        )
+        self.assertEqual(
+            transformer.transform(self.html),
+            "x [y](/path) [z](https://example.com) ![Image](https://example.com/i.png)",
+        )
+
+    def test_attributes_callable(self):
+        def _allowed(tag, attribute, value):
+            return attribute.startswith("data-") or (attribute == "style")
+
+        transformer = Transformer(
+            allowed_tags_attributes={"td": _allowed}, allowed_styles=["color"]
+        )
+        self.assertEqual(
+            transformer.transform(
+                '<table><tr><td id="a" data-b="c" style="color: red; position: fixed">'
+                "d</td></tr></table>"
+            ),
+            '<table><tbody><tr><td data-b="c" style="color: red;">d</td></tr>'
+            "</tbody></table>",
+        )
+
+    def test_compiled_allowlists(self):
+        transformer = Transformer(
+            allowed_tags=["table", "tr", "td"],
+            allowed_tags_attributes={"a": ["href"], "td": ["class"]},
+        )
+        self.assertIsInstance(transformer.allowed_tags, frozenset)
+        self.assertIsInstance(transformer.allowed_tags_attributes["a"], frozenset)
+        self.assertEqual(
+            transformer.transform(
+                '<a href="/a" title="b" data-c="d">e</a><table><tr>'
+                '<td class="f" data-g="h">i</td></tr></table>'
+            ),
+            '<a href="/a">e</a>\n\n<table><tr><td class="f">i</td></tr></table>',
+        )
+
+    def test_strip_styles(self):
+        _html = "<style>p { color: red; }</style><p>a</p>"
+        self.assertEqual(Transformer(strip_styles=True).transform(_html), "a")
+        self.assertEqual(Transformer().transform(_html), "p { color: red; }\n\na")
+
+
+class TestPrune(unittest.TestCase):
+    html = (
+        '<p>a <script>var b = "<p>c</p>";</script>d</p>'
+        '<p>e<svg><title>f</title><path d="g"/></svg> h</p>'
+        '<div class="ad">i <b>j</b></div><p>k<img src="/l.png" class="ad">m</p>'
+    )
+    expected = "a d\n\ne h\n\nkm"
+
+    def _prune(self, tag, attributes):
+        return attributes.get("class") == "ad"
+
+    def _makeOne(self, **kwargs):
+        return Transformer(prune_tags=MARKDOWN_TAGS_PRUNE, prune=self._prune, **kwargs)
+
+    def test_backends(self):
+        for _backend in ("html5lib", "html5lib-tokenizer", "html.parser"):
+            transformer = self._makeOne(backend=_backend)
+            self.assertEqual(transformer.transform(self.html), self.expected)
+
+    def test_treebuilders(self):
+        for _treebuilder in ("etree", "dom", "lxml"):
+            if (_treebuilder == "lxml") and (lxml is None):
+                continue
+            transformer = self._makeOne(treebuilder=_treebuilder)
+            self.assertEqual(transformer.transform(self.html), self.expected)
+
+    def test_render_tree(self):
+        transformer = self._makeOne()
+        _fragment = html5lib.parseFragment(self.html)
+        self.assertEqual(transformer.render_tree(_fragment), self.expected)
+        # the caller's tree is not altered
+        self.assertNotEqual(Transformer().render_tree(_fragment), self.expected)
+
+
+class TestRoot(unittest.TestCase):
+    html = (
+        '<nav><a href="/">home</a></nav><div id="page">'
+        '<article class="post main" role="main"><h1>title</h1><p>a <b>b</b></p>'
+        '<div class="body"><p>c</p></div></article>'
+        "<aside><p>d</p></aside></div>"
+        '<div class="body"><p>e</p></div>'
+    )
+
+    def test_selectors(self):
+        for _backend in ("html5lib", "html5lib-tokenizer", "html.parser"):
+            transformer = Transformer(backend=_backend)
+            for (_root, _expected) in (
+                ("article", "# title\n\na **b**\n\nc"),
+                ("#page article", "# title\n\na **b**\n\nc"),
+                ("div#page > .post.main", "# title\n\na **b**\n\nc"),
+                ('[role="main"]', "# title\n\na **b**\n\nc"),
+                ("article > .body", "c"),
+                ("#page > .body", ""),
+                ("aside p", "d"),
+                ("p", "a **b**"),
+                ("section", ""),
+            ):
+                self.assertEqual(
+                    transformer.transform(self.html, root=_root), _expected
+                )
+
+    def test_render_tree(self):
+        transformer = Transformer()
+        _document = html5lib.parse("<html><body>%s</body></html>" % self.html)
+        self.assertEqual(transformer.render_tree(_document, root="aside"), "d")
+        self.assertEqual(transformer.render_tree(_document, root="body > .body"), "e")
+
+    def test_invalid(self):
+        transformer = Transformer()
+        for _root in ("", "a, b", "> a", "a >", "#", '[a="b]', "a:first-child"):
+            with self.assertRaises(ValueError):
+                transformer.transform(self.html, root=_root)
+
+
+class TestPreview(unittest.TestCase):
+    html = (
+        '<div id="content"><h1>Title here</h1>'
+        "<p>First <b>bold words in here</b> and <i>italic</i> text.</p>"
+        "<blockquote><p>quoted one</p><ul><li>item <code>code span</code></li>"
+        "<li>two</li></ul></blockquote><p>last</p></div>"
+    )
+
+    def test_max_blocks(self):
+        for _backend in ("html5lib", "html5lib-tokenizer", "html.parser"):
+            for (_max_blocks, _expected) in (
+                (1, "# Title here"),
+                (
+                    3,
+                    "# Title here\n\nFirst **bold words in here** and _italic_ text.\n\n> quoted one",
+                ),
+                (
+                    4,
+                    "# Title here\n\nFirst **bold words in here** and _italic_ text.\n\n> quoted one\n> \n> * item `code span`\n> * two",
+                ),
+            ):
+                transformer = Transformer(backend=_backend, max_blocks=_max_blocks)
+                self.assertEqual(transformer.transform(self.html), _expected)
+
+    def test_max_output_chars(self):
+        for _backend in ("html5lib", "html5lib-tokenizer", "html.parser"):
+            for (_max_output_chars, _expected) in (
+                (5, "# Title"),
+                (20, "# Title here\n\nFirst **bold**"),
+                (40, "# Title here\n\nFirst **bold words in here** and"),
+                (
+                    60,
+                    "# Title here\n\nFirst **bold words in here** and _italic_ text.\n\n> quoted one",
+                ),
+                (
+                    65,
+                    "# Title here\n\nFirst **bold words in here** and _italic_ text.\n\n> quoted one\n> \n> * item `code`",
+                ),
+            ):
+                transformer = Transformer(
+                    backend=_backend, max_output_chars=_max_output_chars
+                )
+                self.assertEqual(transformer.transform(self.html), _expected)
+
+    def test_max_output_chars_whitespace(self):
+        # the text before the cut is only whitespace, or leading whitespace and
+        # part of a word; no partial word is rendered
+        for _backend in ("html5lib", "html5lib-tokenizer", "html.parser"):
+            for (_html, _max_output_chars, _expected) in (
+                ("<p>\xa0\xa0abc def</p>", 2, ""),
+                ("<p>\xa0\xa0abc def</p>", 4, ""),
+                ("<p> abc def</p>", 2, ""),
+                ("<p> abc def</p>", 5, "abc"),
+                ("<p>ab cdef</p>", 4, "ab"),
+            ):
+                transformer = Transformer(
+                    backend=_backend, max_output_chars=_max_output_chars
+                )
+                self.assertEqual(transformer.transform(_html), _expected)
+
+    def test_no_limit(self):
+        transformer = Transformer(max_output_chars=1000, max_blocks=100)
+        self.assertEqual(
+            transformer.transform(self.html), Transformer().transform(self.html)
+        )
+
+    def test_code_ends_document(self):
+        # a preview can end with code, which must still be closed
+        transformer = Transformer()
+        self.assertEqual(transformer.transform("<code>lorem</code>"), "`lorem`")
+        self.assertEqual(transformer.transform("a <code>lorem</code>"), "a `lorem`")
+
+
+class TestParallel(unittest.TestCase):
+    """
+    ``transform_parallel`` must render exactly like ``transform``
+    """
+
+    options = (
+        {},
+        {"div_as_block": False, "strip_comments": True},
+        {
+            "a_as_tag": False,
+            "img_as_tag": False,
+            "a_simple_links": False,
+            "reference_style_link": True,
+            "reference_style_img": True,
+        },
+    )
+
+    _html = (
+        "<h1>t</h1>\n<ul><li>a</li><li>b</li></ul>\n<pre>c\n d</pre>\n"
+        "<p>e <b>f</b></p>\n<blockquote><p>g</p></blockquote>"
+    )
+    _expected = "# t\n\n* a\n* b\n\n<pre>c\n d</pre>\n\ne **f**\n\n> g"
+
+    def test_runs(self):
+        transformer = Transformer()
+        self.assertEqual(
+            len(transformer._split_runs(transformer._tokenize(self._html))), 4
+        )
+        self.assertEqual(
+            transformer.transform_parallel(self._html, processes=1), self._expected
+        )
+        # only the top-level blocks are split
+        _wrapped = "<article>%s</article>" % self._html
+        self.assertEqual(
+            len(transformer._split_runs(transformer._tokenize(_wrapped))), 1
+        )
+        self.assertEqual(
+            transformer.transform_parallel(_wrapped, processes=1), self._expected
+        )
+
+    def test_pool(self):
+        transformer = Transformer()
+        self.assertEqual(
+            transformer.transform_parallel(self._html, processes=2), self._expected
+        )
+        pool = transformer._pool
+        self.assertEqual(
+            transformer.transform_parallel(self._html, processes=2), self._expected
+        )
+        self.assertIs(transformer._pool, pool)
+        # another number of processes replaces the pool
+        self.assertEqual(
+            transformer.transform_parallel(self._html, processes=3), self._expected
+        )
+        self.assertIsNot(transformer._pool, pool)
+        transformer.close()
+        self.assertIsNone(transformer._pool)
+        transformer.close()
+
+    def test_context_manager(self):
+        with Transformer() as transformer:
+            self.assertEqual(
+                transformer.transform_parallel(self._html, processes=2),
+                self._expected,
+            )
+            self.assertIsNotNone(transformer._pool)
+        self.assertIsNone(transformer._pool)
+
+    def test_references(self):
+        _html = (
+            '<p><a href="/a">one</a> <a href="/b" title="B">two</a></p>\n'
+            '<p><a href="/c">three</a> <a href="/a">four</a></p>\n'
+            '<p><img src="/b" alt="five"></p>\n<hr>'
+        )
+        transformer = Transformer(**self.options[2])
+        _expected = (
+            "[one][1] [two][2]\n\n[three][3] [four][1]\n\n[five][2]\n\n---\n\n"
+            '[1]: /a\n[2]: /b "B"\n[3]: /c'
+        )
+        self.assertEqual(transformer.transform(_html), _expected)
+        self.assertEqual(transformer.transform_parallel(_html, processes=1), _expected)
+        self.assertEqual(transformer.transform_parallel(_html, processes=2), _expected)
+        transformer.close()
+
+    def test_references_none(self):
+        # the options render references, so the last run is rendered with the
+        # footer; without any, it is rendered again, as it ends differently
+        transformer = Transformer(**self.options[2])
+        _html = "<p>a</p>\n<p>c</p>\n<blockquote><p>b</p><blockquote> <br></blockquote></blockquote>"
+        for _processes in (1, 2):
+            self.assertEqual(
+                transformer.transform_parallel(_html, processes=_processes),
+                "a\n\nc\n\n> b\n> ",
+            )
+        transformer.close()
+
+    def test_empty(self):
+        transformer = Transformer()
+        self.assertEqual(transformer.transform_parallel(""), "")
+        self.assertEqual(transformer.transform_parallel("<p>a</p>"), "a")
+
+
+class TestIncremental(unittest.TestCase):
+    """
+    ``IncrementalTransform`` must render exactly like ``transform``, and only
+    render the runs of blocks which changed
+    """
+
+    _html = "".join(
+        "<h2>Section %s</h2>\n<p>Paragraph %s.</p>\n<ul><li>item %s</li></ul>\n"
+        % (i, i, i)
+        for i in range(10)
+    )
+
+    def test_reuse(self):
+        incremental = Transformer().incremental()
+        _expected = TestParallel._expected
+        self.assertEqual(incremental.transform(TestParallel._html), _expected)
+        self.assertEqual(incremental.runs_rendered, 4)
+        # the second call reuses every run
+        self.assertEqual(incremental.transform(TestParallel._html), _expected)
+        self.assertEqual(incremental.runs_rendered, 0)
+        self.assertEqual(incremental.runs_reused, 4)
+
+    def test_edit(self):
+        transformer = Transformer()
+        incremental = transformer.incremental()
+        incremental.transform(self._html)
+        self.assertEqual(incremental.runs_reused, 0)
+        _edited = self._html.replace("Paragraph 5.", "Paragraph <b>five</b>.")
+        self.assertEqual(incremental.transform(_edited), transformer.transform(_edited))
+        self.assertEqual(incremental.runs_rendered, 1)
+        self.assertEqual(incremental.runs_reused, 29)
+
+    def test_references(self):
+        transformer = Transformer(**TestParallel.options[2])
+        incremental = transformer.incremental()
+        _html = self._html.replace(
+            "Paragraph 8.", '<a href="/b">Paragraph 8</a>.'
+        ).replace("</li></ul>\n", "</li></ul>\n<blockquote><hr></blockquote>")
+        self.assertEqual(incremental.transform(_html), transformer.transform(_html))
+        # a link is added before the existing one, so it is renumbered
+        _edited = _html.replace("Paragraph 2.", '<a href="/a">Paragraph 2</a>.')
+        _expected = transformer.transform(_edited)
+        self.assertIn("[Paragraph 2][1]", _expected)
+        self.assertIn("[Paragraph 8][2]", _expected)
+        self.assertEqual(incremental.transform(_edited), _expected)
+        self.assertEqual(incremental.runs_rendered, 1)
+        # and removed again; only the previous version is kept
+        self.assertEqual(incremental.transform(_html), transformer.transform(_html))
+        self.assertEqual(incremental.runs_rendered, 1)
+
+    def test_references_none(self):
+        incremental = Transformer(**TestParallel.options[2]).incremental()
+        _html = "<p>a</p>\n<p>c</p>\n<blockquote><p>b</p><blockquote> <br></blockquote></blockquote>"
+        self.assertEqual(incremental.transform(_html), "a\n\nc\n\n> b\n> ")
+        # the last run was rendered with the footer, then without it
+        self.assertEqual(incremental.runs_rendered, 3)
+        self.assertEqual(incremental.transform(_html), "a\n\nc\n\n> b\n> ")
+        self.assertEqual(incremental.runs_rendered, 0)
+
+
+class TestBlockCache(unittest.TestCase):
+    """
+    ``Transformer(block_cache=)`` must render exactly like ``transform``, and
+    render boilerplate that repeats across documents only once
+    """
+
+    def test_cached(self):
+        transformer = Transformer(block_cache=100)
+        self.assertEqual(
+            transformer.transform(TestParallel._html), TestParallel._expected
+        )
+        self.assertEqual(
+            transformer.transform(TestParallel._html), TestParallel._expected
+        )
+        self.assertEqual(transformer.block_cache.misses, 4)
+        self.assertEqual(transformer.block_cache.hits, 4)
+
+    def test_references(self):
+        # the last run is cached with the footer, and again without it for a
+        # document without references
+        transformer = Transformer(block_cache=100, **TestParallel.options[2])
+        for (_html, _expected, _hits, _misses) in (
+            (
+                '<p><a href="/a">one</a></p>\n<p>two</p>',
+                "[one][1]\n\ntwo\n\n[1]: /a",
+                0,
+                2,
+            ),
+            ("<p>one</p>\n<p>two</p>", "one\n\ntwo", 1, 4),
+            (
+                '<p><a href="/b">three</a></p>\n<p>two</p>',
+                "[three][1]\n\ntwo\n\n[1]: /b",
+                2,
+                5,
+            ),
+        ):
+            self.assertEqual(transformer.transform(_html), _expected)
+            self.assertEqual(transformer.block_cache.hits, _hits)
+            self.assertEqual(transformer.block_cache.misses, _misses)
+
+    def test_boilerplate(self):
+        _template = (
+            '<p class="header"><a href="/">Home</a> | <a href="/about">About</a>'
+            "</p>\n<h1>Post %s</h1>\n<p>The body of post %s.</p>\n"
+            "<p>This message is confidential.</p>"
+        )
+        transformer = Transformer(block_cache=100)
+        for _post in range(5):
+            _html = _template % (_post, _post)
+            self.assertEqual(
+                transformer.transform(_html), Transformer().transform(_html)
+            )
+        # the header and disclaimer are only rendered for the first post
+        self.assertEqual(transformer.block_cache.misses, 2 + 5 * 2)
+        self.assertEqual(transformer.block_cache.hits, 4 * 2)
+
+    def test_maxsize(self):
+        transformer = Transformer(block_cache=2)
+        transformer.transform("<p>one</p>\n<p>two</p>\n<p>three</p>")
+        self.assertEqual(len(transformer.block_cache), 2)
+        self.assertIsNone(Transformer().block_cache)
+        self.assertRaises(ValueError, Transformer, block_cache=0)
+
+
+class TestDebug(unittest.TestCase):
+    """
+    ``debug=True`` annotates the tokens and prints the token stacks; the
+    default path renders the same Markdown without any of this
+    """
+
+    _html = "<blockquote><p>a <b>b</b></p>\n\n<p>c</p></blockquote>"
+
+    def test_debug(self):
+        transformer = Transformer(backend="html.parser", debug=True)
+        tokens = list(transformer._tokenize(self._html))
+        with _captured_stdout() as _stdout:
+            _stack = to_markdown(tokens, **transformer._markdown_options())
+        _printed = _stdout.getvalue()
+        self.assertIn("-> raw stack >-", _printed)
+        self.assertIn("-> output stack >-", _printed)
+        self.assertTrue(any("_md_debug" in _token for _token in _stack))
+        self.assertTrue(
+            any("_md_whitespace_standardized" in _token for _token in _stack)
+        )
+        self.assertEqual(
+            Transformer(debug=False).transform(self._html),
+            "> a **b**\n> \n> c",
+        )
+
+    def test_default(self):
+        transformer = Transformer(backend="html.parser", debug=False)
+        tokens = list(transformer._tokenize(self._html))
+        _stack = to_markdown(tokens, **transformer._markdown_options())
+        for _token in _stack:
+            self.assertNotIn("_md_debug", _token)
+            self.assertNotIn("_md_whitespace_standardized", _token)
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "the py3 engine requires Python 3.7+")
+class TestEngine(unittest.TestCase):
+    """
+    the py3 engine must return the same values as the legacy engine, which is
+    used by Python 2; the fixtures are tested with either via `MD_ENGINE`
+    """
+
+    def test_engines(self):
+        from html5lib_to_markdown import _engine
+        from html5lib_to_markdown import _engine3
+
+        for (_func, _args) in (
+            ("attributes_from_parser", ([("a", "1"), ("b", None), ("a", "2")],)),
+            ("attributes_from_parser", ([],)),
+            ("attributes_from_tokenizer", ({"a": "1", "b": ""},)),
+            ("attributes_href", ("https://example.com",)),
+            ("bare_link_url", ("https:", {(None, "example.com"): ""})),
+            (
+                "bare_link_url",
+                ("https:", {(None, "example.com"): "", (None, "path"): "x"}),
+            ),
+            ("markdown_link", ("text", "/a", "", None)),
+            ("markdown_link", ("text", "/a", "title", None)),
+            ("markdown_link", ("text", "/a", "title", 1)),
+            ("markdown_image", ("alt", "/a.png", None, None)),
+            ("markdown_image", ("alt", "/a.png", "title", None)),
+            ("markdown_image", ("alt", "/a.png", "title", 0)),
+            ("markdown_reference", (1, "/a", None)),
+            ("markdown_reference", (1, "/a", "title")),
+        ):
+            _legacy = getattr(_engine, _func)(*_args)
+            _py3 = getattr(_engine3, _func)(*_args)
+            self.assertEqual(_legacy, _py3)
+            if isinstance(_py3, dict):
+                self.assertEqual(list(_legacy.items()), list(_py3.items()))
+        for _module in (_engine, _engine3):
+            _cache = OrderedDict(((1, "a"), (2, "b")))
+            self.assertEqual(_module.lru_get(_cache, 1), "a")
+            self.assertEqual(list(_cache.keys()), [2, 1])
+            self.assertRaises(KeyError, _module.lru_get, _cache, 3)
+            self.assertIsInstance(_module.Attributes(), dict)
+            self.assertIsInstance("text", _module.text_types)
+
+
+class TestStartup(unittest.TestCase):
+    """
+    html5lib is imported by the first ``Transformer``, not by the package
+    """
+
+    def test_import_is_lazy(self):
+        import subprocess
+
+        _output = subprocess.check_output(
+            [
+                sys.executable,
+                "-c",
+                "import sys; import html5lib_to_markdown; "
+                "print('html5lib' in sys.modules)",
+            ]
+        )
+        self.assertEqual(_output.strip(), b"False")
+
+    def test_token_types(self):
+        from html5lib.constants import tokenTypes
+        from html5lib_to_markdown.streams import tokenTypes as _tokenTypes
+
+        self.assertEqual(_tokenTypes, tokenTypes)
+
+    def test_prewarm(self):
+        from html5lib_to_markdown import prewarm
+
+        self.assertIsInstance(prewarm(), Transformer)
+        transformer = Transformer(backend="html.parser")
+        self.assertIs(prewarm(transformer), transformer)
+
+    def test_serializer(self):
+        from html5lib_to_markdown import transformer
+        from html5lib_to_markdown.serializer import MarkdownSerializer
+
+        self.assertIs(transformer.MarkdownSerializer, MarkdownSerializer)
+        self.assertIsInstance(Transformer()._serializer, MarkdownSerializer)
+
+    def test_serializer_subclass(self):
+        from html5lib_to_markdown.serializer import MarkdownSerializer
+
+        class _Serializer(MarkdownSerializer):
+            quote_attr_values = "always"
+
+            def serialize(self, domtree, encoding=None):
+                for token in super(_Serializer, self).serialize(domtree, encoding):
+                    yield token.upper()
+
+        serializer = _Serializer(omit_optional_tags=False)
+        self.assertIsInstance(serializer, MarkdownSerializer)
+        self.assertEqual(serializer._html_serializer.quote_attr_values, "always")
+        self.assertFalse(serializer._html_serializer.omit_optional_tags)
+        transformer = Transformer(serializer=serializer)
+        self.assertEqual(
+            transformer.transform("<blockquote>a <b>b</b></blockquote>"),
+            "> A **B**",
+        )
+
+
+@unittest.skipUnless(os.getenv("MD_MYPYC") == "1", "not the mypyc build")
+class TestCompiled(unittest.TestCase):
+    """
+    with `MD_MYPYC=1`, the tests must run against the compiled extensions, not
+    the pure Python modules which are installed beside them
+    """
+
+    def test_compiled(self):
+        import importlib
+
+        for _module_name in ("tokens", "transformer", "utils"):
+            _module = importlib.import_module("html5lib_to_markdown.%s" % _module_name)
+            self.assertFalse(_module.__file__.endswith((".py", ".pyc")))